@@ -1,9 +1,28 @@
 from __future__ import annotations
 
+import asyncio
+from datetime import timedelta
+
 from app.api.rest import middlewares
+from app.api.rest.context import AppContext
+from app.common import metrics
+from app.common import serial
+from app.common import settings
+from app.services import delivery
+from app.services.channels import ChannelDirectory
+from app.services.dispatcher import BroadcastDispatcher
+from app.services.notifications import QueueNotifier
+from app.services.outbox import Outbox
+from app.services.ratelimits import PacketRateLimiter
+from app.services.sessions import SessionCache
+from app.services.spectators import SpectatorEngine
+from app.services.users import UsersCache
+from app.services.world import WorldSnapshot
 from fastapi import FastAPI
 from shared_modules import http_client
 from shared_modules import logger
+from shared_modules.api.rest.v1.chats import ChatsClient
+from shared_modules.api.rest.v1.users import UsersClient
 from starlette.middleware.base import BaseHTTPMiddleware
 
 
@@ -23,6 +42,246 @@ def init_http_client(api: FastAPI) -> None:
         logger.info("HTTP client shut down")
 
 
+def init_world_snapshot(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_world_snapshot() -> None:
+        logger.info("Starting up world snapshot")
+        world_snapshot = WorldSnapshot()
+        api.state.world_snapshot = world_snapshot
+        api.state.world_snapshot_resync_task = asyncio.create_task(
+            world_snapshot.run_resync_loop(
+                UsersClient(api.state.http_client),
+                interval=settings.WORLD_SNAPSHOT_RESYNC_INTERVAL,
+                concurrency_limit=settings.UPSTREAM_CONCURRENCY_LIMIT))
+        logger.info("World snapshot started up")
+
+    @api.on_event("shutdown")
+    async def shutdown_world_snapshot() -> None:
+        logger.info("Shutting down world snapshot")
+        api.state.world_snapshot_resync_task.cancel()
+        del api.state.world_snapshot_resync_task
+        del api.state.world_snapshot
+        logger.info("World snapshot shut down")
+
+
+def init_channel_directory(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_channel_directory() -> None:
+        logger.info("Starting up channel directory")
+        channel_directory = ChannelDirectory()
+        api.state.channel_directory = channel_directory
+        api.state.channel_directory_sync_task = asyncio.create_task(
+            channel_directory.run_sync_loop(
+                ChatsClient(api.state.http_client),
+                interval=settings.CHANNEL_DIRECTORY_SYNC_INTERVAL,
+                concurrency_limit=settings.UPSTREAM_CONCURRENCY_LIMIT))
+        logger.info("Channel directory started up")
+
+    @api.on_event("shutdown")
+    async def shutdown_channel_directory() -> None:
+        logger.info("Shutting down channel directory")
+        api.state.channel_directory_sync_task.cancel()
+        del api.state.channel_directory_sync_task
+        del api.state.channel_directory
+        logger.info("Channel directory shut down")
+
+
+def init_queue_notifier(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_queue_notifier() -> None:
+        api.state.queue_notifier = QueueNotifier()
+
+    @api.on_event("shutdown")
+    async def shutdown_queue_notifier() -> None:
+        del api.state.queue_notifier
+
+
+def init_session_cache(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_session_cache() -> None:
+        session_cache = SessionCache(refresh_threshold=timedelta(
+            seconds=settings.SESSION_REFRESH_THRESHOLD))
+        api.state.session_cache = session_cache
+        metrics.register_gauge("sessions.cached", session_cache.__len__)
+
+    @api.on_event("shutdown")
+    async def shutdown_session_cache() -> None:
+        metrics.unregister_gauge("sessions.cached")
+        del api.state.session_cache
+
+
+def init_users_cache(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_users_cache() -> None:
+        users_cache = UsersCache(
+            presence_ttl=settings.PRESENCE_CACHE_TTL,
+            stats_ttl=settings.STATS_CACHE_TTL,
+            account_ttl=settings.ACCOUNT_CACHE_TTL,
+            max_size=settings.USERS_CACHE_MAX_SIZE,
+            concurrency_limit=settings.UPSTREAM_CONCURRENCY_LIMIT)
+        api.state.users_cache = users_cache
+        users_cache.register_gauges()
+
+    @api.on_event("shutdown")
+    async def shutdown_users_cache() -> None:
+        api.state.users_cache.unregister_gauges()
+        del api.state.users_cache
+
+
+def init_broadcast_dispatcher(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_broadcast_dispatcher() -> None:
+        logger.info("Starting up broadcast dispatcher")
+        broadcast_dispatcher = BroadcastDispatcher(
+            workers=settings.BROADCAST_WORKERS,
+            max_queue_size=settings.BROADCAST_QUEUE_SIZE,
+            max_attempts=settings.BROADCAST_MAX_ATTEMPTS,
+            retry_delay=settings.BROADCAST_RETRY_DELAY)
+        api.state.broadcast_dispatcher = broadcast_dispatcher
+        api.state.broadcast_dispatcher_tasks = \
+            broadcast_dispatcher.start_workers(AppContext(api))
+        metrics.register_gauge("dispatcher.queue_depth",
+                               broadcast_dispatcher.__len__)
+        metrics.register_gauge("dispatcher.lag",
+                               lambda: broadcast_dispatcher.lag)
+        logger.info("Broadcast dispatcher started up")
+
+    @api.on_event("shutdown")
+    async def shutdown_broadcast_dispatcher() -> None:
+        logger.info("Shutting down broadcast dispatcher")
+        metrics.unregister_gauge("dispatcher.queue_depth")
+        metrics.unregister_gauge("dispatcher.lag")
+        for task in api.state.broadcast_dispatcher_tasks:
+            task.cancel()
+        del api.state.broadcast_dispatcher_tasks
+        del api.state.broadcast_dispatcher
+        logger.info("Broadcast dispatcher shut down")
+
+
+def init_spectator_engine(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_spectator_engine() -> None:
+        spectator_engine = SpectatorEngine(
+            ttl=settings.SPECTATOR_CACHE_TTL,
+            max_size=settings.USERS_CACHE_MAX_SIZE,
+            frame_buffer_size=settings.SPECTATOR_FRAME_BUFFER_SIZE,
+            frame_buffer_budget=settings.SPECTATOR_FRAME_BUFFER_BUDGET)
+        api.state.spectator_engine = spectator_engine
+        spectator_engine.register_gauges()
+
+    @api.on_event("shutdown")
+    async def shutdown_spectator_engine() -> None:
+        api.state.spectator_engine.unregister_gauges()
+        del api.state.spectator_engine
+
+
+def init_outbox(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_outbox() -> None:
+        logger.info("Starting up outbox")
+        outbox = Outbox(max_bytes=settings.SESSION_QUEUE_MAX_BYTES,
+                        max_packets=settings.SESSION_QUEUE_MAX_PACKETS,
+                        backlog_ttl=settings.SESSION_QUEUE_BACKLOG_TTL)
+        api.state.outbox = outbox
+        api.state.outbox_flush_task = asyncio.create_task(
+            delivery.run_outbox_flush_loop(
+                AppContext(api), interval=settings.OUTBOX_FLUSH_INTERVAL))
+        metrics.register_gauge("outbox.sessions", outbox.__len__)
+        metrics.register_gauge("outbox.pending_bytes",
+                               lambda: outbox.pending_bytes)
+        logger.info("Outbox started up")
+
+    @api.on_event("shutdown")
+    async def shutdown_outbox() -> None:
+        logger.info("Shutting down outbox")
+        metrics.unregister_gauge("outbox.sessions")
+        metrics.unregister_gauge("outbox.pending_bytes")
+        api.state.outbox_flush_task.cancel()
+        del api.state.outbox_flush_task
+        del api.state.outbox
+        logger.info("Outbox shut down")
+
+
+def init_rate_limiter(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_rate_limiter() -> None:
+        rate_limiter = PacketRateLimiter(
+            limits={
+                serial.ClientPackets.SEND_PUBLIC_MESSAGE: (
+                    settings.PUBLIC_MESSAGE_RATE_LIMIT,
+                    settings.PUBLIC_MESSAGE_RATE_BURST),
+                serial.ClientPackets.CHANGE_ACTION: (
+                    settings.CHANGE_ACTION_RATE_LIMIT,
+                    settings.CHANGE_ACTION_RATE_BURST),
+                serial.ClientPackets.SPECTATE_FRAMES: (
+                    settings.SPECTATE_FRAMES_RATE_LIMIT,
+                    settings.SPECTATE_FRAMES_RATE_BURST),
+            },
+            max_sessions=settings.USERS_CACHE_MAX_SIZE)
+        api.state.rate_limiter = rate_limiter
+        rate_limiter.register_gauges()
+
+    @api.on_event("shutdown")
+    async def shutdown_rate_limiter() -> None:
+        api.state.rate_limiter.unregister_gauges()
+        del api.state.rate_limiter
+
+
+async def export_packet_metrics(interval: float) -> None:
+    """Log the packets handled (and the time spent handling them) by type,
+    since the previous export; busiest handlers first."""
+    # histogram name -> (count, sum) at the previous export
+    previous: dict[str, tuple[int, float]] = {}
+
+    while True:
+        await asyncio.sleep(interval)
+
+        packets: list[tuple[str, int, float]] = []
+        for name, hist in metrics.get_histograms("packets.latency.").items():
+            count, total = previous.get(name, (0, 0.0))
+            previous[name] = (hist.count, hist.sum)
+            if hist.count > count:
+                packets.append((name.removeprefix("packets.latency."),
+                                hist.count - count, hist.sum - total))
+
+        if not packets:
+            continue
+
+        packets.sort(key=lambda packet: packet[2], reverse=True)
+        logger.info("Packet handler metrics", interval=interval, packets={
+            name: {"count": count,
+                   "total_ms": round(total * 1000, 3),
+                   "mean_ms": round(total * 1000 / count, 3)}
+            for name, count, total in packets
+        })
+
+
+def init_serial_gauges(api: FastAPI) -> None:
+    @api.on_event("startup")
+    async def startup_serial_gauges() -> None:
+        metrics.register_gauge("serial.interned_strings",
+                               serial.get_interned_string_cache_info)
+
+    @api.on_event("shutdown")
+    async def shutdown_serial_gauges() -> None:
+        metrics.unregister_gauge("serial.interned_strings")
+
+
+def init_metrics_export(api: FastAPI) -> None:
+    if not settings.METRICS_EXPORT_INTERVAL:
+        return
+
+    @api.on_event("startup")
+    async def startup_metrics_export() -> None:
+        api.state.metrics_export_task = asyncio.create_task(
+            export_packet_metrics(settings.METRICS_EXPORT_INTERVAL))
+
+    @api.on_event("shutdown")
+    async def shutdown_metrics_export() -> None:
+        api.state.metrics_export_task.cancel()
+        del api.state.metrics_export_task
+
+
 def init_middlewares(api: FastAPI) -> None:
     middleware_stack = [
         middlewares.add_process_time_header_to_response,
@@ -46,6 +305,17 @@ def init_api():
     api = FastAPI()
 
     init_http_client(api)
+    init_world_snapshot(api)
+    init_channel_directory(api)
+    init_queue_notifier(api)
+    init_session_cache(api)
+    init_users_cache(api)
+    init_broadcast_dispatcher(api)
+    init_outbox(api)
+    init_spectator_engine(api)
+    init_rate_limiter(api)
+    init_serial_gauges(api)
+    init_metrics_export(api)
     init_middlewares(api)
     init_routes(api)
 
@@ -1,4 +1,16 @@
+from __future__ import annotations
+
 from app.common.context import Context
+from app.services.channels import ChannelDirectory
+from app.services.dispatcher import BroadcastDispatcher
+from app.services.notifications import QueueNotifier
+from app.services.outbox import Outbox
+from app.services.ratelimits import PacketRateLimiter
+from app.services.sessions import SessionCache
+from app.services.spectators import SpectatorEngine
+from app.services.users import UsersCache
+from app.services.world import WorldSnapshot
+from fastapi import FastAPI
 from fastapi import Request
 from shared_modules.http_client import ServiceHTTPClient
 
@@ -10,3 +22,87 @@ class RequestContext(Context):
     @property
     def http_client(self) -> ServiceHTTPClient:
         return self.request.state.http_client
+
+    @property
+    def world_snapshot(self) -> WorldSnapshot:
+        return self.request.app.state.world_snapshot
+
+    @property
+    def queue_notifier(self) -> QueueNotifier:
+        return self.request.app.state.queue_notifier
+
+    @property
+    def session_cache(self) -> SessionCache:
+        return self.request.app.state.session_cache
+
+    @property
+    def users_cache(self) -> UsersCache:
+        return self.request.app.state.users_cache
+
+    @property
+    def channel_directory(self) -> ChannelDirectory:
+        return self.request.app.state.channel_directory
+
+    @property
+    def broadcast_dispatcher(self) -> BroadcastDispatcher:
+        return self.request.app.state.broadcast_dispatcher
+
+    @property
+    def spectator_engine(self) -> SpectatorEngine:
+        return self.request.app.state.spectator_engine
+
+    @property
+    def outbox(self) -> Outbox:
+        return self.request.app.state.outbox
+
+    @property
+    def rate_limiter(self) -> PacketRateLimiter:
+        return self.request.app.state.rate_limiter
+
+
+class AppContext(Context):
+    """A context for work done outside of a request (e.g. by background
+    tasks)."""
+
+    def __init__(self, app: FastAPI) -> None:
+        self.app = app
+
+    @property
+    def http_client(self) -> ServiceHTTPClient:
+        return self.app.state.http_client
+
+    @property
+    def world_snapshot(self) -> WorldSnapshot:
+        return self.app.state.world_snapshot
+
+    @property
+    def queue_notifier(self) -> QueueNotifier:
+        return self.app.state.queue_notifier
+
+    @property
+    def session_cache(self) -> SessionCache:
+        return self.app.state.session_cache
+
+    @property
+    def users_cache(self) -> UsersCache:
+        return self.app.state.users_cache
+
+    @property
+    def channel_directory(self) -> ChannelDirectory:
+        return self.app.state.channel_directory
+
+    @property
+    def broadcast_dispatcher(self) -> BroadcastDispatcher:
+        return self.app.state.broadcast_dispatcher
+
+    @property
+    def spectator_engine(self) -> SpectatorEngine:
+        return self.app.state.spectator_engine
+
+    @property
+    def outbox(self) -> Outbox:
+        return self.app.state.outbox
+
+    @property
+    def rate_limiter(self) -> PacketRateLimiter:
+        return self.app.state.rate_limiter
@@ -1,14 +1,15 @@
 from __future__ import annotations
 
 import time
-from datetime import datetime
-from datetime import timedelta
 from typing import Any
 from uuid import UUID
 
 from app.api.rest.context import RequestContext
 from app.common import serial
+from app.common import settings
 from app.events.packets import handle_packet_event
+from app.services import delivery
+from app.services import world
 from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import Header
@@ -23,6 +24,9 @@ router = APIRouter()
 
 OSU_STABLE_PROTOCOL_VERSION = 19
 
+LOGIN_PRESENCES_FULL = "full"
+LOGIN_PRESENCES_BUNDLE = "bundle"
+
 
 def parse_login_data(data: bytes) -> LoginData:
     """Parse data from the body of a login request."""
@@ -75,15 +79,14 @@ async def login(request: Request, ctx: RequestContext = Depends()):
     # make sure this user isn't already logged in
     presences = await users_client.get_all_presences(username=login_data["username"])
     if presences is None:
-        return Response(content=serial.write_account_id_packet(-1),
+        return Response(content=serial.LOGIN_FAILED_PACKET,
                         headers={"cho-token": "no"},
                         status_code=200)
 
     # TODO: allow this if the existing session has been active for a while,
     # as a way to prevent ghosting sessions from being left open forever
     if len(presences) > 0:
-        response = Response(content=(serial.write_notification_packet("Your account is already logged in.")
-                                     + serial.write_account_id_packet(-1)),
+        response = Response(content=serial.ALREADY_LOGGED_IN_PACKETS,
                             headers={"cho-token": "no"},
                             status_code=200)
         return response
@@ -93,7 +96,7 @@ async def login(request: Request, ctx: RequestContext = Depends()):
                                         login_data["password_md5"],
                                         user_agent="osu!")
     if session is None:
-        response = Response(content=serial.write_account_id_packet(-1),
+        response = Response(content=serial.LOGIN_FAILED_PACKET,
                             headers={"cho-token": "no"},
                             status_code=200)
         return response
@@ -101,48 +104,38 @@ async def login(request: Request, ctx: RequestContext = Depends()):
     session_id = session.session_id
     account_id = session.account_id
 
+    # (make sure we see any changes to the account since it last logged in)
+    ctx.users_cache.invalidate_account(account_id)
+
     # TODO: privileges
     privileges = 2_147_483_647
-    def is_restricted(server_privs: int): return False
-    def to_client_privileges(server_privs: int): return server_privs & 0xff
 
     # TODO: endpoint to submit client hashes
     # (osu_path_md5, adapters_str, adapters_md5, uninstall_md5, disk_signature_md5)
 
-    response_buffer = bytearray()
-    response_buffer += serial.write_protocol_version_packet(
+    response_buffer = serial.PacketWriter()
+    response_buffer.write_protocol_version(
         version=OSU_STABLE_PROTOCOL_VERSION)
-    response_buffer += serial.write_account_id_packet(account_id)
-    response_buffer += serial.write_privileges_packet(privileges)
-
-    chats = await chats_client.get_chats()
-    if chats is None:
-        return Response(content=serial.write_account_id_packet(-1),
-                        headers={"cho-token": "no"},
-                        status_code=200)
-
-    for chat in chats:
-        if chat.name == "#lobby":
-            continue
-
-        members = await chats_client.get_members(chat.chat_id)
-        if members is None:
-            return Response(content=serial.write_account_id_packet(-1),
+    response_buffer.write_account_id(account_id)
+    response_buffer.write_privileges(privileges)
+
+    channel_directory = ctx.channel_directory
+    if not channel_directory.synced:
+        synced = await channel_directory.sync(
+            chats_client,
+            concurrency_limit=settings.UPSTREAM_CONCURRENCY_LIMIT)
+        if not synced:
+            return Response(content=serial.LOGIN_FAILED_PACKET,
                             headers={"cho-token": "no"},
                             status_code=200)
 
-        response_buffer += serial.write_channel_info_packet(
-            channel=chat.name,
-            topic=chat.topic,
-            user_count=len(members),
-        )
-
-        # TODO: enqueue to other players that we've joined
+    # (the pre-encoded channel info block ends with CHANNEL_INFO_END)
+    response_buffer.write_raw(channel_directory.get_channel_info_packets())
 
-    response_buffer += serial.write_channel_info_end_packet()
+    # TODO: enqueue to other players that we've joined
 
     # TODO: unhardcode these into an sql table
-    # response_buffer += serial.write_main_menu_icon_packet(
+    # response_buffer.write_main_menu_icon(
     #     icon_url="https://akatsuki.pw/static/images/logos/logo.png",
     #     onclick_url="https://akatsuki.pw",
     # )
@@ -150,21 +143,17 @@ async def login(request: Request, ctx: RequestContext = Depends()):
     friends = []  # TODO: friends
     silence_end = 0  # TODO: silences
 
-    response_buffer += serial.write_friends_list_packet(friends)
-    response_buffer += serial.write_silence_end_packet(silence_end)
+    response_buffer.write_friends_list(friends)
+    response_buffer.write_silence_end(silence_end)
 
     # TODO: geolocation
     country_code = 38
     latitude = 48.23
     longitude = 16.37
 
-    # TODO: global player rankings
-
-    def get_global_rank(account_id: int) -> int:
-        return 0
-
     # create user presence
-    presence = await users_client.create_presence(
+    presence = await ctx.users_cache.create_presence(
+        users_client,
         session_id,
         game_mode=0,
         account_id=account_id,
@@ -183,16 +172,19 @@ async def login(request: Request, ctx: RequestContext = Depends()):
         display_city=login_data["display_city"],
         pm_private=login_data["pm_private"])
     if presence is None:
-        return Response(content=serial.write_account_id_packet(-1),
+        return Response(content=serial.LOGIN_FAILED_PACKET,
                         headers={"cho-token": "no"},
                         status_code=200)
 
     game_mode: int = presence.game_mode
 
     # fetch user stats
-    stats = await users_client.get_stats(account_id, game_mode)
+    # (make sure they're fresh, as with the account above)
+    ctx.users_cache.invalidate_stats(account_id, game_mode)
+    stats = await ctx.users_cache.get_stats(users_client, account_id,
+                                            game_mode)
     if stats is None:
-        return Response(content=serial.write_account_id_packet(-1),
+        return Response(content=serial.LOGIN_FAILED_PACKET,
                         headers={"cho-token": "no"},
                         status_code=200)
 
@@ -203,105 +195,50 @@ async def login(request: Request, ctx: RequestContext = Depends()):
     #  'active', 'created_at': '2022-09-18T12:25:04.923023+00:00',
     #  'updated_at': '2022-09-18T12:25:04.923023+00:00'}
 
-    user_global_rank = get_global_rank(account_id)
-
-    user_presence_data = serial.write_user_presence_packet(
-        account_id=account_id,
-        username=login_data["username"],
-        utc_offset=presence.utc_offset,
-        country_code=presence.country_code,
-        bancho_privileges=to_client_privileges(presence.privileges),
-        mode=presence.game_mode,
-        latitude=presence.latitude,
-        longitude=presence.longitude,
-        global_rank=user_global_rank)
-
-    user_stats_data = serial.write_user_stats_packet(
-        account_id=account_id,
-        action=presence.action,
-        info_text=presence.info_text,
-        map_md5=presence.map_md5,
-        mods=presence.mods,
-        mode=presence.game_mode,
-        map_id=presence.map_id,
-        ranked_score=stats.ranked_score,
-        accuracy=stats.accuracy,
-        play_count=stats.play_count,
-        total_score=stats.total_score,
-        global_rank=user_global_rank,
-        pp=stats.performance)
-
-    response_buffer += user_presence_data
-    response_buffer += user_stats_data
-
-    # TODO: other sessions presences & account stats
-    other_presences = await users_client.get_all_presences()
-    if other_presences is None:
-        return Response(content=serial.write_account_id_packet(-1),
-                        headers={"cho-token": "no"},
-                        status_code=200)
-
-    for other_presence in other_presences:
-        if other_presence.session_id == session_id:
-            continue
+    user_presence_data = world.write_user_presence_packet(presence)
+    user_stats_data = world.write_user_stats_packet(presence, stats)
 
-        if is_restricted(other_presence.privileges):
-            continue
+    response_buffer.write_raw(user_presence_data)
+    response_buffer.write_raw(user_stats_data)
 
-        other_stats = await users_client.get_stats(other_presence.account_id,
-                                                   other_presence.game_mode)
-        if other_stats is None:
-            return Response(content=serial.write_account_id_packet(-1),
+    # other sessions presences & account stats
+    world_snapshot = ctx.world_snapshot
+    if not world_snapshot.synced:
+        synced = await world_snapshot.resync(
+            users_client,
+            concurrency_limit=settings.UPSTREAM_CONCURRENCY_LIMIT)
+        if not synced:
+            return Response(content=serial.LOGIN_FAILED_PACKET,
                             headers={"cho-token": "no"},
                             status_code=200)
 
-        global_rank = get_global_rank(other_presence.account_id)
-
-        # send them to us
-        response_buffer += serial.write_user_presence_packet(
-            account_id=other_presence.account_id,
-            username=other_presence.username,
-            utc_offset=other_presence.utc_offset,
-            country_code=other_presence.country_code,
-            bancho_privileges=to_client_privileges(
-                other_presence.privileges),
-            mode=other_presence.game_mode,
-            latitude=other_presence.latitude,
-            longitude=other_presence.longitude,
-            global_rank=global_rank)
-
-        response_buffer += serial.write_user_stats_packet(
-            account_id=other_presence.account_id,
-            action=other_presence.action,
-            info_text=other_presence.info_text,
-            map_md5=other_presence.map_md5,
-            mods=other_presence.mods,
-            mode=other_presence.game_mode,
-            map_id=other_presence.map_id,
-            ranked_score=other_stats.ranked_score,
-            accuracy=other_stats.accuracy,
-            play_count=other_stats.play_count,
-            total_score=other_stats.total_score,
-            global_rank=global_rank,
-            pp=other_stats.performance)
-
-        # send us to them
-        success = await users_client.enqueue_packet(other_presence.session_id,
-                                                    data=list(user_presence_data + user_stats_data))
-        if not success:
-            response = Response(content=serial.write_account_id_packet(-1),
-                                headers={"cho-token": "no"},
-                                status_code=200)
-            return response
-
-    response_buffer += serial.write_notification_packet(
+    # send them to us
+    if settings.LOGIN_PRESENCES == LOGIN_PRESENCES_BUNDLE:
+        # (the client requests the presences it displays, as it needs them)
+        response_buffer.write_user_presence_bundle(
+            world_snapshot.account_ids(exclude_session_id=session_id))
+    else:
+        response_buffer.write_raw(world_snapshot.get_packets(
+            exclude_session_id=session_id))
+
+    world_snapshot.set_player(session_id, user_presence_data, user_stats_data)
+    world_snapshot.set_friends(session_id, friends)
+
+    # send us to them
+    ctx.broadcast_dispatcher.submit(
+        user_presence_data + user_stats_data,
+        world_snapshot.get_presence_recipients(account_id,
+                                               exclude=session_id),
+        key=session_id)
+
+    response_buffer.write_notification(
         message="Welcome to Akatsuki v2!")
 
     end_time = time.time()
-    response_buffer += serial.write_notification_packet(
+    response_buffer.write_notification(
         f"Login took {(end_time - start_time) * 1000:.2f}ms")
 
-    response = Response(content=bytes(response_buffer),
+    response = Response(content=response_buffer.getvalue(),
                         headers={"cho-token": str(session_id)},
                         status_code=200)
     return response
@@ -313,46 +250,76 @@ async def bancho(request: Request,
                  ctx: RequestContext = Depends()):
     users_client = UsersClient(ctx.http_client)
 
-    new_session_expiry = datetime.utcnow() + timedelta(minutes=5)
-
-    session = await users_client.partial_update_session(session_id,
-                                                        expires_at=new_session_expiry)
+    session = await ctx.session_cache.get(users_client, session_id)
     if session is None:
         # this session could not be found - probably expired
-        response = Response(content=(serial.write_notification_packet("Service has restarted")
-                                     + serial.write_server_restart_packet(ms=0)),
+        ctx.outbox.remove(session_id)
+        ctx.rate_limiter.remove(session_id)
+        chats_left = await ctx.channel_directory.leave_all(
+            ChatsClient(ctx.http_client), session_id,
+            concurrency_limit=settings.UPSTREAM_CONCURRENCY_LIMIT)
+        if not chats_left:
+            logger.warning("Failed to leave chats of an expired session",
+                           session_id=session_id)
+
+        response = Response(content=serial.SERVICE_RESTARTED_PACKETS,
                             status_code=200)
         return response
 
     response_buffer = bytearray()
+    logging_out = False
+
+    # handle each packet as soon as it has been fully received
+    packet_framer = serial.PacketFramer(
+        max_size=settings.BANCHO_MAX_REQUEST_SIZE)
+    try:
+        async for chunk in request.stream():
+            for packet_id, packet_data in packet_framer.feed(chunk):
+                if packet_id == serial.ClientPackets.LOGOUT:
+                    logging_out = True
+
+                packet_response = await handle_packet_event(ctx, session,
+                                                            packet_id,
+                                                            packet_data)
+                response_buffer += packet_response
+
+        packet_framer.close()
+    except serial.TruncatedPacketError as exc:
+        logger.warning("Received a truncated packet",
+                       session_id=session_id, error=str(exc))
+    except serial.RequestTooLargeError as exc:
+        logger.warning("Received an oversized request",
+                       session_id=session_id, error=str(exc))
+
+    # low delay mode: hold the request open until there's something to
+    # send, then have the client poll again immediately
+    long_poll = settings.BANCHO_LONG_POLL_TIMEOUT > 0 and not logging_out
+
+    # (listening before the dequeue, so nothing enqueued after it is missed)
+    with ctx.queue_notifier.listen(session_id) as queue_event:
+        # fetch any data from the player's packet queue
+        queued_data = await delivery.dequeue_all(ctx, session_id)
+
+        if long_poll and not response_buffer and queued_data == b"":
+            if await ctx.queue_notifier.wait(
+                    queue_event, settings.BANCHO_LONG_POLL_TIMEOUT):
+                queued_data = await delivery.dequeue_all(ctx, session_id)
+
+    if queued_data is None:
+        # the session may have been deleted; validate it upstream next time
+        ctx.session_cache.invalidate(session_id)
 
-    # TODO: async for chunk in request.stream()
-    with memoryview(await request.body()) as raw_data:
-        data_reader = serial.Reader(raw_data)
-
-        while not data_reader.stream_consumed:
-            packet_id = data_reader.read_uint16()
-            _ = data_reader.read_uint8()  # reserved byte
-            packet_length = data_reader.read_uint32()
-
-            packet_data = data_reader.read_bytes(packet_length)
-
-            packet_response = await handle_packet_event(ctx, session,
-                                                        packet_id, packet_data)
-            response_buffer += packet_response
-
-    # fetch any data from the player's packet queue
-    queued_packets = await users_client.deqeue_all_packets(session_id)
-    if queued_packets is None:
         # TODO: should we send a packet here?
-        # response = Response(content=serial.write_account_id_packet(-1),
+        # response = Response(content=serial.LOGIN_FAILED_PACKET,
         #                     headers={"cho-token": "no"},
         #                     status_code=200)
         response = b""
         return response
 
-    for packet in queued_packets:
-        response_buffer.extend(packet.data)
+    response_buffer += queued_data
+
+    if long_poll:
+        response_buffer += serial.PONG_PACKET
 
     response_data = bytes(response_buffer)
 
@@ -0,0 +1,11 @@
+from __future__ import annotations
+
+from app.common import metrics
+from fastapi import APIRouter
+
+router = APIRouter()
+
+
+@router.get("/v1/metrics")
+async def get_metrics():
+    return metrics.snapshot()
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Generic
+from typing import Hashable
+from typing import TypeVar
+
+from app.common import metrics
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """A size-bounded LRU cache whose entries also expire after `ttl`
+    seconds. Hits & misses are counted as `<name>.hits` & `<name>.misses`.
+    """
+
+    def __init__(self, name: str, ttl: float, max_size: int) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # key -> (expires at, value), least recently used first
+        self._entries: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.increment(f"{self.name}.hits")
+                return value
+
+            del self._entries[key]
+
+        self.misses += 1
+        metrics.increment(f"{self.name}.misses")
+        return None
+
+    def peek(self, key: K) -> V | None:
+        """As get, without counting the lookup or refreshing its recency."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def set(self, key: K, value: V) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            metrics.increment(f"{self.name}.evictions")
+
+    def pop(self, key: K) -> V | None:
+        entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def register_gauges(self) -> None:
+        metrics.register_gauge(f"{self.name}.size", self.__len__)
+        metrics.register_gauge(f"{self.name}.hit_ratio",
+                               lambda: self.hit_ratio)
+
+    def unregister_gauges(self) -> None:
+        metrics.unregister_gauge(f"{self.name}.size")
+        metrics.unregister_gauge(f"{self.name}.hit_ratio")
@@ -0,0 +1,21 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable
+from typing import Iterable
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+async def gather_bounded(awaitables: Iterable[Awaitable[T]],
+                         limit: int) -> list[T]:
+    """Like asyncio.gather, but with at most `limit` awaitables running
+    at once. Results are returned in the order the awaitables were given."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(awaitable: Awaitable[T]) -> T:
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*(run(awaitable) for awaitable in awaitables))
@@ -2,12 +2,70 @@ from __future__ import annotations
 
 from abc import ABC
 from abc import abstractmethod
+from typing import TYPE_CHECKING
 
+from app.services.channels import ChannelDirectory
+from app.services.notifications import QueueNotifier
+from app.services.outbox import Outbox
+from app.services.ratelimits import PacketRateLimiter
+from app.services.sessions import SessionCache
+from app.services.users import UsersCache
+from app.services.world import WorldSnapshot
 from shared_modules.http_client import ServiceHTTPClient
 
+if TYPE_CHECKING:
+    # (these deliver through a context)
+    from app.services.dispatcher import BroadcastDispatcher
+    from app.services.spectators import SpectatorEngine
+
 
 class Context(ABC):
     @property
     @abstractmethod
     def http_client(self) -> ServiceHTTPClient:
         ...
+
+    @property
+    @abstractmethod
+    def world_snapshot(self) -> WorldSnapshot:
+        ...
+
+    @property
+    @abstractmethod
+    def queue_notifier(self) -> QueueNotifier:
+        ...
+
+    @property
+    @abstractmethod
+    def session_cache(self) -> SessionCache:
+        ...
+
+    @property
+    @abstractmethod
+    def users_cache(self) -> UsersCache:
+        ...
+
+    @property
+    @abstractmethod
+    def channel_directory(self) -> ChannelDirectory:
+        ...
+
+    @property
+    @abstractmethod
+    def broadcast_dispatcher(self) -> BroadcastDispatcher:
+        ...
+
+    @property
+    @abstractmethod
+    def spectator_engine(self) -> SpectatorEngine:
+        ...
+
+    @property
+    @abstractmethod
+    def outbox(self) -> Outbox:
+        ...
+
+    @property
+    @abstractmethod
+    def rate_limiter(self) -> PacketRateLimiter:
+        ...
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Any
+from typing import Callable
+
+# process-local counters, gauges & histograms, exported through /v1/metrics
+
+# the default histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram:
+    """Counts observations into fixed buckets, each counting the values up
+    to (and including) its bound that didn't fit a smaller one."""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # (+ the overflow)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self) -> dict[str, Any]:
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip(bounds, self.bucket_counts)),
+        }
+
+
+_counters: defaultdict[str, int] = defaultdict(int)
+_gauges: dict[str, Callable[[], Any]] = {}
+_histograms: dict[str, Histogram] = {}
+
+
+def increment(name: str, value: int = 1) -> None:
+    _counters[name] += value
+
+
+def get_counter(name: str) -> int:
+    return _counters.get(name, 0)
+
+
+def register_gauge(name: str, func: Callable[[], Any]) -> None:
+    """Register a gauge, whose (json serializable) value is read when
+    metrics are exported."""
+    _gauges[name] = func
+
+
+def unregister_gauge(name: str) -> None:
+    _gauges.pop(name, None)
+
+
+def histogram(name: str) -> Histogram:
+    """The histogram of the given name, created if it doesn't exist yet.
+    Callers on hot paths should keep hold of it, rather than look it up
+    for each observation."""
+    hist = _histograms.get(name)
+    if hist is None:
+        hist = _histograms[name] = Histogram()
+    return hist
+
+
+def get_histograms(prefix: str = "") -> dict[str, Histogram]:
+    return {name: hist for name, hist in _histograms.items()
+            if name.startswith(prefix)}
+
+
+def snapshot() -> dict[str, Any]:
+    return {
+        "counters": dict(sorted(_counters.items())),
+        "gauges": {name: func() for name, func in sorted(_gauges.items())},
+        "histograms": {name: hist.to_dict()
+                       for name, hist in sorted(_histograms.items())},
+    }
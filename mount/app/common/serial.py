@@ -2,6 +2,14 @@ from __future__ import annotations
 
 import struct
 from functools import cache
+from functools import lru_cache
+from typing import Any
+from typing import Callable
+from typing import Iterable
+from typing import Mapping
+from typing import Sequence
+
+import numpy
 
 # writing
 
@@ -84,81 +92,132 @@ def pack_string(value: str) -> bytes:
 
 # reading
 
+class TruncatedPacketError(ValueError):
+    """Raised when a read runs past the end of the data."""
+
+
+UINT8_STRUCT = struct.Struct('<B')
+UINT16_STRUCT = struct.Struct('<H')
+UINT32_STRUCT = struct.Struct('<I')
+UINT64_STRUCT = struct.Struct('<Q')
+INT8_STRUCT = struct.Struct('<b')
+INT16_STRUCT = struct.Struct('<h')
+INT32_STRUCT = struct.Struct('<i')
+INT64_STRUCT = struct.Struct('<q')
+FLOAT32_STRUCT = struct.Struct('<f')
+FLOAT64_STRUCT = struct.Struct('<d')
+
+
 class Reader:
+    """Reads values from a buffer by advancing an offset into it.
+
+    The underlying buffer is never re-sliced; read_bytes() returns a
+    zero-copy view into it when the buffer is a memoryview.
+    """
+
     def __init__(self, data: bytes) -> None:
-        self.remaining_data = data
+        self.data = data
+        self.offset = 0
+
+    @property
+    def remaining_data(self) -> bytes:
+        return self.data[self.offset:]
+
+    @property
+    def bytes_remaining(self) -> int:
+        return len(self.data) - self.offset
 
     @property
     def stream_consumed(self) -> bool:
-        return not self.remaining_data
+        return self.offset >= len(self.data)
+
+    def _advance(self, length: int) -> int:
+        offset = self.offset
+        if offset + length > len(self.data):
+            raise TruncatedPacketError(
+                f"Tried to read {length} bytes at offset {offset}, "
+                f"but only {len(self.data) - offset} remain")
+
+        self.offset = offset + length
+        return offset
+
+    def _unpack(self, unpacker: struct.Struct) -> Any:
+        offset = self._advance(unpacker.size)
+        return unpacker.unpack_from(self.data, offset)[0]
 
     def read_bytes(self, length: int = -1) -> bytes:
         if length == -1:
-            length = len(self.remaining_data)
+            length = len(self.data) - self.offset
 
-        raw_data = self.remaining_data[:length]
-        self.remaining_data = self.remaining_data[length:]
-        return raw_data
+        offset = self._advance(length)
+        return self.data[offset:offset + length]
 
     def read_uint8(self) -> int:
-        raw_data = self.read_bytes(1)
-        return struct.unpack('<B', raw_data)[0]
+        return self._unpack(UINT8_STRUCT)
 
     def read_uint16(self) -> int:
-        raw_data = self.read_bytes(2)
-        return struct.unpack('<H', raw_data)[0]
+        return self._unpack(UINT16_STRUCT)
 
     def read_uint32(self) -> int:
-        raw_data = self.read_bytes(4)
-        return struct.unpack('<I', raw_data)[0]
+        return self._unpack(UINT32_STRUCT)
 
     def read_uint64(self) -> int:
-        raw_data = self.read_bytes(8)
-        return struct.unpack('<Q', raw_data)[0]
+        return self._unpack(UINT64_STRUCT)
 
     def read_int8(self) -> int:
-        raw_data = self.read_bytes(1)
-        return struct.unpack('<b', raw_data)[0]
+        return self._unpack(INT8_STRUCT)
 
     def read_int16(self) -> int:
-        raw_data = self.read_bytes(2)
-        return struct.unpack('<h', raw_data)[0]
+        return self._unpack(INT16_STRUCT)
 
     def read_int32(self) -> int:
-        raw_data = self.read_bytes(4)
-        return struct.unpack('<i', raw_data)[0]
+        return self._unpack(INT32_STRUCT)
 
     def read_int64(self) -> int:
-        raw_data = self.read_bytes(8)
-        return struct.unpack('<q', raw_data)[0]
+        return self._unpack(INT64_STRUCT)
 
     def read_float(self) -> float:
-        raw_data = self.read_bytes(4)
-        return struct.unpack('<f', raw_data)[0]
+        return self._unpack(FLOAT32_STRUCT)
 
     def read_double(self) -> float:
-        raw_data = self.read_bytes(8)
-        return struct.unpack('<d', raw_data)[0]
+        return self._unpack(FLOAT64_STRUCT)
+
+    def read_int32_list(self) -> list[int]:
+        """An int16 count, followed by that many int32 values."""
+        count = self.read_int16()
+        if count <= 0:
+            return []
+
+        unpacker = struct.Struct(f"<{count}i")
+        offset = self._advance(unpacker.size)
+        return list(unpacker.unpack_from(self.data, offset))
 
     def read_string(self) -> str:
         exists = self.read_uint8()
         if exists != 0x0b:
             return ""
 
+        data = self.data
+        offset = self.offset
+
         length = 0
         shift = 0
         while True:
-            byte = self.read_uint8()
+            if offset >= len(data):
+                raise TruncatedPacketError(
+                    "String length runs past the end of the data")
+
+            byte = data[offset]
+            offset += 1
+
             length |= (byte & 0x7F) << shift
             shift += 7
             if not byte & 0x80:
                 break
 
-        raw_data = self.read_bytes(length)
-        if isinstance(raw_data, memoryview):
-            raw_data = raw_data.tobytes()
-
-        return raw_data.decode('utf-8')
+        self.offset = offset
+        offset = self._advance(length)
+        return str(data[offset:offset + length], 'utf-8')
 
 
 # osu! packets
@@ -215,6 +274,10 @@ class ClientPackets:
     TOURNAMENT_LEAVE_MATCH_CHANNEL = 109
 
 
+# every client packet id is below this
+MAX_CLIENT_PACKET_ID = 128
+
+
 @cache
 def client_packet_id_to_name(packet_id: int) -> str:
     id_to_name_map = {v: k for k, v in vars(
@@ -295,112 +358,603 @@ def server_packet_id_to_name(packet_id: int) -> str:
 
 RESERVED_BYTE = b"\x00"
 
+PACKET_HEADER = struct.Struct("<HxI")  # packet id, reserved byte, length
+
 
 def write_packet(packet_id: int, data: bytes = b"") -> bytes:
-    return pack_uint16(packet_id) + RESERVED_BYTE + pack_uint32(len(data)) + data
+    return PACKET_HEADER.pack(packet_id, len(data)) + data
+
+
+# packet schemas
+#
+# each server packet is declared as a sequence of (field name, wire type)
+# pairs. schemas are compiled once at import into a generated encoder:
+# runs of consecutive fixed-width fields share a precompiled struct.Struct
+# (the leading run is packed along with the packet header), and the packet
+# is assembled with a single join. packets made up entirely of fixed-width
+# fields are encoded by a single Struct.pack call.
+
+# fixed-width wire types (struct format characters)
+UINT8 = "B"
+UINT16 = "H"
+UINT32 = "I"
+UINT64 = "Q"
+INT8 = "b"
+INT16 = "h"
+INT32 = "i"
+INT64 = "q"
+FLOAT32 = "f"
+FLOAT64 = "d"
+
+# variable-width wire types
+STRING = "string"  # uleb128 length-prefixed utf-8
+INTERNED_STRING = "interned_string"  # as STRING; encodings are cached
+RAW = "raw"  # copied verbatim
+UINT32_LIST = "uint32_list"  # uint16 count, followed by uint32 values
+
+FIXED_WIDTH_TYPES = frozenset((UINT8, UINT16, UINT32, UINT64, INT8, INT16,
+                               INT32, INT64, FLOAT32, FLOAT64))
+
+NUMPY_TYPES = {
+    UINT8: "u1",
+    UINT16: "<u2",
+    UINT32: "<u4",
+    UINT64: "<u8",
+    INT8: "i1",
+    INT16: "<i2",
+    INT32: "<i4",
+    INT64: "<i8",
+    FLOAT32: "<f4",
+    FLOAT64: "<f8",
+}
+
+PACKET_HEADER_DTYPE = (("_packet_id", "<u2"),
+                       ("_reserved", "u1"),
+                       ("_length", "<u4"))
+
+
+def pack_uint32_list(values: list[int]) -> bytes:
+    return struct.pack(f"<H{len(values)}I", len(values), *values)
+
+
+def pack_string_header(length: int) -> bytes:
+    """The bytes preceding a utf-8 encoded string of the given length."""
+    if length == 0:
+        return b"\x00"
+
+    ret = bytearray()
+    ret += b"\x0b"
+
+    while length > 0:
+        ret.append(length & 0x7F)
+        length >>= 7
+        if length > 0:
+            ret[-1] |= 0x80
+
+    return bytes(ret)
+
+
+# nearly all strings fit in a single uleb128 byte
+SHORT_STRING_HEADERS = tuple(pack_string_header(length)
+                             for length in range(0x80))
+
+# usernames, channel names, map md5s, etc. are sent over and over again;
+# keep the encodings of the most recently used ones around
+INTERNED_STRING_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=INTERNED_STRING_CACHE_SIZE)
+def pack_interned_string(value: str) -> bytes:
+    encoded = value.encode()
+    length = len(encoded)
+    if length < 0x80:
+        return SHORT_STRING_HEADERS[length] + encoded
+
+    return pack_string_header(length) + encoded
+
+
+def get_interned_string_cache_info() -> dict[str, int]:
+    info = pack_interned_string.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
+
+
+def _pack_string_column(values: Sequence[str]
+                        ) -> list[tuple[bytes, numpy.ndarray]]:
+    """Encode a column of strings as two pieces; the uleb128 headers, and
+    the utf-8 data of every row."""
+    count = len(values)
+
+    data = "".join(values).encode()
+    lengths = numpy.fromiter(map(len, values), dtype=numpy.int64, count=count)
+    if len(data) != lengths.sum():
+        # not pure ascii; character counts aren't byte counts
+        encoded = [value.encode() for value in values]
+        data = b"".join(encoded)
+        lengths = numpy.fromiter(map(len, encoded), dtype=numpy.int64,
+                                 count=count)
+
+    # b"\x00" for empty strings, otherwise b"\x0b" + uleb128(length)
+    uleb128_sizes = 1 + sum((lengths >= 1 << (7 * i)).astype(numpy.int64)
+                            for i in range(1, 5))
+    header_lengths = numpy.where(lengths == 0, 1, 1 + uleb128_sizes)
+
+    header_bytes = numpy.zeros((count, 6), dtype=numpy.uint8)
+    header_bytes[:, 0] = numpy.where(lengths == 0, 0x00, 0x0b)
+    for i in range(5):
+        continues = (uleb128_sizes > i + 1).astype(numpy.int64) << 7
+        header_bytes[:, i + 1] = ((lengths >> (7 * i)) & 0x7F) | continues
+
+    header_mask = numpy.arange(6) < header_lengths[:, None]
+    headers = header_bytes[header_mask].tobytes()
+
+    return [(headers, header_lengths), (data, lengths)]
+
+
+class PacketSchema:
+    def __init__(self, packet_id: int,
+                 fields: tuple[tuple[str, str], ...] = ()) -> None:
+        self.packet_id = packet_id
+        self.fields = fields
+        self.field_names = tuple(name for name, _ in fields)
+
+        self._namespace: dict[str, Any] = {
+            "SHORT_STRING_HEADERS": SHORT_STRING_HEADERS,
+            "pack_string_header": pack_string_header,
+            "pack_uint32_list": pack_uint32_list,
+            "pack_interned_string": pack_interned_string,
+        }
+        self._compile_layout()
+
+        self.encode = self._compile_encoder()
+        self.write_into = self._compile_writer()
+
+    def _compile_layout(self) -> None:
+        """Split the fields into the packet head (the header along with any
+        leading fixed-width fields), and a sequence of steps, each either a
+        run of fixed-width fields or a single variable-width field."""
+        self._head_args: list[str] = []
+        self._steps: list[tuple[str, int, list[str]]] = []
+        self._fixed_size = 0
+
+        head_format = PACKET_HEADER.format
+        run_format = ""
+        run_args: list[str] = []
+
+        # numpy equivalents of the head & runs, for encode_many()
+        head_dtype = list(PACKET_HEADER_DTYPE)
+        self._run_dtypes: dict[int, numpy.dtype] = {}
+
+        def flush_run(index: int) -> None:
+            nonlocal head_format, run_format, run_args
+            if not run_format:
+                return
+
+            run_struct = struct.Struct("<" + run_format)
+            self._fixed_size += run_struct.size
+
+            run_dtype = [(name, NUMPY_TYPES[wire_type])
+                         for name, wire_type in zip(run_args, run_format)]
+
+            if not self._steps:
+                head_format += run_format
+                self._head_args += run_args
+                head_dtype.extend(run_dtype)
+            else:
+                self._namespace[f"run_{index}"] = run_struct
+                self._steps.append(("run", index, run_args))
+                self._run_dtypes[index] = numpy.dtype(run_dtype)
+
+            run_format = ""
+            run_args = []
+
+        for index, (name, wire_type) in enumerate(self.fields):
+            if wire_type in FIXED_WIDTH_TYPES:
+                run_format += wire_type
+                run_args.append(name)
+                continue
+
+            if wire_type not in (STRING, INTERNED_STRING, RAW, UINT32_LIST):
+                raise ValueError(f"Unknown wire type {wire_type!r} "
+                                 f"for field {name!r}")
+
+            flush_run(index)
+            self._steps.append((wire_type, index, [name]))
+
+        flush_run(len(self.fields))
+
+        self._namespace["head"] = struct.Struct(head_format)
+        self._head_dtype = numpy.dtype(head_dtype)
+
+    def _compile(self, signature: str, lines: list[str]) -> Callable[..., Any]:
+        name = signature.split("(", 1)[0]
+        source = (f"def {signature}:\n"
+                  + "".join(f"    {line}\n" for line in lines))
+        exec(source, self._namespace)
+        return self._namespace.pop(name)
+
+    def _compile_variable_fields(self, lines: list[str]) -> None:
+        for kind, index, (name, *_) in self._steps:
+            if kind == STRING:
+                lines += [
+                    f"encoded_{index} = {name}.encode()",
+                    f"length_{index} = len(encoded_{index})",
+                    f"header_{index} = (SHORT_STRING_HEADERS[length_{index}]"
+                    f" if length_{index} < 128"
+                    f" else pack_string_header(length_{index}))",
+                ]
+            elif kind == INTERNED_STRING:
+                lines.append(f"packed_{index} = pack_interned_string({name})")
+            elif kind == UINT32_LIST:
+                lines.append(f"packed_{index} = pack_uint32_list({name})")
+
+    def _compile_encoder(self) -> Callable[..., bytes]:
+        """Generate the encoder for this schema.
+
+        The generated function takes the field values (in schema order) and
+        returns the full packet, header included. For example, USER_PRESENCE
+        compiles to roughly:
+
+            def encode(account_id, username, utc_offset, ...):
+                encoded_1 = username.encode()
+                length_1 = len(encoded_1)
+                header_1 = (SHORT_STRING_HEADERS[length_1] if length_1 < 128
+                            else pack_string_header(length_1))
+                return b"".join((
+                    head.pack(83, 19 + len(header_1) + length_1, account_id),
+                    header_1, encoded_1,
+                    run_2.pack(utc_offset, country_code, ...),
+                ))
+        """
+        lines: list[str] = []
+        self._compile_variable_fields(lines)
+
+        parts: list[str] = []
+        sizes: list[str] = [str(self._fixed_size)]
+        for kind, index, args in self._steps:
+            if kind == "run":
+                parts.append(f"run_{index}.pack({', '.join(args)})")
+            elif kind == STRING:
+                parts += [f"header_{index}", f"encoded_{index}"]
+                sizes += [f"len(header_{index})", f"length_{index}"]
+            elif kind == RAW:
+                parts.append(args[0])
+                sizes.append(f"len({args[0]})")
+            else:  # INTERNED_STRING, UINT32_LIST
+                parts.append(f"packed_{index}")
+                sizes.append(f"len(packed_{index})")
+
+        head_args = [str(self.packet_id), " + ".join(sizes)] + self._head_args
+        head = f"head.pack({', '.join(head_args)})"
+
+        if not parts:
+            # fixed-size packet; a single pack call does everything
+            lines.append(f"return {head}")
+        else:
+            lines.append(f"return b''.join(({head}, {', '.join(parts)}))")
+
+        return self._compile(f"encode({', '.join(self.field_names)})", lines)
+
+    def _compile_writer(self) -> Callable[..., None]:
+        """Generate a function appending this packet to a PacketWriter's
+        buffer field by field, without building the packet separately.
+
+        All variable-width fields are encoded first, so the header is written
+        with its final length up front rather than being patched afterwards.
+        """
+        lines: list[str] = []
+        self._compile_variable_fields(lines)
+
+        sizes: list[str] = [str(self._fixed_size)]
+        appends: list[str] = []
+        for kind, index, args in self._steps:
+            if kind == "run":
+                appends.append(f"run_{index}.pack({', '.join(args)})")
+            elif kind == STRING:
+                sizes += [f"len(header_{index})", f"length_{index}"]
+                appends += [f"header_{index}", f"encoded_{index}"]
+            elif kind == RAW:
+                sizes.append(f"len({args[0]})")
+                appends.append(args[0])
+            else:  # INTERNED_STRING, UINT32_LIST
+                sizes.append(f"len(packed_{index})")
+                appends.append(f"packed_{index}")
+
+        head_args = [str(self.packet_id), " + ".join(sizes)] + self._head_args
+        lines += [
+            "buffer = writer.buffer",
+            f"buffer += head.pack({', '.join(head_args)})",
+        ]
+        lines += [f"buffer += {data}" for data in appends]
+
+        return self._compile(
+            f"write_into({', '.join(('writer',) + self.field_names)})", lines)
+
+    def encode_many(self, columns: Mapping[str, Sequence[Any]]) -> bytes:
+        """Encode one packet per row of the given columns (one sequence or
+        array per field), returning the packets concatenated.
+
+        The fixed-width fields are packed column-wise through numpy
+        structured arrays and scattered into the output alongside the
+        variable-width fields; the result is identical to concatenating
+        encode() for each row.
+        """
+        count = len(columns[self.field_names[0]])
+        if count == 0:
+            return b""
+
+        # encode the variable-width fields of every row up front, as one or
+        # more (data, per-row lengths) pieces laid out back to back
+        variable_fields: dict[int, list[tuple[bytes, numpy.ndarray]]] = {}
+        sizes = numpy.full(count, self._fixed_size, dtype=numpy.int64)
+        for kind, index, (name, *_) in self._steps:
+            if kind == "run":
+                continue
+
+            if kind in (STRING, INTERNED_STRING):
+                pieces = _pack_string_column(columns[name])
+            else:
+                if kind == RAW:
+                    encoded = [bytes(value) for value in columns[name]]
+                else:  # UINT32_LIST
+                    encoded = [pack_uint32_list(value)
+                               for value in columns[name]]
+
+                lengths = numpy.fromiter(map(len, encoded), dtype=numpy.int64,
+                                         count=count)
+                pieces = [(b"".join(encoded), lengths)]
+
+            variable_fields[index] = pieces
+            for _, lengths in pieces:
+                sizes += lengths
+
+        packet_sizes = sizes + PACKET_HEADER.size
+        packet_starts = numpy.zeros(count, dtype=numpy.int64)
+        numpy.cumsum(packet_sizes[:-1], out=packet_starts[1:])
+
+        output = numpy.empty(int(packet_sizes.sum()), dtype=numpy.uint8)
+
+        def scatter_fixed(dtype: numpy.dtype, values: dict[str, Any],
+                          offsets: numpy.ndarray) -> None:
+            rows = numpy.empty(count, dtype=dtype)
+            for name in dtype.names:
+                rows[name] = values[name]
+
+            row_bytes = rows.view(numpy.uint8).reshape(count, dtype.itemsize)
+            output[offsets[:, None] + numpy.arange(dtype.itemsize)] = row_bytes
+
+        head_values = {"_packet_id": self.packet_id, "_reserved": 0,
+                       "_length": sizes}
+        for name in self._head_args:
+            head_values[name] = columns[name]
+
+        scatter_fixed(self._head_dtype, head_values, packet_starts)
+        offsets = packet_starts + self._head_dtype.itemsize
+
+        for kind, index, args in self._steps:
+            if kind == "run":
+                run_dtype = self._run_dtypes[index]
+                scatter_fixed(run_dtype, columns, offsets)
+                offsets = offsets + run_dtype.itemsize
+            else:
+                for blob, lengths in variable_fields[index]:
+                    blob_starts = numpy.cumsum(lengths) - lengths
+                    positions = (numpy.repeat(offsets - blob_starts, lengths)
+                                 + numpy.arange(len(blob)))
+                    output[positions] = numpy.frombuffer(blob,
+                                                         dtype=numpy.uint8)
+                    offsets = offsets + lengths
+
+        return output.tobytes()
+
+
+PACKET_SCHEMAS = {
+    ServerPackets.ACCOUNT_ID: PacketSchema(ServerPackets.ACCOUNT_ID, (
+        ("account_id", INT32),
+    )),
+    ServerPackets.SEND_MESSAGE: PacketSchema(ServerPackets.SEND_MESSAGE, (
+        ("sender", INTERNED_STRING),
+        ("message", STRING),
+        ("recipient", INTERNED_STRING),
+        ("sender_id", INT32),
+    )),
+    ServerPackets.PONG: PacketSchema(ServerPackets.PONG),
+    ServerPackets.PROTOCOL_VERSION: PacketSchema(ServerPackets.PROTOCOL_VERSION, (
+        ("version", INT32),
+    )),
+    ServerPackets.PRIVILEGES: PacketSchema(ServerPackets.PRIVILEGES, (
+        ("privileges", INT32),
+    )),
+    ServerPackets.CHANNEL_JOIN_SUCCESS: PacketSchema(ServerPackets.CHANNEL_JOIN_SUCCESS, (
+        ("channel", INTERNED_STRING),
+    )),
+    ServerPackets.CHANNEL_KICK: PacketSchema(ServerPackets.CHANNEL_KICK, (
+        ("channel", INTERNED_STRING),
+    )),
+    ServerPackets.CHANNEL_INFO: PacketSchema(ServerPackets.CHANNEL_INFO, (
+        ("channel", INTERNED_STRING),
+        ("topic", INTERNED_STRING),
+        ("user_count", UINT16),
+    )),
+    ServerPackets.CHANNEL_AUTO_JOIN: PacketSchema(ServerPackets.CHANNEL_AUTO_JOIN, (
+        ("channel", INTERNED_STRING),
+        ("topic", INTERNED_STRING),
+        ("user_count", UINT16),
+    )),
+    ServerPackets.CHANNEL_INFO_END: PacketSchema(ServerPackets.CHANNEL_INFO_END),
+    ServerPackets.MAIN_MENU_ICON: PacketSchema(ServerPackets.MAIN_MENU_ICON, (
+        ("icon", STRING),  # "{icon_url}|{onclick_url}"
+    )),
+    ServerPackets.FRIENDS_LIST: PacketSchema(ServerPackets.FRIENDS_LIST, (
+        ("friends", UINT32_LIST),
+    )),
+    ServerPackets.USER_PRESENCE_BUNDLE: PacketSchema(ServerPackets.USER_PRESENCE_BUNDLE, (
+        ("user_ids", UINT32_LIST),
+    )),
+    ServerPackets.SILENCE_END: PacketSchema(ServerPackets.SILENCE_END, (
+        ("remaining_sec", INT32),
+    )),
+    ServerPackets.SPECTATOR_JOINED: PacketSchema(ServerPackets.SPECTATOR_JOINED, (
+        ("user_id", INT32),
+    )),
+    ServerPackets.SPECTATOR_LEFT: PacketSchema(ServerPackets.SPECTATOR_LEFT, (
+        ("user_id", INT32),
+    )),
+    ServerPackets.SPECTATE_FRAMES: PacketSchema(ServerPackets.SPECTATE_FRAMES, (
+        ("frame_bundle", RAW),
+    )),
+    ServerPackets.SPECTATOR_CANT_SPECTATE: PacketSchema(ServerPackets.SPECTATOR_CANT_SPECTATE, (
+        ("user_id", INT32),
+    )),
+    ServerPackets.FELLOW_SPECTATOR_JOINED: PacketSchema(ServerPackets.FELLOW_SPECTATOR_JOINED, (
+        ("user_id", INT32),
+    )),
+    ServerPackets.FELLOW_SPECTATOR_LEFT: PacketSchema(ServerPackets.FELLOW_SPECTATOR_LEFT, (
+        ("user_id", INT32),
+    )),
+    ServerPackets.USER_LOGOUT: PacketSchema(ServerPackets.USER_LOGOUT, (
+        ("user_id", INT32),
+        ("reserved", UINT8),
+    )),
+    ServerPackets.USER_STATS: PacketSchema(ServerPackets.USER_STATS, (
+        ("account_id", INT32),
+        ("action", UINT8),
+        ("info_text", INTERNED_STRING),
+        ("map_md5", INTERNED_STRING),
+        ("mods", INT32),
+        ("mode", UINT8),
+        ("map_id", INT32),
+        ("ranked_score", INT64),
+        ("accuracy", FLOAT32),  # 0.0-1.0
+        ("play_count", INT32),
+        ("total_score", INT64),
+        ("global_rank", INT32),
+        ("pp", INT16),
+    )),
+    ServerPackets.USER_PRESENCE: PacketSchema(ServerPackets.USER_PRESENCE, (
+        ("account_id", INT32),
+        ("username", INTERNED_STRING),
+        ("utc_offset", UINT8),  # offset + 24
+        ("country_code", UINT8),
+        ("bancho_privileges", UINT8),  # privileges | (mode << 5)
+        ("latitude", FLOAT32),
+        ("longitude", FLOAT32),
+        ("global_rank", INT32),
+    )),
+    ServerPackets.RESTART: PacketSchema(ServerPackets.RESTART, (
+        ("ms", INT32),
+    )),
+    ServerPackets.NOTIFICATION: PacketSchema(ServerPackets.NOTIFICATION, (
+        ("message", STRING),
+    )),
+}
 
 
 # osu! packets
 
 def write_account_id_packet(id: int) -> bytes:
-    data = pack_int32(id)
-    return write_packet(ServerPackets.ACCOUNT_ID, data)
+    return PACKET_SCHEMAS[ServerPackets.ACCOUNT_ID].encode(id)
 
 
 def write_send_message_packet(sender: str, message: str, recipient: str,
                               sender_id: int) -> bytes:
-    data = pack_string(sender) + pack_string(message) + \
-        pack_string(recipient) + pack_int32(sender_id)
-    return write_packet(ServerPackets.SEND_MESSAGE, data)
+    return PACKET_SCHEMAS[ServerPackets.SEND_MESSAGE].encode(
+        sender, message, recipient, sender_id)
+
+
+# SEND_MESSAGE, for senders whose name was encoded ahead of time
+SEND_MESSAGE_ENCODED_SENDER_SCHEMA = PacketSchema(ServerPackets.SEND_MESSAGE, (
+    ("encoded_sender", RAW),
+    ("message", STRING),
+    ("recipient", INTERNED_STRING),
+    ("sender_id", INT32),
+))
+
+
+def write_send_message_packet_encoded(encoded_sender: bytes, message: str,
+                                      recipient: str, sender_id: int) -> bytes:
+    """As write_send_message_packet, with the sender already packed by
+    pack_string."""
+    return SEND_MESSAGE_ENCODED_SENDER_SCHEMA.encode(
+        encoded_sender, message, recipient, sender_id)
 
 
 def write_pong_packet() -> bytes:
-    return write_packet(ServerPackets.PONG)
+    return PACKET_SCHEMAS[ServerPackets.PONG].encode()
 
 
 def write_protocol_version_packet(version: int) -> bytes:
-    data = pack_int32(version)
-    return write_packet(ServerPackets.PROTOCOL_VERSION, data)
+    return PACKET_SCHEMAS[ServerPackets.PROTOCOL_VERSION].encode(version)
 
 
 def write_privileges_packet(privileges: int) -> bytes:
-    data = pack_int32(privileges)
-    return write_packet(ServerPackets.PRIVILEGES, data)
+    return PACKET_SCHEMAS[ServerPackets.PRIVILEGES].encode(privileges)
 
 
 def write_channel_join_success_packet(channel: str) -> bytes:
-    data = pack_string(channel)
-    return write_packet(ServerPackets.CHANNEL_JOIN_SUCCESS, data)
+    return PACKET_SCHEMAS[ServerPackets.CHANNEL_JOIN_SUCCESS].encode(channel)
 
 
 def write_channel_kick_packet(channel: str) -> bytes:
-    data = pack_string(channel)
-    return write_packet(ServerPackets.CHANNEL_KICK, data)
+    return PACKET_SCHEMAS[ServerPackets.CHANNEL_KICK].encode(channel)
 
 
 def write_channel_info_packet(channel: str, topic: str, user_count: int) -> bytes:
-    data = pack_string(channel) + pack_string(topic) + pack_uint16(user_count)
-    return write_packet(ServerPackets.CHANNEL_INFO, data)
+    return PACKET_SCHEMAS[ServerPackets.CHANNEL_INFO].encode(
+        channel, topic, user_count)
 
 
 def write_channel_auto_join_packet(channel: str, topic: str, user_count: int) -> bytes:
-    data = pack_string(channel) + pack_string(topic) + pack_uint16(user_count)
-    return write_packet(ServerPackets.CHANNEL_AUTO_JOIN, data)
+    return PACKET_SCHEMAS[ServerPackets.CHANNEL_AUTO_JOIN].encode(
+        channel, topic, user_count)
 
 
 def write_channel_info_end_packet() -> bytes:
-    return write_packet(ServerPackets.CHANNEL_INFO_END)
+    return PACKET_SCHEMAS[ServerPackets.CHANNEL_INFO_END].encode()
 
 
 def write_main_menu_icon_packet(icon_url: str, onclick_url: str) -> bytes:
-    data = pack_string(icon_url + "|" + onclick_url)
-    return write_packet(ServerPackets.MAIN_MENU_ICON, data)
+    return PACKET_SCHEMAS[ServerPackets.MAIN_MENU_ICON].encode(
+        icon_url + "|" + onclick_url)
 
 
 def write_friends_list_packet(friends: list[int]) -> bytes:
-    data = pack_uint16(len(friends))
-    for friend in friends:
-        data += pack_uint32(friend)
-    return write_packet(ServerPackets.FRIENDS_LIST, data)
+    return PACKET_SCHEMAS[ServerPackets.FRIENDS_LIST].encode(friends)
+
+
+def write_user_presence_bundle_packet(user_ids: list[int]) -> bytes:
+    return PACKET_SCHEMAS[ServerPackets.USER_PRESENCE_BUNDLE].encode(user_ids)
 
 
 def write_silence_end_packet(remaining_sec: int) -> bytes:
-    data = pack_int32(remaining_sec)
-    return write_packet(ServerPackets.SILENCE_END, data)
+    return PACKET_SCHEMAS[ServerPackets.SILENCE_END].encode(remaining_sec)
 
 
 def write_spectator_joined_packet(user_id: int) -> bytes:
-    data = pack_int32(user_id)
-    return write_packet(ServerPackets.SPECTATOR_JOINED, data)
+    return PACKET_SCHEMAS[ServerPackets.SPECTATOR_JOINED].encode(user_id)
 
 
 def write_spectator_left_packet(user_id: int) -> bytes:
-    data = pack_int32(user_id)
-    return write_packet(ServerPackets.SPECTATOR_LEFT, data)
+    return PACKET_SCHEMAS[ServerPackets.SPECTATOR_LEFT].encode(user_id)
 
 
 def write_spectate_frames_packet(raw_data: bytes) -> bytes:
-    return write_packet(ServerPackets.SPECTATE_FRAMES, raw_data)
+    return PACKET_SCHEMAS[ServerPackets.SPECTATE_FRAMES].encode(raw_data)
 
 
 def write_spectator_cant_spectate_packet(user_id: int) -> bytes:
-    data = pack_int32(user_id)
-    return write_packet(ServerPackets.SPECTATOR_CANT_SPECTATE, data)
+    return PACKET_SCHEMAS[ServerPackets.SPECTATOR_CANT_SPECTATE].encode(user_id)
 
 
 def write_fellow_spectator_joined_packet(user_id: int) -> bytes:
-    data = pack_int32(user_id)
-    return write_packet(ServerPackets.FELLOW_SPECTATOR_JOINED, data)
+    return PACKET_SCHEMAS[ServerPackets.FELLOW_SPECTATOR_JOINED].encode(user_id)
 
 
 def write_fellow_spectator_left_packet(user_id: int) -> bytes:
-    data = pack_int32(user_id)
-    return write_packet(ServerPackets.FELLOW_SPECTATOR_LEFT, data)
+    return PACKET_SCHEMAS[ServerPackets.FELLOW_SPECTATOR_LEFT].encode(user_id)
 
 
 def write_user_logout_packet(user_id: int) -> bytes:
-    data = pack_int32(user_id) + pack_uint8(0)
-    return write_packet(ServerPackets.USER_LOGOUT, data)
+    return PACKET_SCHEMAS[ServerPackets.USER_LOGOUT].encode(user_id, 0)
 
 
 def write_user_stats_packet(account_id: int,
@@ -416,21 +970,10 @@ def write_user_stats_packet(account_id: int,
                             total_score: int,
                             global_rank: int,
                             pp: int) -> bytes:
-    data = (
-        pack_int32(account_id)
-        + pack_uint8(action)
-        + pack_string(info_text)
-        + pack_string(map_md5)
-        + pack_int32(mods)
-        + pack_uint8(mode)
-        + pack_int32(map_id)
-        + pack_int64(ranked_score)
-        + pack_float32(accuracy / 100.0)
-        + pack_int32(play_count)
-        + pack_int64(total_score)
-        + pack_int32(global_rank)
-        + pack_int16(pp))
-    return write_packet(ServerPackets.USER_STATS, data)
+    return PACKET_SCHEMAS[ServerPackets.USER_STATS].encode(
+        account_id, action, info_text, map_md5, mods, mode, map_id,
+        ranked_score, accuracy / 100.0, play_count, total_score,
+        global_rank, pp)
 
 
 def write_user_presence_packet(account_id: int,
@@ -442,23 +985,344 @@ def write_user_presence_packet(account_id: int,
                                latitude: float,
                                longitude: float,
                                global_rank: int) -> bytes:
-    data = (
-        pack_int32(account_id)
-        + pack_string(username)
-        + pack_uint8(utc_offset + 24)
-        + pack_uint8(country_code)
-        + pack_uint8(bancho_privileges | (mode << 5))
-        + pack_float32(latitude)
-        + pack_float32(longitude)
-        + pack_int32(global_rank))
-    return write_packet(ServerPackets.USER_PRESENCE, data)
+    return PACKET_SCHEMAS[ServerPackets.USER_PRESENCE].encode(
+        account_id, username, utc_offset + 24, country_code,
+        bancho_privileges | (mode << 5), latitude, longitude, global_rank)
 
 
 def write_server_restart_packet(ms: int) -> bytes:
-    data = pack_int32(ms)
-    return write_packet(ServerPackets.RESTART, data)
+    return PACKET_SCHEMAS[ServerPackets.RESTART].encode(ms)
 
 
 def write_notification_packet(message: str) -> bytes:
-    data = pack_string(message)
-    return write_packet(ServerPackets.NOTIFICATION, data)
+    return PACKET_SCHEMAS[ServerPackets.NOTIFICATION].encode(message)
+
+
+# pre-encoded packets whose contents never change
+
+PONG_PACKET = write_pong_packet()
+CHANNEL_INFO_END_PACKET = write_channel_info_end_packet()
+LOGIN_FAILED_PACKET = write_account_id_packet(-1)
+
+ALREADY_LOGGED_IN_PACKETS = (
+    write_notification_packet("Your account is already logged in.")
+    + LOGIN_FAILED_PACKET
+)
+SERVICE_RESTARTED_PACKETS = (
+    write_notification_packet("Service has restarted")
+    + write_server_restart_packet(ms=0)
+)
+
+
+# bulk encoding (one packet per row of each column)
+
+def write_user_stats_packets(account_id: Sequence[int],
+                             action: Sequence[int],
+                             info_text: Sequence[str],
+                             map_md5: Sequence[str],
+                             mods: Sequence[int],
+                             mode: Sequence[int],
+                             map_id: Sequence[int],
+                             ranked_score: Sequence[int],
+                             accuracy: Sequence[float],
+                             play_count: Sequence[int],
+                             total_score: Sequence[int],
+                             global_rank: Sequence[int],
+                             pp: Sequence[int]) -> bytes:
+    return PACKET_SCHEMAS[ServerPackets.USER_STATS].encode_many({
+        "account_id": account_id,
+        "action": action,
+        "info_text": info_text,
+        "map_md5": map_md5,
+        "mods": mods,
+        "mode": mode,
+        "map_id": map_id,
+        "ranked_score": ranked_score,
+        "accuracy": numpy.asarray(accuracy, dtype=numpy.float64) / 100.0,
+        "play_count": play_count,
+        "total_score": total_score,
+        "global_rank": global_rank,
+        "pp": pp,
+    })
+
+
+def write_user_presence_packets(account_id: Sequence[int],
+                                username: Sequence[str],
+                                utc_offset: Sequence[int],
+                                country_code: Sequence[int],
+                                bancho_privileges: Sequence[int],
+                                mode: Sequence[int],
+                                latitude: Sequence[float],
+                                longitude: Sequence[float],
+                                global_rank: Sequence[int]) -> bytes:
+    return PACKET_SCHEMAS[ServerPackets.USER_PRESENCE].encode_many({
+        "account_id": account_id,
+        "username": username,
+        "utc_offset": numpy.asarray(utc_offset, dtype=numpy.int64) + 24,
+        "country_code": country_code,
+        "bancho_privileges": (numpy.asarray(bancho_privileges, dtype=numpy.int64)
+                              | (numpy.asarray(mode, dtype=numpy.int64) << 5)),
+        "latitude": latitude,
+        "longitude": longitude,
+        "global_rank": global_rank,
+    })
+
+
+# writing many packets into a single buffer
+
+class PacketWriter:
+    """Encodes many packets into a single growing buffer.
+
+    A packet's header and each run of fixed-width fields are packed into a
+    small bytes object, which is appended to the buffer straight away; the
+    packet as a whole is never built as a separate bytes object. The
+    finished response is then either viewed in place with getbuffer(), or
+    copied out once with getvalue().
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+
+    def getbuffer(self) -> memoryview:
+        """A view of the written data; the writer must not be written to
+        while the view is alive."""
+        return memoryview(self.buffer)
+
+    def getvalue(self) -> bytes:
+        return bytes(self.buffer)
+
+    # osu! packets
+
+    def write_raw(self, data: bytes) -> None:
+        """Write already encoded packet(s)."""
+        self.write(data)
+
+    def write_account_id(self, id: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.ACCOUNT_ID].write_into(self, id)
+
+    def write_send_message(self, sender: str, message: str, recipient: str,
+                           sender_id: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.SEND_MESSAGE].write_into(
+            self, sender, message, recipient, sender_id)
+
+    def write_pong(self) -> None:
+        self.write(PONG_PACKET)
+
+    def write_protocol_version(self, version: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.PROTOCOL_VERSION].write_into(
+            self, version)
+
+    def write_privileges(self, privileges: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.PRIVILEGES].write_into(self, privileges)
+
+    def write_channel_join_success(self, channel: str) -> None:
+        PACKET_SCHEMAS[ServerPackets.CHANNEL_JOIN_SUCCESS].write_into(
+            self, channel)
+
+    def write_channel_kick(self, channel: str) -> None:
+        PACKET_SCHEMAS[ServerPackets.CHANNEL_KICK].write_into(self, channel)
+
+    def write_channel_info(self, channel: str, topic: str,
+                           user_count: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.CHANNEL_INFO].write_into(
+            self, channel, topic, user_count)
+
+    def write_channel_auto_join(self, channel: str, topic: str,
+                                user_count: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.CHANNEL_AUTO_JOIN].write_into(
+            self, channel, topic, user_count)
+
+    def write_channel_info_end(self) -> None:
+        self.write(CHANNEL_INFO_END_PACKET)
+
+    def write_main_menu_icon(self, icon_url: str, onclick_url: str) -> None:
+        PACKET_SCHEMAS[ServerPackets.MAIN_MENU_ICON].write_into(
+            self, icon_url + "|" + onclick_url)
+
+    def write_friends_list(self, friends: list[int]) -> None:
+        PACKET_SCHEMAS[ServerPackets.FRIENDS_LIST].write_into(self, friends)
+
+    def write_user_presence_bundle(self, user_ids: list[int]) -> None:
+        PACKET_SCHEMAS[ServerPackets.USER_PRESENCE_BUNDLE].write_into(
+            self, user_ids)
+
+    def write_silence_end(self, remaining_sec: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.SILENCE_END].write_into(
+            self, remaining_sec)
+
+    def write_spectator_joined(self, user_id: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.SPECTATOR_JOINED].write_into(
+            self, user_id)
+
+    def write_spectator_left(self, user_id: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.SPECTATOR_LEFT].write_into(self, user_id)
+
+    def write_spectate_frames(self, raw_data: bytes) -> None:
+        PACKET_SCHEMAS[ServerPackets.SPECTATE_FRAMES].write_into(
+            self, raw_data)
+
+    def write_spectator_cant_spectate(self, user_id: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.SPECTATOR_CANT_SPECTATE].write_into(
+            self, user_id)
+
+    def write_fellow_spectator_joined(self, user_id: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.FELLOW_SPECTATOR_JOINED].write_into(
+            self, user_id)
+
+    def write_fellow_spectator_left(self, user_id: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.FELLOW_SPECTATOR_LEFT].write_into(
+            self, user_id)
+
+    def write_user_logout(self, user_id: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.USER_LOGOUT].write_into(self, user_id, 0)
+
+    def write_user_stats(self,
+                         account_id: int,
+                         action: int,
+                         info_text: str,
+                         map_md5: str,
+                         mods: int,
+                         mode: int,
+                         map_id: int,
+                         ranked_score: int,
+                         accuracy: float,
+                         play_count: int,
+                         total_score: int,
+                         global_rank: int,
+                         pp: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.USER_STATS].write_into(
+            self, account_id, action, info_text, map_md5, mods, mode, map_id,
+            ranked_score, accuracy / 100.0, play_count, total_score,
+            global_rank, pp)
+
+    def write_user_presence(self,
+                            account_id: int,
+                            username: str,
+                            utc_offset: int,
+                            country_code: int,
+                            bancho_privileges: int,
+                            mode: int,
+                            latitude: float,
+                            longitude: float,
+                            global_rank: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.USER_PRESENCE].write_into(
+            self, account_id, username, utc_offset + 24, country_code,
+            bancho_privileges | (mode << 5), latitude, longitude, global_rank)
+
+    def write_server_restart(self, ms: int) -> None:
+        PACKET_SCHEMAS[ServerPackets.RESTART].write_into(self, ms)
+
+    def write_notification(self, message: str) -> None:
+        PACKET_SCHEMAS[ServerPackets.NOTIFICATION].write_into(self, message)
+
+
+# framing packets from a stream of chunks
+
+class RequestTooLargeError(ValueError):
+    """Raised when a request body exceeds the framer's size limit."""
+
+
+class PacketFramer:
+    """Splits an incoming stream of chunks into complete packets.
+
+    Packets are framed as soon as their last byte arrives; only the
+    incomplete tail of the stream (which may be a partial header) is kept
+    buffered between chunks.
+    """
+
+    def __init__(self, max_size: int | None = None) -> None:
+        self.max_size = max_size
+        self.bytes_received = 0
+        self.buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> list[tuple[int, bytes]]:
+        """Add a chunk of the stream, returning (packet id, packet data)
+        for each packet it completes."""
+        self.bytes_received += len(chunk)
+        if self.max_size is not None and self.bytes_received > self.max_size:
+            raise RequestTooLargeError(
+                f"Request exceeded the {self.max_size} byte limit")
+
+        if self.buffer:
+            self.buffer += chunk
+            data = memoryview(self.buffer)
+        else:
+            # nothing buffered; frame directly from the chunk
+            data = memoryview(chunk)
+
+        packets: list[tuple[int, bytes]] = []
+        with data:
+            offset = 0
+            end = len(data)
+            while end - offset >= PACKET_HEADER.size:
+                packet_id, length = PACKET_HEADER.unpack_from(data, offset)
+
+                data_start = offset + PACKET_HEADER.size
+                data_end = data_start + length
+                if data_end > end:
+                    break
+
+                packets.append(
+                    (packet_id, data[data_start:data_end].tobytes()))
+                offset = data_end
+
+            if not self.buffer and offset != end:
+                self.buffer += data[offset:]
+                offset = 0
+
+        # (the view has to be released before the buffer can be resized)
+        del self.buffer[:offset]
+        return packets
+
+    def close(self) -> None:
+        """Signal the end of the stream."""
+        if self.buffer:
+            raise TruncatedPacketError(
+                f"Stream ended with {len(self.buffer)} bytes of an "
+                "incomplete packet")
+
+
+# a binary packet queue dequeue returns each entry prefixed by its length
+QUEUED_PACKET_HEADER = struct.Struct("<I")
+
+
+def pack_queued_packets(entries: Iterable[bytes]) -> bytes:
+    """Frame packet queue entries, as sent in a binary dequeue response."""
+    buffer = bytearray()
+    for entry in entries:
+        buffer += QUEUED_PACKET_HEADER.pack(len(entry))
+        buffer += entry
+    return bytes(buffer)
+
+
+def unpack_queued_packets(data: bytes) -> bytes:
+    """Join the entries of a binary dequeue response back together.
+
+    The entries are already framed bancho packets, so the client only
+    needs their concatenation.
+    """
+    buffer = bytearray()
+    with memoryview(data) as view:
+        offset = 0
+        end = len(view)
+        while offset != end:
+            if end - offset < QUEUED_PACKET_HEADER.size:
+                raise TruncatedPacketError(
+                    "Truncated packet queue entry header")
+
+            (length,) = QUEUED_PACKET_HEADER.unpack_from(view, offset)
+            offset += QUEUED_PACKET_HEADER.size
+
+            if end - offset < length:
+                raise TruncatedPacketError("Truncated packet queue entry")
+
+            buffer += view[offset:offset + length]
+            offset += length
+
+    return bytes(buffer)
@@ -14,3 +14,81 @@ APP_PORT = int(os.environ["APP_PORT"])
 LOG_LEVEL = int(os.environ["LOG_LEVEL"])
 
 DEFAULT_PAGE_SIZE = int(os.environ["DEFAULT_PAGE_SIZE"])
+
+# how often a summary of packet handler metrics is logged, in seconds;
+# 0 disables it
+METRICS_EXPORT_INTERVAL = int(os.environ["METRICS_EXPORT_INTERVAL"])
+
+# bancho
+# the largest request body /v1/bancho accepts, in bytes
+BANCHO_MAX_REQUEST_SIZE = int(os.environ["BANCHO_MAX_REQUEST_SIZE"])
+# how long /v1/bancho may wait for queued data, in seconds; 0 disables
+# long-polling
+BANCHO_LONG_POLL_TIMEOUT = float(os.environ["BANCHO_LONG_POLL_TIMEOUT"])
+# how other players are sent at login; as presence & stats packets (full),
+# or as a bundle of account ids whose presences the client requests when it
+# needs them (bundle)
+LOGIN_PRESENCES = os.environ["LOGIN_PRESENCES"]
+
+# upstream services
+UPSTREAM_CONCURRENCY_LIMIT = int(os.environ["UPSTREAM_CONCURRENCY_LIMIT"])
+USERS_SERVICE_URL = os.environ["USERS_SERVICE_URL"]
+
+# packet queues
+# json | binary
+PACKET_QUEUE_TRANSPORT = os.environ["PACKET_QUEUE_TRANSPORT"]
+
+# sessions
+# refresh a session's expiry upstream once it has less than this many
+# seconds left
+SESSION_REFRESH_THRESHOLD = int(os.environ["SESSION_REFRESH_THRESHOLD"])
+
+# presence & stats cache; TTLs in seconds, sizes in entries
+PRESENCE_CACHE_TTL = int(os.environ["PRESENCE_CACHE_TTL"])
+STATS_CACHE_TTL = int(os.environ["STATS_CACHE_TTL"])
+ACCOUNT_CACHE_TTL = int(os.environ["ACCOUNT_CACHE_TTL"])
+USERS_CACHE_MAX_SIZE = int(os.environ["USERS_CACHE_MAX_SIZE"])
+
+# broadcast dispatcher
+BROADCAST_WORKERS = int(os.environ["BROADCAST_WORKERS"])
+# jobs, per worker
+BROADCAST_QUEUE_SIZE = int(os.environ["BROADCAST_QUEUE_SIZE"])
+BROADCAST_MAX_ATTEMPTS = int(os.environ["BROADCAST_MAX_ATTEMPTS"])
+# seconds
+BROADCAST_RETRY_DELAY = float(os.environ["BROADCAST_RETRY_DELAY"])
+
+# spectators
+# how long a host's cached spectators are trusted, in seconds
+SPECTATOR_CACHE_TTL = int(os.environ["SPECTATOR_CACHE_TTL"])
+# recent frame bundles kept per host, within a budget in bytes for all hosts
+SPECTATOR_FRAME_BUFFER_SIZE = int(os.environ["SPECTATOR_FRAME_BUFFER_SIZE"])
+SPECTATOR_FRAME_BUFFER_BUDGET = int(
+    os.environ["SPECTATOR_FRAME_BUFFER_BUDGET"])
+
+# per-session outbound packets
+# how often held packets are sent upstream, in seconds
+OUTBOX_FLUSH_INTERVAL = float(os.environ["OUTBOX_FLUSH_INTERVAL"])
+# failed sends in a row before a session's droppable packets are dropped
+OUTBOX_MAX_FLUSH_ATTEMPTS = int(os.environ["OUTBOX_MAX_FLUSH_ATTEMPTS"])
+SESSION_QUEUE_MAX_BYTES = int(os.environ["SESSION_QUEUE_MAX_BYTES"])
+SESSION_QUEUE_MAX_PACKETS = int(os.environ["SESSION_QUEUE_MAX_PACKETS"])
+# how long packets sent upstream are assumed to stay queued, in seconds
+SESSION_QUEUE_BACKLOG_TTL = int(os.environ["SESSION_QUEUE_BACKLOG_TTL"])
+
+# per-session packet rate limits, as packets per second & burst size
+PUBLIC_MESSAGE_RATE_LIMIT = float(os.environ["PUBLIC_MESSAGE_RATE_LIMIT"])
+PUBLIC_MESSAGE_RATE_BURST = int(os.environ["PUBLIC_MESSAGE_RATE_BURST"])
+CHANGE_ACTION_RATE_LIMIT = float(os.environ["CHANGE_ACTION_RATE_LIMIT"])
+CHANGE_ACTION_RATE_BURST = int(os.environ["CHANGE_ACTION_RATE_BURST"])
+SPECTATE_FRAMES_RATE_LIMIT = float(os.environ["SPECTATE_FRAMES_RATE_LIMIT"])
+SPECTATE_FRAMES_RATE_BURST = int(os.environ["SPECTATE_FRAMES_RATE_BURST"])
+
+# world snapshot
+# how often the snapshot is rebuilt from the users service, in seconds
+WORLD_SNAPSHOT_RESYNC_INTERVAL = int(
+    os.environ["WORLD_SNAPSHOT_RESYNC_INTERVAL"])
+
+# channel directory
+# how often the directory is resynced from the chats service, in seconds
+CHANNEL_DIRECTORY_SYNC_INTERVAL = int(
+    os.environ["CHANNEL_DIRECTORY_SYNC_INTERVAL"])
@@ -1,48 +1,99 @@
+import asyncio
+import time
+from typing import Any
 from typing import Awaitable
 from typing import Callable
+from typing import NamedTuple
 from uuid import UUID
 
+from app.common import metrics
 from app.common import serial
+from app.common import settings
 from app.common.context import Context
+from app.services import delivery
+from app.services import world
 from shared_modules import logger
 from shared_modules.api.rest.v1.chats import ChatsClient
 from shared_modules.api.rest.v1.users import UsersClient
 from shared_modules.models.sessions import Session
 
-PACKET_HANDLERS = {}
-
 PacketHandler = Callable[[Context, Session, bytes], Awaitable[bytes]]
 
 
-def get_packet_handler(packet_id: int) -> PacketHandler | None:
-    return PACKET_HANDLERS.get(packet_id)
+class RegisteredPacketHandler(NamedTuple):
+    handler: PacketHandler
+    counter_name: str
+    latency: metrics.Histogram
+
+
+# client packet ids are all small, so handlers (and their names & metrics)
+# are kept in lists indexed by packet id
+MAX_PACKET_ID = serial.MAX_CLIENT_PACKET_ID
+
+PACKET_NAMES = [serial.client_packet_id_to_name(packet_id)
+                for packet_id in range(MAX_PACKET_ID)]
+
+PACKET_HANDLERS: list[RegisteredPacketHandler | None] = [None] * MAX_PACKET_ID
+
+
+def get_packet_name(packet_id: int) -> str:
+    if 0 <= packet_id < MAX_PACKET_ID:
+        return PACKET_NAMES[packet_id]
+    return "Unknown"
+
+
+def get_packet_handler(packet_id: int) -> RegisteredPacketHandler | None:
+    if 0 <= packet_id < MAX_PACKET_ID:
+        return PACKET_HANDLERS[packet_id]
+    return None
 
 
 async def handle_packet_event(ctx: Context, session: Session, packet_id: int,
                               packet_data: bytes) -> bytes:
     packet_handler = get_packet_handler(packet_id)
-    packet_name = serial.client_packet_id_to_name(packet_id)
 
     if packet_handler is None:
+        packet_name = get_packet_name(packet_id)
+
         if packet_id != serial.ClientPackets.LOGOUT:
             response_data = serial.write_notification_packet(
                 f"[Unhandled Packet] {packet_name} ({packet_id})")
         else:
             response_data = b""
 
+        metrics.increment(f"packets.unhandled.{packet_name}")
         logger.warning("Unhandled packet", type=packet_name)
         return response_data
 
-    logger.info("Handling packet", type=packet_name,
-                length=len(packet_data))
+    # (drop floods before they cost us any upstream work)
+    if not ctx.rate_limiter.allow(session.session_id, session.account_id,
+                                  packet_id):
+        return b""
+
+    start_time = time.perf_counter()
+
+    try:
+        response_data = await packet_handler.handler(ctx, session,
+                                                     packet_data)
+    except serial.TruncatedPacketError as exc:
+        logger.warning("Received a truncated packet",
+                       type=PACKET_NAMES[packet_id],
+                       session_id=session.session_id, error=str(exc))
+        response_data = b""
+    finally:
+        packet_handler.latency.observe(time.perf_counter() - start_time)
+        metrics.increment(packet_handler.counter_name)
 
-    response_data = await packet_handler(ctx, session, packet_data)
     return response_data
 
 
 def packet_handler(packet_id: int) -> Callable[[PacketHandler], PacketHandler]:
     def decorator(func: PacketHandler) -> PacketHandler:
-        PACKET_HANDLERS[packet_id] = func
+        packet_name = PACKET_NAMES[packet_id]
+        PACKET_HANDLERS[packet_id] = RegisteredPacketHandler(
+            handler=func,
+            counter_name=f"packets.handled.{packet_name}",
+            latency=metrics.histogram(f"packets.latency.{packet_name}"))
         return func
     return decorator
 
@@ -50,9 +101,8 @@ def packet_handler(packet_id: int) -> Callable[[PacketHandler], PacketHandler]:
 @packet_handler(serial.ClientPackets.PING)
 async def handle_ping(ctx: Context, session: Session,  packet_data: bytes
                       ) -> bytes:
-    # NOTE: this makes osu! send it's next request immediately
-    # could be useful for something like a 'low delay mode'?
-    # return serial.write_pong_packet()
+    # NOTE: a pong makes osu! send it's next request immediately;
+    # /v1/bancho appends one itself in low delay (long-poll) mode
 
     return b""
 
@@ -66,45 +116,36 @@ async def handle_logout(ctx: Context, session: Session, packet_data: bytes
     chats_client = ChatsClient(ctx.http_client)
 
     # delete user presence
-    presence = await users_client.delete_presence(session.session_id)
+    presence = await ctx.users_cache.delete_presence(users_client,
+                                                     session.session_id)
     if presence is None:
         return b""
 
+    ctx.world_snapshot.remove_player(session.session_id)
+    ctx.spectator_engine.remove_host(session.session_id)
+
     # delete user session
+    ctx.session_cache.invalidate(session.session_id)
+    ctx.outbox.remove(session.session_id)
+    ctx.rate_limiter.remove(session.session_id)
     deleted_session = await users_client.log_out(session.session_id)
     if deleted_session is None:
         return b""
 
     # remove user from all chats they're in
-    chats = await chats_client.get_chats()
-    if chats is None:
+    chats_left = await ctx.channel_directory.leave_all(
+        chats_client, session.session_id,
+        concurrency_limit=settings.UPSTREAM_CONCURRENCY_LIMIT)
+    if not chats_left:
         return b""
 
-    for chat in chats:
-        chat_left = await chats_client.leave_chat(chat.chat_id,
-                                                  session.session_id)
-        if chat_left is None:
-            return b""
-
     # inform all other players that the user has logged out
     # TODO: should we be fetching the osu-specific sessions here?
     # should sessions be refactored so that we have osu-specific ones?
     data = serial.write_user_logout_packet(session.account_id)
 
-    other_presences = await users_client.get_all_presences()
-    if other_presences is None:
-        return b""
-
-    for other_presence in other_presences:
-        # commented since we're already logged out.
-        # left here because it's logical
-        # if other_presence.session_id == session.session_id:
-        #     continue
-
-        success = await users_client.enqueue_packet(other_presence.session_id,
-                                                    data=list(data))
-        if not success:
-            return b""
+    # (we're already logged out, so we won't be included)
+    ctx.broadcast_dispatcher.submit(data, key=session.session_id)
 
     return b""
 
@@ -114,12 +155,16 @@ async def handle_request_game_mode_stats(ctx: Context, session: Session,
                                          packet_data: bytes) -> bytes:
     users_client = UsersClient(ctx.http_client)
 
-    presence = await users_client.get_presence(session.session_id)
+    presence = await ctx.users_cache.get_presence(users_client,
+                                                  session.session_id)
     if presence is None:
         return b""
 
-    stats = await users_client.get_stats(session.account_id,
-                                         presence.game_mode)
+    # (the client asks after submitting a score; don't send cached stats)
+    ctx.users_cache.invalidate_stats(session.account_id, presence.game_mode)
+
+    stats = await ctx.users_cache.get_stats(users_client, session.account_id,
+                                            presence.game_mode)
     if stats is None:
         return b""
 
@@ -145,38 +190,46 @@ async def handle_request_all_user_stats_request(ctx: Context, session: Session,
                                                 packet_data: bytes) -> bytes:
     users_client = UsersClient(ctx.http_client)
 
-    presences = await users_client.get_all_presences()
+    presences = await ctx.users_cache.get_all_presences(users_client)
     if presences is None:
         return b""
 
-    response_buffer = bytearray()
+    presences = [presence for presence in presences
+                 if presence.session_id != session.session_id]
+
+    # (requested together, so the users cache can batch its misses)
+    all_stats = await asyncio.gather(*(
+        ctx.users_cache.get_stats(users_client, presence.account_id,
+                                  presence.game_mode)
+        for presence in presences))
 
-    for presence in presences:
-        if presence.session_id == session.session_id:
-            continue
+    # (in write_user_stats_packets argument order)
+    stats_rows: list[tuple[Any, ...]] = []
 
-        stats = await users_client.get_stats(presence.account_id,
-                                             presence.game_mode)
+    for presence, stats in zip(presences, all_stats):
         if stats is None:
             return b""
 
-        response_buffer += serial.write_user_stats_packet(
-            account_id=stats.account_id,
-            action=presence.action,
-            info_text=presence.info_text,
-            map_md5=presence.map_md5,
-            mods=presence.mods,
-            mode=presence.game_mode,
-            map_id=presence.map_id,
-            ranked_score=stats.ranked_score,
-            accuracy=stats.accuracy,
-            play_count=stats.play_count,
-            total_score=stats.total_score,
-            global_rank=0,  # TODO
-            pp=stats.performance,
-        )
+        stats_rows.append((
+            stats.account_id,
+            presence.action,
+            presence.info_text,
+            presence.map_md5,
+            presence.mods,
+            presence.game_mode,
+            presence.map_id,
+            stats.ranked_score,
+            stats.accuracy,
+            stats.play_count,
+            stats.total_score,
+            0,  # TODO: global rank
+            stats.performance,
+        ))
 
-    return bytes(response_buffer)
+    if not stats_rows:
+        return b""
+
+    return serial.write_user_stats_packets(*zip(*stats_rows))
 
 
 @packet_handler(serial.ClientPackets.CHANGE_ACTION)
@@ -195,7 +248,8 @@ async def handle_change_action_request(ctx: Context, session: Session,
 
     users_client = UsersClient(ctx.http_client)
 
-    presence = await users_client.partial_update_presence(
+    presence = await ctx.users_cache.partial_update_presence(
+        users_client,
         session.session_id,
         action=action,
         info_text=info_text,
@@ -207,17 +261,17 @@ async def handle_change_action_request(ctx: Context, session: Session,
     if presence is None:
         return b""
 
-    stats = await users_client.get_stats(presence.account_id,
-                                         presence.game_mode)
+    # (e.g. after a score submission; don't broadcast cached stats)
+    ctx.users_cache.invalidate_stats(presence.account_id, presence.game_mode)
+
+    stats = await ctx.users_cache.get_stats(users_client,
+                                            presence.account_id,
+                                            presence.game_mode)
     if stats is None:
         return b""
 
     # broadcast the new presence to all other users
     # TODO: if the user is restricted, should not happen
-    other_presences = await users_client.get_all_presences()
-    if other_presences is None:
-        return b""
-
     data = serial.write_user_stats_packet(account_id=session.account_id,
                                           action=action,
                                           info_text=info_text,
@@ -232,11 +286,17 @@ async def handle_change_action_request(ctx: Context, session: Session,
                                           global_rank=0,  # TODO
                                           pp=stats.performance)
 
-    for other_presence in other_presences:
-        success = await users_client.enqueue_packet(other_presence.session_id,
-                                                    data=list(data))
-        if not success:
-            return b""
+    # (the presence packet includes the game mode, so it may be stale too)
+    ctx.world_snapshot.set_player_stats(
+        session.session_id, data, world.write_user_presence_packet(presence))
+
+    # (we always get our own stats, whatever our presence filter)
+    recipients = ctx.world_snapshot.get_presence_recipients(
+        session.account_id, exclude=session.session_id)
+    if recipients is not None:
+        recipients.append(session.session_id)
+
+    ctx.broadcast_dispatcher.submit(data, recipients, key=session.session_id)
 
     return b""
 
@@ -254,11 +314,69 @@ async def handle_update_presence_filter_request(ctx: Context, session: Session,
                        presence_filter=presence_filter)
         return b""
 
-    # TODO: set this on the user
+    ctx.world_snapshot.set_presence_filter(session.session_id,
+                                           presence_filter)
 
     return b""
 
 
+async def get_presence_packets(ctx: Context, account_ids: list[int]) -> bytes:
+    """The presence packets of some accounts, from the world snapshot where
+    possible. The rest are looked up with one (cached) request for every
+    presence, rather than one request each."""
+    data, missing_account_ids = ctx.world_snapshot.get_presence_packets(
+        account_ids)
+    if not missing_account_ids:
+        return data
+
+    metrics.increment("world.presence_lookups_upstream",
+                      len(missing_account_ids))
+
+    users_client = UsersClient(ctx.http_client)
+
+    presences = await ctx.users_cache.get_all_presences(users_client)
+    if presences is None:
+        return data
+
+    missing_account_ids = set(missing_account_ids)
+    return data + b"".join([
+        world.write_user_presence_packet(presence)
+        for presence in presences
+        if (presence.account_id in missing_account_ids
+            and not world.is_restricted(presence.privileges))
+    ])
+
+
+@packet_handler(serial.ClientPackets.USER_PRESENCE_REQUEST)
+async def handle_user_presence_request(ctx: Context, session: Session,
+                                       packet_data: bytes) -> bytes:
+    with memoryview(packet_data) as raw_data:
+        data_reader = serial.Reader(raw_data)
+        account_ids = data_reader.read_int32_list()
+
+    if not account_ids:
+        return b""
+
+    return await get_presence_packets(ctx, account_ids)
+
+
+@packet_handler(serial.ClientPackets.USER_PRESENCE_REQUEST_ALL)
+async def handle_user_presence_request_all(ctx: Context, session: Session,
+                                           packet_data: bytes) -> bytes:
+    # (the packet's data is the client's ingame time, which we don't need)
+
+    world_snapshot = ctx.world_snapshot
+    if not world_snapshot.synced:
+        synced = await world_snapshot.resync(
+            UsersClient(ctx.http_client),
+            concurrency_limit=settings.UPSTREAM_CONCURRENCY_LIMIT)
+        if not synced:
+            return b""
+
+    return await get_presence_packets(ctx, world_snapshot.account_ids(
+        exclude_session_id=session.session_id))
+
+
 # these channels are client-only and don't exist on the server
 # (but the osu! client will still send requests for them xd)
 CLIENT_ONLY_CHANNELS = ("#hightlight", "#userlog")
@@ -296,47 +414,35 @@ async def handle_send_public_message_request(ctx: Context, session: Session,
     chats_client = ChatsClient(ctx.http_client)
 
     # TODO: instance channels will need to be handled differently
-    chats = await chats_client.get_chats(name=recipient_name)
-    if chats is None:
-        return b""
-
-    if not chats:
+    channel = await ctx.channel_directory.get_channel(chats_client,
+                                                      recipient_name)
+    if channel is None:
         logger.warning("User sent a message to a non-existent chat",
                        session_id=session.session_id,
                        recipient_name=recipient_name)
         return b""
 
-    chat = chats[0]
-
-    chat_members = await chats_client.get_members(chat.chat_id)
-    if chat_members is None:
-        return b""
-
     # make sure sender is actually in the chats members
-    if not any(member.account_id == session.account_id
-               for member in chat_members):
+    if not channel.has_account(session.account_id):
         logger.warning("User sent a message to a chat they are not in",
                        session_id=session.session_id,
-                       chat_id=chat.chat_id, chat_name=chat.name)
+                       chat_id=channel.chat_id, chat_name=channel.name)
         return b""
 
-    account = await users_client.get_account(session.account_id)
+    account = await ctx.users_cache.get_account(users_client,
+                                                session.account_id)
     if account is None:
         return b""
 
-    data = serial.write_send_message_packet(sender=account.username,
-                                            message=message,
-                                            recipient=recipient_name,
-                                            sender_id=account.account_id)
-
-    for chat_member in chat_members:
-        if chat_member.session_id == session.session_id:
-            continue
+    data = serial.write_send_message_packet_encoded(
+        encoded_sender=account.encoded_username,
+        message=message,
+        recipient=recipient_name,
+        sender_id=account.account_id)
 
-        success = await users_client.enqueue_packet(chat_member.session_id,
-                                                    data=list(data))
-        if not success:
-            return b""
+    ctx.broadcast_dispatcher.submit(data, channel.members,
+                                    exclude=session.session_id,
+                                    key=session.session_id)
 
     return b""
 
@@ -351,56 +457,33 @@ async def handle_channel_part_request(ctx: Context, session: Session,
     if channel_name in CLIENT_ONLY_CHANNELS:
         return b""
 
-    users_client = UsersClient(ctx.http_client)
     chats_client = ChatsClient(ctx.http_client)
 
-    chats = await chats_client.get_chats(name=channel_name)
-    if chats is None:
-        return b""
-
-    if len(chats) != 1:
+    channel = await ctx.channel_directory.get_channel(chats_client,
+                                                      channel_name)
+    if channel is None:
         # logger.error("Failed to get chat",
         #               channel_name=channel_name,
         #               session_id=session.session_id)
         return b""
 
-    chat = chats[0]
-
     # check if user is already in channel
-    members = await chats_client.get_members(chat.chat_id)
-    if members is None:
-        return b""
-
-    for member in members:
-        if member.account_id == session.account_id:
-            break
-    else:
+    if not channel.has_account(session.account_id):
         logger.error("User attempted to leave channel they're not in",
                      channel_name=channel_name,
                      session_id=session.session_id)
         return b""
 
-    chat_left = await chats_client.leave_chat(chat.chat_id,
-                                              session.session_id)
+    chat_left = await ctx.channel_directory.leave(chats_client, channel,
+                                                  session.session_id)
     if chat_left is None:
         return b""
 
     # send updated channel info (player count) to everyone that can see it
-    updated_channel_info = serial.write_channel_info_packet(channel=chat.name,
-                                                            topic=chat.topic,
-                                                            user_count=len(members) - 1)
+    updated_channel_info = channel.write_channel_info_packet()
 
-    presences = await users_client.get_all_presences()
-    if presences is None:
-        return b""
-
-    for presence in presences:
-        # TODO: only if they have read privs
-
-        success = await users_client.enqueue_packet(presence.session_id,
-                                                    list(updated_channel_info))
-        if not success:
-            return b""
+    # TODO: only if they have read privs
+    ctx.broadcast_dispatcher.submit(updated_channel_info, key=channel.name)
 
     return b""
 
@@ -434,32 +517,38 @@ async def handle_start_spectating_request(ctx: Context, session: Session,
     if spectator is None:
         return b""
 
+    ctx.spectator_engine.add_spectator(target_session.session_id,
+                                       session.session_id,
+                                       session.account_id)
+
     data = serial.write_spectator_joined_packet(session.account_id)
-    success = await users_client.enqueue_packet(target_session.session_id,
-                                                data=list(data))
-    if not success:
-        return b""
+    await delivery.enqueue(ctx, target_session.session_id, data)
 
-    spectators = await users_client.get_spectators(target_session.session_id)
+    spectators = await ctx.spectator_engine.get_spectators(
+        users_client, target_session.session_id)
     if spectators is None:
         return b""
 
     response_buffer = bytearray()
 
-    data = serial.write_fellow_spectator_joined_packet(session.account_id)
-    for spectator in spectators:
-        if spectator == session.session_id:
-            continue
+    spectators = {spectator_session_id: spectator_account_id
+                  for spectator_session_id, spectator_account_id
+                  in spectators.items()
+                  if spectator_session_id != session.session_id}
 
-        # them to us
+    # them to us
+    for spectator_account_id in spectators.values():
         response_buffer += serial.write_fellow_spectator_joined_packet(
-            spectator.account_id)
+            spectator_account_id)
 
-        # us to them
-        success = await users_client.enqueue_packet(spectator.session_id,
-                                                    data=list(data))
-        if not success:
-            return b""
+    # us to them
+    data = serial.write_fellow_spectator_joined_packet(session.account_id)
+    ctx.broadcast_dispatcher.submit(data, spectators,
+                                    key=target_session.session_id)
+
+    # catch us up with the host's most recent frames
+    response_buffer += ctx.spectator_engine.get_buffered_frames(
+        target_session.session_id)
 
     return bytes(response_buffer)
 
@@ -482,55 +571,49 @@ async def handle_stop_spectating_request(ctx: Context, session: Session,
     if spectator is None:
         return b""
 
+    ctx.spectator_engine.remove_spectator(host_session_id, session.session_id)
+
     # tell them we stopped spectating
     data = serial.write_spectator_left_packet(session.account_id)
-    success = await users_client.enqueue_packet(host_session_id,
-                                                data=list(data))
-    if not success:
-        return b""
+    await delivery.enqueue(ctx, host_session_id, data)
 
     # leave the #spectator channel
-    chats = await chats_client.get_chats(name=f"#{host_session_id}:spectators",
-                                         instance=True)
-    if chats is None:
-        return b""
-
-    if len(chats) != 1:
+    channel = await ctx.channel_directory.get_channel(
+        chats_client, f"#{host_session_id}:spectators", instance=True)
+    if channel is None:
         logger.error("Failed to get chat",
                      channel_name=f"#{host_session_id}:spectators",
                      session_id=session.session_id)
         return b""
 
-    chat = chats[0]
-
-    chat_left = await chats_client.leave_chat(chat.chat_id,
-                                              session.session_id)
+    chat_left = await ctx.channel_directory.leave(chats_client, channel,
+                                                  session.session_id)
     if chat_left is None:
         return b""
 
     # TODO: do we need to alert other spectators of the channel's -1 user count?
 
     # tell everyone else we stopped spectating
-    spectators = await users_client.get_spectators(host_session_id)
+    spectators = await ctx.spectator_engine.get_spectators(users_client,
+                                                           host_session_id)
     if spectators is None:
         return b""
 
     response_buffer = bytearray()
 
-    data = serial.write_fellow_spectator_left_packet(session.account_id)
-    for spectator in spectators:
-        if spectator == session.session_id:
-            continue
+    spectators = {spectator_session_id: spectator_account_id
+                  for spectator_session_id, spectator_account_id
+                  in spectators.items()
+                  if spectator_session_id != session.session_id}
 
-        # them to us
+    # them to us
+    for spectator_account_id in spectators.values():
         response_buffer += serial.write_fellow_spectator_left_packet(
-            spectator.account_id)
+            spectator_account_id)
 
-        # us to them
-        success = await users_client.enqueue_packet(spectator.session_id,
-                                                    data=list(data))
-        if not success:
-            return b""
+    # us to them
+    data = serial.write_fellow_spectator_left_packet(session.account_id)
+    ctx.broadcast_dispatcher.submit(data, spectators, key=host_session_id)
 
     return bytes(response_buffer)
 
@@ -544,19 +627,13 @@ async def handle_spectate_frames_request(ctx: Context, session: Session,
 
     # TODO: validate that the data the user is sending is valid
 
-    users_client = UsersClient(ctx.http_client)
-
-    spectators = await users_client.get_spectators(session.session_id)
-    if spectators is None:
-        return b""
-
-    data = serial.write_spectate_frames_packet(frame_bundle_data)
-
-    for spectator in spectators:
-        success = await users_client.enqueue_packet(spectator.session_id,
-                                                    data=list(data))
-        if not success:
-            return b""
+    success = await ctx.spectator_engine.broadcast_frames(ctx,
+                                                          session.session_id,
+                                                          session.account_id,
+                                                          frame_bundle_data)
+    if not success:
+        logger.error("Failed to get spectators",
+                     session_id=session.session_id)
 
     return b""
 
@@ -567,27 +644,24 @@ async def handle_lobby_join_request(ctx: Context, session: Session,
     users_client = UsersClient(ctx.http_client)
     chats_client = ChatsClient(ctx.http_client)
 
-    chats = await chats_client.get_chats(name="#lobby", instance=False)
-    if chats is None:
-        return b""
-
-    if len(chats) != 1:
+    channel = await ctx.channel_directory.get_channel(chats_client, "#lobby",
+                                                      instance=False)
+    if channel is None:
         logger.error("Failed to get chat",
                      channel_name="#lobby",
                      session_id=session.session_id)
         return b""
 
-    chat = chats[0]
-
-    account = await users_client.get_account(session.account_id)
+    account = await ctx.users_cache.get_account(users_client,
+                                                session.account_id)
     if account is None:
         return b""
 
-    member = await chats_client.join_chat(chat.chat_id,
-                                          session.session_id,
-                                          session.account_id,
-                                          account.username,
-                                          privileges=0)  # TODO
+    member = await ctx.channel_directory.join(chats_client, channel,
+                                              session.session_id,
+                                              session.account_id,
+                                              account.username,
+                                              privileges=0)  # TODO
     if member is None:
         return b""
 
@@ -599,19 +673,16 @@ async def handle_lobby_part_request(ctx: Context, session: Session,
                                     packet_data: bytes) -> bytes:
     chats_client = ChatsClient(ctx.http_client)
 
-    chats = await chats_client.get_chats(name="#lobby", instance=False)
-    if chats is None:
-        return b""
-
-    if len(chats) != 1:
+    channel = await ctx.channel_directory.get_channel(chats_client, "#lobby",
+                                                      instance=False)
+    if channel is None:
         logger.error("Failed to get chat",
                      channel_name="#lobby",
                      session_id=session.session_id)
         return b""
 
-    chat = chats[0]
-
-    member = await chats_client.leave_chat(chat.chat_id, session.session_id)
+    member = await ctx.channel_directory.leave(chats_client, channel,
+                                               session.session_id)
     if member is None:
         return b""
 
@@ -636,32 +707,23 @@ async def handle_channel_join_request(ctx: Context, session: Session,
 
     chats_client = ChatsClient(ctx.http_client)
 
-    chats = await chats_client.get_chats(name=channel_name)
-    if chats is None:
-        return b""
-
-    if len(chats) != 1:
+    channel = await ctx.channel_directory.get_channel(chats_client,
+                                                      channel_name)
+    if channel is None:
         # logger.error("Failed to get chat",
         #               channel_name=channel_name,
         #               session_id=session.session_id)
         return b""
 
-    chat = chats[0]
-
     # https://github.com/osuAkatsuki/bancho.py/blob/25d844eb6e2b9ec89e73fcc3b4b7632dbbf35709/app/objects/player.py#L758-L790
 
     # check if user is already in channel
-    members = await chats_client.get_members(chat.chat_id)
-    if members is None:
+    if channel.has_account(session.account_id):
+        logger.error("User attempted to join channel they're already in",
+                     channel_name=channel_name,
+                     session_id=session.session_id)
         return b""
 
-    for member in members:
-        if member.account_id == session.account_id:
-            logger.error("User attempted to join channel they're already in",
-                         channel_name=channel_name,
-                         session_id=session.session_id)
-            return b""
-
     # check if user has read privileges to the channel
     # TODO
 
@@ -670,15 +732,16 @@ async def handle_channel_join_request(ctx: Context, session: Session,
     # join the channel
     users_client = UsersClient(ctx.http_client)
 
-    account = await users_client.get_account(session.account_id)
+    account = await ctx.users_cache.get_account(users_client,
+                                                session.account_id)
     if account is None:
         return b""
 
-    member = await chats_client.join_chat(chat.chat_id,
-                                          session.session_id,
-                                          session.account_id,
-                                          account.username,
-                                          privileges=0)  # TODO
+    member = await ctx.channel_directory.join(chats_client, channel,
+                                              session.session_id,
+                                              session.account_id,
+                                              account.username,
+                                              privileges=0)  # TODO
     if member is None:
         return b""
 
@@ -689,20 +752,9 @@ async def handle_channel_join_request(ctx: Context, session: Session,
     response_buffer += serial.write_channel_join_success_packet(channel_name)
 
     # send updated channel info (player count) to everyone that can see it
-    updated_channel_info = serial.write_channel_info_packet(channel=chat.name,
-                                                            topic=chat.topic,
-                                                            user_count=len(members) + 1)
+    updated_channel_info = channel.write_channel_info_packet()
 
-    presences = await users_client.get_all_presences()
-    if presences is None:
-        return b""
-
-    for presence in presences:
-        # TODO: only if they have read privs
-
-        success = await users_client.enqueue_packet(presence.session_id,
-                                                    list(updated_channel_info))
-        if not success:
-            return b""
+    # TODO: only if they have read privs
+    ctx.broadcast_dispatcher.submit(updated_channel_info, key=channel.name)
 
     return bytes(response_buffer)
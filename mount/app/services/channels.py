@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+from uuid import UUID
+
+from app.common import metrics
+from app.common import serial
+from app.common.concurrency import gather_bounded
+from shared_modules import logger
+from shared_modules.api.rest.v1.chats import ChatsClient
+
+# channels which exist, but aren't listed to the client on login
+UNLISTED_CHANNELS = {"#lobby"}
+
+
+class Channel:
+    def __init__(self, chat: Any, members: list[Any]) -> None:
+        self.chat = chat
+        # session id -> member
+        self.members: dict[UUID, Any] = {member.session_id: member
+                                         for member in members}
+
+    @property
+    def chat_id(self) -> int:
+        return self.chat.chat_id
+
+    @property
+    def name(self) -> str:
+        return self.chat.name
+
+    def has_account(self, account_id: int) -> bool:
+        return any(member.account_id == account_id
+                   for member in self.members.values())
+
+    def write_channel_info_packet(self) -> bytes:
+        return serial.write_channel_info_packet(channel=self.chat.name,
+                                                topic=self.chat.topic,
+                                                user_count=len(self.members))
+
+
+class ChannelDirectory:
+    """The chats service's channels and their members, indexed by name and
+    kept current by this instance's own joins & leaves.
+
+    Also holds the CHANNEL_INFO ... CHANNEL_INFO_END block sent on login,
+    pre-encoded and only rebuilt when a listed channel's topic or member
+    count changes. The directory is periodically rebuilt from the chats
+    service to pick up changes made elsewhere.
+    """
+
+    def __init__(self) -> None:
+        self.synced = False
+
+        self._channels: dict[str, Channel] = {}
+
+        # session id -> the names of the channels it's a member of
+        self._session_channels: dict[UUID, set[str]] = {}
+
+        # the names of the channels returned by get_chats(), in order
+        self._listed: list[str] = []
+
+        self._channel_info_packets: bytes | None = None
+
+        # channels joined or left while a sync is in progress
+        self._sync_lock = asyncio.Lock()
+        self._updated_during_sync: set[str] | None = None
+
+    def __len__(self) -> int:
+        return len(self._channels)
+
+    def _updated(self, channel: Channel) -> None:
+        if channel.name in self._listed:
+            self._channel_info_packets = None
+
+        if self._updated_during_sync is not None:
+            self._updated_during_sync.add(channel.name)
+
+    def _channel_info_key(self) -> list[tuple[str, str, int]]:
+        return [(name, self._channels[name].chat.topic,
+                 len(self._channels[name].members))
+                for name in self._listed]
+
+    def get_channel_info_packets(self) -> bytes:
+        """CHANNEL_INFO for each listed channel, then CHANNEL_INFO_END."""
+        if self._channel_info_packets is None:
+            self._channel_info_packets = b"".join(
+                [self._channels[name].write_channel_info_packet()
+                 for name in self._listed
+                 if name not in UNLISTED_CHANNELS]
+                + [serial.CHANNEL_INFO_END_PACKET])
+
+        return self._channel_info_packets
+
+    def _add_member(self, channel: Channel, session_id: UUID,
+                    member: Any) -> None:
+        channel.members[session_id] = member
+        self._session_channels.setdefault(session_id, set()).add(channel.name)
+        self._updated(channel)
+
+    def _remove_member(self, channel: Channel, session_id: UUID) -> None:
+        if channel.members.pop(session_id, None) is None:
+            return
+
+        session_channels = self._session_channels.get(session_id)
+        if session_channels is not None:
+            session_channels.discard(channel.name)
+            if not session_channels:
+                del self._session_channels[session_id]
+
+        self._updated(channel)
+
+    def _index_channel(self, channel: Channel) -> None:
+        for session_id in channel.members:
+            self._session_channels.setdefault(session_id,
+                                              set()).add(channel.name)
+
+    def get_session_channels(self, session_id: UUID) -> list[Channel]:
+        return [self._channels[name]
+                for name in self._session_channels.get(session_id, ())]
+
+    async def get_channel(self, chats_client: ChatsClient, name: str,
+                          instance: bool | None = None) -> Channel | None:
+        """Find a channel by name, fetching it if it isn't known yet."""
+        channel = self._channels.get(name)
+        if channel is not None:
+            return channel
+
+        if instance is None:
+            chats = await chats_client.get_chats(name=name)
+        else:
+            chats = await chats_client.get_chats(name=name, instance=instance)
+
+        if chats is None or len(chats) != 1:
+            return None
+
+        chat = chats[0]
+
+        members = await chats_client.get_members(chat.chat_id)
+        if members is None:
+            return None
+
+        # (another request may have fetched it in the meantime)
+        channel = self._channels.get(name)
+        if channel is None:
+            channel = self._channels[name] = Channel(chat, members)
+            self._index_channel(channel)
+
+        return channel
+
+    async def join(self, chats_client: ChatsClient, channel: Channel,
+                   session_id: UUID, account_id: int, username: str,
+                   privileges: int) -> Any | None:
+        member = await chats_client.join_chat(channel.chat_id, session_id,
+                                              account_id, username,
+                                              privileges=privileges)
+        if member is None:
+            return None
+
+        # (the directory may have been synced while we were waiting)
+        channel = self._channels.get(channel.name, channel)
+        self._add_member(channel, session_id, member)
+        return member
+
+    async def leave(self, chats_client: ChatsClient, channel: Channel,
+                    session_id: UUID) -> Any | None:
+        member = await chats_client.leave_chat(channel.chat_id, session_id)
+        if member is None:
+            return None
+
+        channel = self._channels.get(channel.name, channel)
+        self._remove_member(channel, session_id)
+        return member
+
+    async def leave_all(self, chats_client: ChatsClient, session_id: UUID,
+                        concurrency_limit: int) -> bool:
+        """Leave every channel a session is a member of, e.g. when it logs
+        out or expires."""
+        channels = self.get_session_channels(session_id)
+
+        # (vs. leaving every channel, whether we're a member or not)
+        metrics.increment("channels.leave_all.leaves", len(channels))
+        metrics.increment("channels.leave_all.leaves_saved",
+                          len(self._channels) - len(channels))
+
+        results = await gather_bounded(
+            (self.leave(chats_client, channel, session_id)
+             for channel in channels),
+            limit=concurrency_limit)
+
+        return all(result is not None for result in results)
+
+    async def sync(self, chats_client: ChatsClient,
+                   concurrency_limit: int) -> bool:
+        """Rebuild the directory from the chats service."""
+        async with self._sync_lock:
+            self._updated_during_sync = set()
+            try:
+                chats = await chats_client.get_chats()
+                if chats is None:
+                    return False
+
+                all_members = await gather_bounded(
+                    (chats_client.get_members(chat.chat_id)
+                     for chat in chats),
+                    limit=concurrency_limit)
+
+                channels: dict[str, Channel] = {}
+                for chat, members in zip(chats, all_members):
+                    if members is None:
+                        return False
+
+                    channels[chat.name] = Channel(chat, members)
+
+                # local joins & leaves made while we were fetching are newer
+                for name in self._updated_during_sync:
+                    channel = self._channels.get(name)
+                    if channel is not None and name in channels:
+                        channels[name].members = channel.members
+
+                channel_info_key = self._channel_info_key()
+
+                self._channels = channels
+                self._listed = [chat.name for chat in chats]
+                self.synced = True
+
+                self._session_channels = {}
+                for channel in channels.values():
+                    self._index_channel(channel)
+
+                if self._channel_info_key() != channel_info_key:
+                    self._channel_info_packets = None
+
+                return True
+            finally:
+                self._updated_during_sync = None
+
+    async def run_sync_loop(self, chats_client: ChatsClient, interval: float,
+                            concurrency_limit: int) -> None:
+        while True:
+            try:
+                synced = await self.sync(chats_client, concurrency_limit)
+            except Exception as exc:
+                logger.error("Failed to sync channel directory",
+                             error=str(exc))
+            else:
+                if synced:
+                    logger.debug("Synced channel directory",
+                                 channels=len(self))
+                else:
+                    logger.warning("Failed to sync channel directory")
+
+            await asyncio.sleep(interval)
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Collection
+from uuid import UUID
+
+import httpx
+from app.common import metrics
+from app.common import serial
+from app.common import settings
+from app.common.concurrency import gather_bounded
+from app.common.context import Context
+from app.services.outbox import OutboxEntry
+from app.services.outbox import split_packets
+from shared_modules import logger
+from shared_modules.api.rest.v1.chats import ChatsClient
+from shared_modules.api.rest.v1.users import UsersClient
+
+# how packet queue data is sent to & from the users service.
+# - json: through the users client, as a list of ints per byte
+# - binary: raw application/octet-stream bodies; a dequeue returns every
+#   queued entry, each prefixed with its u32 length
+QUEUE_TRANSPORT_JSON = "json"
+QUEUE_TRANSPORT_BINARY = "binary"
+
+QUEUED_PACKETS_PATH = "/v1/sessions/{session_id}/queued-packets"
+BINARY_CONTENT_TYPE = "application/octet-stream"
+
+
+def _queued_packets_url(session_id: UUID) -> str:
+    return (settings.USERS_SERVICE_URL
+            + QUEUED_PACKETS_PATH.format(session_id=session_id))
+
+
+async def _enqueue_binary(ctx: Context, session_id: UUID,
+                          data: bytes) -> bool:
+    try:
+        response = await ctx.http_client.post(
+            _queued_packets_url(session_id), content=data,
+            headers={"Content-Type": BINARY_CONTENT_TYPE})
+    except httpx.HTTPError as exc:
+        logger.error("Failed to enqueue packet data",
+                     session_id=session_id, error=str(exc))
+        return False
+
+    if not response.is_success:
+        logger.warning("Failed to enqueue packet data",
+                       session_id=session_id,
+                       status_code=response.status_code)
+        return False
+
+    return True
+
+
+async def _dequeue_all_binary(ctx: Context, session_id: UUID
+                              ) -> bytes | None:
+    try:
+        response = await ctx.http_client.delete(
+            _queued_packets_url(session_id),
+            headers={"Accept": BINARY_CONTENT_TYPE})
+    except httpx.HTTPError as exc:
+        logger.error("Failed to dequeue packet data",
+                     session_id=session_id, error=str(exc))
+        return None
+
+    if not response.is_success:
+        logger.warning("Failed to dequeue packet data",
+                       session_id=session_id,
+                       status_code=response.status_code)
+        return None
+
+    try:
+        return serial.unpack_queued_packets(response.content)
+    except serial.TruncatedPacketError as exc:
+        logger.error("Received malformed packet data",
+                     session_id=session_id, error=str(exc))
+        return None
+
+
+async def _enqueue_upstream(ctx: Context, session_id: UUID,
+                            data: bytes) -> bool:
+    if settings.PACKET_QUEUE_TRANSPORT == QUEUE_TRANSPORT_BINARY:
+        return await _enqueue_binary(ctx, session_id, data)
+
+    users_client = UsersClient(ctx.http_client)
+    return await users_client.enqueue_packet(session_id, data=list(data))
+
+
+async def _dequeue_all_upstream(ctx: Context, session_id: UUID
+                                ) -> bytes | None:
+    if settings.PACKET_QUEUE_TRANSPORT == QUEUE_TRANSPORT_BINARY:
+        return await _dequeue_all_binary(ctx, session_id)
+
+    users_client = UsersClient(ctx.http_client)
+    queued_packets = await users_client.deqeue_all_packets(session_id)
+    if queued_packets is None:
+        return None
+
+    return b"".join(bytes(packet.data) for packet in queued_packets)
+
+
+async def enqueue(ctx: Context, session_id: UUID, data: bytes) -> None:
+    """Enqueue a payload to a single session's packet queue.
+
+    The payload is held in our outbox until the next flush (or the
+    session's next poll), so this can't fail.
+    """
+    ctx.outbox.add(session_id, split_packets(data))
+    ctx.queue_notifier.notify(session_id)
+
+
+async def dequeue_all(ctx: Context, session_id: UUID) -> bytes | None:
+    """Dequeue (and join) everything in a session's packet queue, followed
+    by anything still in our outbox for it."""
+    # (so that packets already on their way upstream aren't overtaken)
+    await ctx.outbox.wait_for_flush(session_id)
+
+    data = await _dequeue_all_upstream(ctx, session_id)
+    if data is None:
+        return None
+
+    return data + ctx.outbox.polled(session_id)
+
+
+async def multicast(ctx: Context, data: bytes,
+                    session_ids: Collection[UUID]) -> None:
+    """Enqueue one payload to many sessions' packet queues. As with
+    enqueue, this can't fail."""
+    # (split once; the entries are immutable, so sessions can share them)
+    entries = split_packets(data)
+
+    for session_id in session_ids:
+        ctx.outbox.add(session_id, entries)
+        # (a spurious wake up only costs the waiter an empty dequeue)
+        ctx.queue_notifier.notify(session_id)
+
+
+async def _flush_session(ctx: Context, session_id: UUID,
+                         entries: list[OutboxEntry]) -> None:
+    outbox = ctx.outbox
+
+    try:
+        success = await _enqueue_upstream(
+            ctx, session_id, b"".join([entry.data for entry in entries]))
+    except Exception as exc:
+        logger.error("Failed to enqueue packet data",
+                     session_id=session_id, error=str(exc))
+        success = False
+
+    if success:
+        outbox.sent_upstream(session_id, entries)
+        metrics.increment("outbox.flushed_packets", len(entries))
+        return
+
+    dropped = outbox.put_back(session_id, entries,
+                              max_attempts=settings.OUTBOX_MAX_FLUSH_ATTEMPTS)
+    metrics.increment("outbox.failed_flushes")
+    if dropped:
+        logger.warning("Dropped undeliverable packets",
+                       session_id=session_id, packets=dropped)
+        metrics.increment("outbox.undeliverable_packets", dropped)
+
+
+async def flush_outbox(ctx: Context) -> None:
+    """Send each session's pending packets upstream, as one enqueue."""
+    outbox = ctx.outbox
+
+    session_ids = outbox.get_pending_session_ids()
+    pending = [outbox.take_entries(session_id) for session_id in session_ids]
+
+    await gather_bounded((_flush_session(ctx, session_id, entries)
+                          for session_id, entries in zip(session_ids, pending)),
+                         limit=settings.UPSTREAM_CONCURRENCY_LIMIT)
+
+    metrics.increment("outbox.flushes")
+    outbox.prune()
+
+
+async def run_outbox_flush_loop(ctx: Context, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            await flush_outbox(ctx)
+        except Exception as exc:
+            logger.error("Failed to flush the outbox", error=str(exc))
+
+
+async def get_online_session_ids(ctx: Context,
+                                 exclude: UUID | None = None
+                                 ) -> list[UUID] | None:
+    users_client = UsersClient(ctx.http_client)
+
+    presences = await ctx.users_cache.get_all_presences(users_client)
+    if presences is None:
+        return None
+
+    return [presence.session_id for presence in presences
+            if presence.session_id != exclude]
+
+
+async def broadcast(ctx: Context, data: bytes,
+                    exclude: UUID | None = None) -> bool:
+    """Enqueue a payload to every online session; returns False if they
+    couldn't be fetched."""
+    session_ids = await get_online_session_ids(ctx, exclude)
+    if session_ids is None:
+        return False
+
+    await multicast(ctx, data, session_ids)
+    return True
+
+
+async def broadcast_to_chat(ctx: Context, data: bytes, chat_id: int,
+                            exclude: UUID | None = None) -> bool:
+    """Enqueue a payload to every member of a chat; returns False if they
+    couldn't be fetched."""
+    chats_client = ChatsClient(ctx.http_client)
+
+    members = await chats_client.get_members(chat_id)
+    if members is None:
+        return False
+
+    await multicast(ctx, data, [member.session_id
+                                for member in members
+                                if member.session_id != exclude])
+    return True
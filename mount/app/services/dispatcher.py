@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections.abc import Hashable
+from typing import Collection
+from typing import NamedTuple
+from uuid import UUID
+
+from app.common import metrics
+from app.common.context import Context
+from app.services import delivery
+from shared_modules import logger
+
+
+class BroadcastJob(NamedTuple):
+    data: bytes
+    session_ids: list[UUID] | None  # None for every online session
+    exclude: UUID | None
+    submitted_at: float
+
+
+class BroadcastDispatcher:
+    """Delivers broadcasts in the background, so that the request which
+    triggered one doesn't wait on (or fail because of) its recipients.
+
+    Jobs are spread over one bounded queue per worker by key; jobs with the
+    same key (e.g. the sender's session) are delivered in order. Delivery
+    is to the outbox, which can't fail; failures to fetch a broadcast's
+    recipients are retried, with a linear backoff.
+    """
+
+    def __init__(self, workers: int, max_queue_size: int, max_attempts: int,
+                 retry_delay: float) -> None:
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self._queues: list[asyncio.Queue[BroadcastJob]] = [
+            asyncio.Queue(maxsize=max_queue_size) for _ in range(workers)
+        ]
+        self._next_queue = 0
+
+        # how long the most recently started job waited in its queue
+        self.lag = 0.0
+
+    def __len__(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def submit(self, data: bytes,
+               session_ids: Collection[UUID] | None = None,
+               exclude: UUID | None = None,
+               key: Hashable | None = None) -> bool:
+        """Queue a payload for delivery to some sessions, or every online
+        session. Returns False if the queue was full and it was dropped."""
+        if key is not None:
+            queue = self._queues[hash(key) % len(self._queues)]
+        else:
+            queue = self._queues[self._next_queue]
+            self._next_queue = (self._next_queue + 1) % len(self._queues)
+
+        job = BroadcastJob(data=data,
+                           session_ids=(list(session_ids)
+                                        if session_ids is not None
+                                        else None),
+                           exclude=exclude,
+                           submitted_at=time.monotonic())
+        try:
+            queue.put_nowait(job)
+        except asyncio.QueueFull:
+            metrics.increment("dispatcher.jobs_dropped")
+            logger.warning("Dropped a broadcast; the dispatcher is full",
+                           queue_depth=len(self))
+            return False
+
+        metrics.increment("dispatcher.jobs_submitted")
+        return True
+
+    async def _dispatch(self, ctx: Context, job: BroadcastJob) -> None:
+        session_ids = job.session_ids
+        attempt = 1
+
+        while session_ids is None:
+            session_ids = await delivery.get_online_session_ids(ctx,
+                                                                job.exclude)
+            if session_ids is None:
+                if attempt == self.max_attempts:
+                    metrics.increment("dispatcher.jobs_failed")
+                    logger.error("Failed to fetch a broadcast's recipients")
+                    return
+
+                await asyncio.sleep(self.retry_delay * attempt)
+                attempt += 1
+
+        if job.exclude is not None:
+            session_ids = [session_id for session_id in session_ids
+                           if session_id != job.exclude]
+
+        await delivery.multicast(ctx, job.data, session_ids)
+        metrics.increment("dispatcher.deliveries", len(session_ids))
+
+    async def run_worker(self, ctx: Context, worker_id: int) -> None:
+        queue = self._queues[worker_id]
+        while True:
+            job = await queue.get()
+            self.lag = time.monotonic() - job.submitted_at
+            try:
+                await self._dispatch(ctx, job)
+            except Exception as exc:
+                metrics.increment("dispatcher.jobs_failed")
+                logger.error("Failed to dispatch a broadcast",
+                             error=str(exc))
+            finally:
+                queue.task_done()
+
+    def start_workers(self, ctx: Context) -> list[asyncio.Task[None]]:
+        return [asyncio.create_task(self.run_worker(ctx, worker_id))
+                for worker_id in range(len(self._queues))]
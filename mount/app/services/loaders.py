@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Awaitable
+from typing import Callable
+from typing import Generic
+from typing import Hashable
+from typing import TypeVar
+
+from app.common import metrics
+from app.common.concurrency import gather_bounded
+from shared_modules.api.rest.v1.users import UsersClient
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class BatchLoader(Generic[K, V]):
+    """Coalesces lookups of the same keys made at around the same time.
+
+    Keys requested within one tick of the event loop are collected,
+    deduplicated, and fetched together (concurrently, at most
+    `concurrency_limit` at once) once the tick is over. A key which is
+    already being fetched isn't fetched again; its waiters share the one
+    upstream call.
+
+    Counted as `<name>.requests`, `<name>.coalesced` (requests which shared
+    another's upstream call), `<name>.batches` & `<name>.upstream_calls`.
+    """
+
+    def __init__(self, name: str,
+                 fetch: Callable[[UsersClient, K], Awaitable[V | None]],
+                 concurrency_limit: int) -> None:
+        self.name = name
+        self.fetch = fetch
+        self.concurrency_limit = concurrency_limit
+
+        # keys waiting for the next batch, and keys being fetched
+        self._pending: dict[K, asyncio.Future[V | None]] = {}
+        self._in_flight: dict[K, asyncio.Future[V | None]] = {}
+
+        # (any of the batch's requesters' clients will do; they all wrap
+        # the same http client)
+        self._users_client: UsersClient | None = None
+
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def load(self, users_client: UsersClient, key: K) -> V | None:
+        metrics.increment(f"{self.name}.requests")
+
+        future = self._in_flight.get(key)
+        if future is None:
+            future = self._pending.get(key)
+
+        if future is not None:
+            metrics.increment(f"{self.name}.coalesced")
+            # (don't let one waiter being cancelled cancel the others)
+            return await asyncio.shield(future)
+
+        loop = asyncio.get_running_loop()
+        future = self._pending[key] = loop.create_future()
+
+        if self._users_client is None:
+            self._users_client = users_client
+            loop.call_soon(self._dispatch)
+
+        return await asyncio.shield(future)
+
+    def _dispatch(self) -> None:
+        users_client = self._users_client
+        assert users_client is not None
+
+        batch, self._pending = self._pending, {}
+        self._users_client = None
+
+        self._in_flight.update(batch)
+
+        task = asyncio.create_task(self._fetch_batch(users_client, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch_one(self, users_client: UsersClient, key: K,
+                         future: asyncio.Future[V | None]) -> None:
+        try:
+            value = await self.fetch(users_client, key)
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(value)
+        finally:
+            del self._in_flight[key]
+
+    async def _fetch_batch(self, users_client: UsersClient,
+                           batch: dict[K, asyncio.Future[V | None]]) -> None:
+        metrics.increment(f"{self.name}.batches")
+        metrics.increment(f"{self.name}.upstream_calls", len(batch))
+
+        await gather_bounded((self._fetch_one(users_client, key, future)
+                              for key, future in batch.items()),
+                             limit=self.concurrency_limit)
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import asyncio
+from collections.abc import Iterator
+from contextlib import contextmanager
+from uuid import UUID
+
+
+class QueueNotifier:
+    """Wakes up requests waiting for data to be enqueued to a session.
+
+    Only enqueues made by this process are seen, so waiters should always
+    wait with a deadline.
+    """
+
+    def __init__(self) -> None:
+        self._waiters: dict[UUID, set[asyncio.Event]] = {}
+
+    def __len__(self) -> int:
+        return len(self._waiters)
+
+    def notify(self, session_id: UUID) -> None:
+        for event in self._waiters.get(session_id, ()):
+            event.set()
+
+    @contextmanager
+    def listen(self, session_id: UUID) -> Iterator[asyncio.Event]:
+        """Register an event which is set by the session's next enqueue.
+
+        Listen before checking the queue, so an enqueue between the check
+        and the wait isn't missed.
+        """
+        event = asyncio.Event()
+        waiters = self._waiters.setdefault(session_id, set())
+        waiters.add(event)
+        try:
+            yield event
+        finally:
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[session_id]
+
+    @staticmethod
+    async def wait(event: asyncio.Event, timeout: float) -> bool:
+        """Wait for a listened event; returns whether it was set in time."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
@@ -0,0 +1,264 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import NamedTuple
+from uuid import UUID
+
+from app.common import metrics
+from app.common import serial
+
+
+class OutboxEntry(NamedTuple):
+    packet_id: int
+    data: bytes  # the full packet, header included
+    account_id: int | None  # for USER_STATS; packets are coalesced by it
+
+
+# packets which may be dropped (oldest first) when a session is over its
+# limits, or can't be sent upstream; everything else (e.g. chat) is never
+# dropped
+DROPPABLE_PACKETS = frozenset((serial.ServerPackets.SPECTATE_FRAMES,))
+
+
+def split_packets(data: bytes) -> list[OutboxEntry]:
+    entries: list[OutboxEntry] = []
+
+    offset = 0
+    while offset < len(data):
+        packet_id, length = serial.PACKET_HEADER.unpack_from(data, offset)
+        end = offset + serial.PACKET_HEADER.size + length
+
+        account_id = None
+        if packet_id == serial.ServerPackets.USER_STATS:
+            (account_id,) = serial.INT32_STRUCT.unpack_from(
+                data, offset + serial.PACKET_HEADER.size)
+
+        entries.append(OutboxEntry(packet_id, data[offset:end], account_id))
+        offset = end
+
+    return entries
+
+
+class SessionOutbox:
+    def __init__(self) -> None:
+        # packets not yet sent upstream, oldest first
+        self.pending: list[OutboxEntry] = []
+        self.pending_bytes = 0
+
+        # packets being sent upstream, and set once they've got there (or
+        # failed to)
+        self.in_flight: list[OutboxEntry] = []
+        self.flushed: asyncio.Event | None = None
+
+        # what we've sent upstream since the session last polled us
+        self.backlog_bytes = 0
+        self.backlog_packets = 0
+        self.backlog_started_at = 0.0
+
+        # consecutive failures to send the pending packets upstream
+        self.failed_flushes = 0
+
+    def finish_flush(self) -> None:
+        self.in_flight = []
+        if self.flushed is not None:
+            self.flushed.set()
+            self.flushed = None
+
+    def expire_backlog(self, backlog_ttl: float) -> None:
+        if (self.backlog_packets
+                and time.monotonic() - self.backlog_started_at > backlog_ttl):
+            self.backlog_bytes = 0
+            self.backlog_packets = 0
+
+
+class Outbox:
+    """Packets on their way to sessions' packet queues.
+
+    Packets are held for up to one flush interval before they're sent
+    upstream (as one enqueue per session), or until the session polls us,
+    whichever comes first. While they're held:
+
+    - a USER_STATS packet replaces any pending one for the same account.
+    - once a session has more than `max_bytes` or `max_packets` pending or
+      sent upstream since it last polled us, its oldest pending
+      SPECTATE_FRAMES are dropped. Other packets are never dropped.
+
+    We can't see the upstream queues themselves, so what we've sent upstream
+    is assumed to have been dequeued after `backlog_ttl` seconds, even if
+    the session polled another instance of this service.
+
+    A session's packets arrive in the order they were added: a poll waits
+    for any of its packets on their way upstream (see wait_for_flush), and
+    pending packets aren't handed to a poll while older ones are in flight.
+    """
+
+    def __init__(self, max_bytes: int, max_packets: int,
+                 backlog_ttl: float) -> None:
+        self.max_bytes = max_bytes
+        self.max_packets = max_packets
+        self.backlog_ttl = backlog_ttl
+
+        self._outboxes: dict[UUID, SessionOutbox] = {}
+
+    def __len__(self) -> int:
+        return len(self._outboxes)
+
+    @property
+    def pending_bytes(self) -> int:
+        return sum(outbox.pending_bytes for outbox in self._outboxes.values())
+
+    def _get_or_create(self, session_id: UUID) -> SessionOutbox:
+        outbox = self._outboxes.get(session_id)
+        if outbox is None:
+            outbox = self._outboxes[session_id] = SessionOutbox()
+        return outbox
+
+    def add(self, session_id: UUID, entries: list[OutboxEntry]) -> None:
+        """Add packets (from split_packets, which may be shared between
+        sessions) to a session's outbox."""
+        outbox = self._get_or_create(session_id)
+
+        for entry in entries:
+            if entry.account_id is not None:
+                self._coalesce(outbox, entry.account_id)
+
+            outbox.pending.append(entry)
+            outbox.pending_bytes += len(entry.data)
+
+        outbox.expire_backlog(self.backlog_ttl)
+        self._enforce_limits(outbox)
+
+    def _coalesce(self, outbox: SessionOutbox, account_id: int) -> None:
+        for i, entry in enumerate(outbox.pending):
+            if entry.account_id == account_id:
+                del outbox.pending[i]
+                outbox.pending_bytes -= len(entry.data)
+                metrics.increment("outbox.coalesced.USER_STATS")
+                # (there's never more than one pending per account)
+                return
+
+    def _enforce_limits(self, outbox: SessionOutbox) -> None:
+        def over_limits() -> bool:
+            return (outbox.pending_bytes + outbox.backlog_bytes > self.max_bytes
+                    or (len(outbox.pending) + outbox.backlog_packets
+                        > self.max_packets))
+
+        if not over_limits():
+            return
+
+        kept: list[OutboxEntry] = []
+        for entry in outbox.pending:
+            if entry.packet_id in DROPPABLE_PACKETS and over_limits():
+                outbox.pending_bytes -= len(entry.data)
+                packet_name = serial.server_packet_id_to_name(entry.packet_id)
+                metrics.increment(f"outbox.dropped.{packet_name}")
+            else:
+                kept.append(entry)
+
+        outbox.pending = kept
+
+    def _get_in_flight(self, session_id: UUID,
+                       entries: list[OutboxEntry]) -> SessionOutbox | None:
+        # (None if the session was removed while they were in flight)
+        outbox = self._outboxes.get(session_id)
+        if outbox is None or outbox.in_flight is not entries:
+            return None
+        return outbox
+
+    def take_entries(self, session_id: UUID) -> list[OutboxEntry]:
+        """Take a session's pending packets, to be sent upstream; report
+        back with sent_upstream or put_back."""
+        outbox = self._outboxes.get(session_id)
+        if outbox is None or not outbox.pending or outbox.in_flight:
+            return []
+
+        entries = outbox.in_flight = outbox.pending
+        outbox.flushed = asyncio.Event()
+        outbox.pending = []
+        outbox.pending_bytes = 0
+        return entries
+
+    def put_back(self, session_id: UUID, entries: list[OutboxEntry],
+                 max_attempts: int) -> int:
+        """Return packets which couldn't be sent upstream, ahead of anything
+        added since they were taken. Once they've failed `max_attempts`
+        times in a row, the droppable ones are dropped; the rest are kept
+        until they get there. Returns how many were dropped."""
+        outbox = self._get_in_flight(session_id, entries)
+        if outbox is None:
+            return 0
+
+        outbox.finish_flush()
+
+        dropped = 0
+        outbox.failed_flushes += 1
+        if outbox.failed_flushes >= max_attempts:
+            outbox.failed_flushes = 0
+            kept = [entry for entry in entries
+                    if entry.packet_id not in DROPPABLE_PACKETS]
+            dropped = len(entries) - len(kept)
+            entries = kept
+
+        outbox.pending[:0] = entries
+        outbox.pending_bytes += sum(len(entry.data) for entry in entries)
+        return dropped
+
+    def sent_upstream(self, session_id: UUID,
+                      entries: list[OutboxEntry]) -> None:
+        outbox = self._get_in_flight(session_id, entries)
+        if outbox is None:
+            return
+
+        outbox.finish_flush()
+        outbox.failed_flushes = 0
+
+        outbox.expire_backlog(self.backlog_ttl)
+        if not outbox.backlog_packets:
+            outbox.backlog_started_at = time.monotonic()
+
+        outbox.backlog_bytes += sum(len(entry.data) for entry in entries)
+        outbox.backlog_packets += len(entries)
+
+    async def wait_for_flush(self, session_id: UUID) -> None:
+        """Wait for any of the session's packets on their way upstream to
+        get there (or fail to); call before dequeueing its upstream queue."""
+        outbox = self._outboxes.get(session_id)
+        if outbox is not None and outbox.flushed is not None:
+            await outbox.flushed.wait()
+
+    def polled(self, session_id: UUID) -> bytes:
+        """The session has polled us, emptying its upstream queue; take its
+        pending packets to include in the response."""
+        outbox = self._outboxes.get(session_id)
+        if outbox is None:
+            return b""
+
+        if outbox.in_flight:
+            # (a flush started after the session's dequeue; its packets are
+            # older than those pending, so leave both for the next poll)
+            outbox.backlog_bytes = 0
+            outbox.backlog_packets = 0
+            return b""
+
+        del self._outboxes[session_id]
+        return b"".join([entry.data for entry in outbox.pending])
+
+    def remove(self, session_id: UUID) -> None:
+        outbox = self._outboxes.pop(session_id, None)
+        if outbox is not None:
+            # (don't leave a poll waiting on it)
+            outbox.finish_flush()
+
+    def get_pending_session_ids(self) -> list[UUID]:
+        return [session_id for session_id, outbox in self._outboxes.items()
+                if outbox.pending and not outbox.in_flight]
+
+    def prune(self) -> None:
+        """Forget sessions with nothing pending or in flight, whose backlog
+        has expired."""
+        for session_id, outbox in list(self._outboxes.items()):
+            outbox.expire_backlog(self.backlog_ttl)
+            if (not outbox.pending and not outbox.in_flight
+                    and not outbox.backlog_packets):
+                del self._outboxes[session_id]
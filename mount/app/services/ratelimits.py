@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Mapping
+from uuid import UUID
+
+from app.common import metrics
+from app.common import serial
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class SessionRateLimits:
+    def __init__(self, account_id: int) -> None:
+        self.account_id = account_id
+        # packet id -> bucket
+        self.buckets: dict[int, TokenBucket] = {}
+        self.dropped = 0
+
+
+class PacketRateLimiter:
+    """Token bucket rate limits on the packets a session may send, per
+    packet type. `limits` maps packet ids to (packets per second, burst);
+    other packets aren't limited.
+
+    Sessions are forgotten on logout, or once more than `max_sessions` are
+    tracked (least recently active first); a forgotten session just starts
+    again with full buckets.
+
+    Offenders are reported by account id; session ids are bearer tokens,
+    and mustn't be exported.
+    """
+
+    def __init__(self, limits: Mapping[int, tuple[float, int]],
+                 max_sessions: int) -> None:
+        self.max_sessions = max_sessions
+
+        # (indexed by packet id, like the packet handlers)
+        self._limits: list[tuple[float, int] | None] = \
+            [None] * serial.MAX_CLIENT_PACKET_ID
+        for packet_id, limit in limits.items():
+            self._limits[packet_id] = limit
+
+        self._drop_counter_names = [
+            f"ratelimits.dropped.{serial.client_packet_id_to_name(packet_id)}"
+            for packet_id in range(len(self._limits))
+        ]
+
+        # session id -> their buckets, least recently active first
+        self._sessions: OrderedDict[UUID, SessionRateLimits] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def allow(self, session_id: UUID, account_id: int,
+              packet_id: int) -> bool:
+        """Take a token for a packet; False if it should be dropped."""
+        if not 0 <= packet_id < len(self._limits):
+            return True
+
+        limit = self._limits[packet_id]
+        if limit is None:
+            return True
+
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = SessionRateLimits(
+                account_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+
+        bucket = session.buckets.get(packet_id)
+        if bucket is None:
+            bucket = session.buckets[packet_id] = TokenBucket(*limit)
+
+        if bucket.take():
+            return True
+
+        session.dropped += 1
+        metrics.increment(self._drop_counter_names[packet_id])
+        return False
+
+    def get_top_offenders(self, limit: int = 10) -> dict[str, int]:
+        """The accounts whose sessions have the most dropped packets."""
+        dropped: dict[int, int] = {}
+        for session in self._sessions.values():
+            if session.dropped:
+                dropped[session.account_id] = (
+                    dropped.get(session.account_id, 0) + session.dropped)
+
+        offenders = sorted(dropped.items(), key=lambda item: item[1],
+                           reverse=True)[:limit]
+        return {str(account_id): count for account_id, count in offenders}
+
+    def remove(self, session_id: UUID) -> None:
+        self._sessions.pop(session_id, None)
+
+    def register_gauges(self) -> None:
+        metrics.register_gauge("ratelimits.sessions", self.__len__)
+        metrics.register_gauge("ratelimits.top_offenders",
+                               self.get_top_offenders)
+
+    def unregister_gauges(self) -> None:
+        metrics.unregister_gauge("ratelimits.sessions")
+        metrics.unregister_gauge("ratelimits.top_offenders")
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from datetime import datetime
+from datetime import timedelta
+from typing import NamedTuple
+from uuid import UUID
+
+from app.common import metrics
+from shared_modules.api.rest.v1.users import UsersClient
+from shared_modules.models.sessions import Session
+
+SESSION_LIFETIME = timedelta(minutes=5)
+
+
+class CachedSession(NamedTuple):
+    session: Session
+    expires_at: datetime
+
+
+class SessionCache:
+    """Sessions validated by this instance, keyed by token.
+
+    A session is served locally until its remaining lifetime drops below
+    the refresh threshold, and only then is a new expiry pushed to the
+    users service. A session deleted upstream by someone else (e.g. a kick
+    from another instance) is therefore noticed within
+    `SESSION_LIFETIME - refresh_threshold`.
+    """
+
+    def __init__(self, refresh_threshold: timedelta) -> None:
+        self.refresh_threshold = refresh_threshold
+        self._sessions: dict[UUID, CachedSession] = {}
+        self._next_prune = datetime.utcnow() + SESSION_LIFETIME
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _prune(self, now: datetime) -> None:
+        """Drop sessions which expired without being invalidated."""
+        self._sessions = {session_id: cached for session_id, cached
+                          in self._sessions.items()
+                          if cached.expires_at > now}
+        self._next_prune = now + SESSION_LIFETIME
+
+    async def get(self, users_client: UsersClient, session_id: UUID
+                  ) -> Session | None:
+        """Validate a session, refreshing its expiry upstream if due."""
+        now = datetime.utcnow()
+
+        cached = self._sessions.get(session_id)
+        if (cached is not None
+                and cached.expires_at - now > self.refresh_threshold):
+            metrics.increment("sessions.cache_hits")
+            return cached.session
+
+        expires_at = now + SESSION_LIFETIME
+        session = await users_client.partial_update_session(
+            session_id, expires_at=expires_at)
+        metrics.increment("sessions.upstream_writes")
+
+        if session is None:
+            self._sessions.pop(session_id, None)
+            return None
+
+        self._sessions[session_id] = CachedSession(session, expires_at)
+
+        if now >= self._next_prune:
+            self._prune(now)
+
+        return session
+
+    def invalidate(self, session_id: UUID) -> None:
+        self._sessions.pop(session_id, None)
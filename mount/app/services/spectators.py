@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+from collections import deque
+from collections import OrderedDict
+from uuid import UUID
+
+from app.common import metrics
+from app.common import serial
+from app.common.cache import TTLCache
+from app.common.context import Context
+from app.services import delivery
+from shared_modules.api.rest.v1.users import UsersClient
+
+
+class HostStats:
+    def __init__(self, account_id: int) -> None:
+        self.account_id = account_id
+        self.frame_bundles = 0
+        self.bytes_received = 0  # frame bundle data, from the host
+        self.bytes_delivered = 0  # encoded packets, summed over spectators
+        self.deliveries = 0
+
+    def to_dict(self) -> dict[str, int]:
+        return {
+            "frame_bundles": self.frame_bundles,
+            "bytes_received": self.bytes_received,
+            "bytes_delivered": self.bytes_delivered,
+            "deliveries": self.deliveries,
+        }
+
+
+class SpectatorEngine:
+    """Each host's spectators, kept in memory and updated as players start &
+    stop spectating, so that frame bundles can be fanned out without asking
+    the users service who is watching.
+
+    Spectator sets expire after `ttl` seconds, so spectators added through
+    another instance of this service are picked up.
+
+    The most recent (encoded) frame bundles of each host are also kept, up
+    to `frame_buffer_size` per host, so that new spectators can catch up
+    without waiting for the host's next bundle. All hosts' buffers share a
+    budget of `frame_buffer_budget` bytes; the least recently used hosts'
+    buffers are evicted to stay within it.
+    """
+
+    def __init__(self, ttl: float, max_size: int, frame_buffer_size: int,
+                 frame_buffer_budget: int) -> None:
+        # host session id -> {spectator session id: spectator account id}
+        self._spectators: TTLCache[UUID, dict[UUID, int]] = TTLCache(
+            "spectators.sets", ttl=ttl, max_size=max_size)
+
+        self._host_stats: dict[UUID, HostStats] = {}
+
+        # host session id -> recent SPECTATE_FRAMES packets, least recently
+        # used host first
+        self.frame_buffer_size = frame_buffer_size
+        self.frame_buffer_budget = frame_buffer_budget
+        self._frame_buffers: OrderedDict[UUID, deque[bytes]] = OrderedDict()
+        self._frame_buffer_bytes = 0
+
+    def register_gauges(self) -> None:
+        self._spectators.register_gauges()
+        metrics.register_gauge("spectators.hosts", self.get_host_stats)
+        metrics.register_gauge("spectators.frame_buffer_bytes",
+                               lambda: self._frame_buffer_bytes)
+        metrics.register_gauge("spectators.frame_buffer_hosts",
+                               lambda: len(self._frame_buffers))
+
+    def unregister_gauges(self) -> None:
+        self._spectators.unregister_gauges()
+        metrics.unregister_gauge("spectators.hosts")
+        metrics.unregister_gauge("spectators.frame_buffer_bytes")
+        metrics.unregister_gauge("spectators.frame_buffer_hosts")
+
+    def get_host_stats(self) -> dict[str, dict[str, int]]:
+        # (by account id; session ids are bearer tokens, and mustn't be
+        # exported)
+        return {str(stats.account_id): stats.to_dict()
+                for stats in self._host_stats.values()}
+
+    async def get_spectators(self, users_client: UsersClient,
+                             host_session_id: UUID) -> dict[UUID, int] | None:
+        """A host's spectators, as {session id: account id}."""
+        spectators = self._spectators.get(host_session_id)
+        if spectators is not None:
+            return spectators
+
+        # (a miss is when other hosts' sets may have expired too)
+        self._prune_host_stats(keep=host_session_id)
+
+        fetched_spectators = await users_client.get_spectators(host_session_id)
+        if fetched_spectators is None:
+            return None
+
+        spectators = {spectator.session_id: spectator.account_id
+                      for spectator in fetched_spectators}
+        self._spectators.set(host_session_id, spectators)
+        return spectators
+
+    def add_spectator(self, host_session_id: UUID, session_id: UUID,
+                      account_id: int) -> None:
+        # (if the host isn't cached, the next fetch will include them)
+        spectators = self._spectators.peek(host_session_id)
+        if spectators is not None:
+            spectators[session_id] = account_id
+
+    def remove_spectator(self, host_session_id: UUID,
+                         session_id: UUID) -> None:
+        spectators = self._spectators.peek(host_session_id)
+        if spectators is not None:
+            spectators.pop(session_id, None)
+            if not spectators:
+                self._host_stats.pop(host_session_id, None)
+
+    def _prune_host_stats(self, keep: UUID) -> None:
+        """Forget the stats of hosts whose spectators are no longer cached."""
+        for host_session_id in list(self._host_stats):
+            if (host_session_id != keep
+                    and host_session_id not in self._spectators):
+                del self._host_stats[host_session_id]
+
+    def remove_host(self, host_session_id: UUID) -> None:
+        self._spectators.pop(host_session_id)
+        self._host_stats.pop(host_session_id, None)
+        self._drop_frame_buffer(host_session_id)
+
+    def _drop_frame_buffer(self, host_session_id: UUID) -> None:
+        frame_buffer = self._frame_buffers.pop(host_session_id, None)
+        if frame_buffer is not None:
+            self._frame_buffer_bytes -= sum(map(len, frame_buffer))
+
+    def _buffer_frames(self, host_session_id: UUID, data: bytes) -> None:
+        if len(data) > self.frame_buffer_budget:
+            return
+
+        frame_buffer = self._frame_buffers.get(host_session_id)
+        if frame_buffer is None:
+            frame_buffer = self._frame_buffers[host_session_id] = deque()
+        else:
+            self._frame_buffers.move_to_end(host_session_id)
+
+        frame_buffer.append(data)
+        self._frame_buffer_bytes += len(data)
+
+        if len(frame_buffer) > self.frame_buffer_size:
+            self._frame_buffer_bytes -= len(frame_buffer.popleft())
+
+        while self._frame_buffer_bytes > self.frame_buffer_budget:
+            evicted_host_session_id = next(iter(self._frame_buffers))
+            if evicted_host_session_id == host_session_id:
+                # (we're the only host left; trim our own oldest bundles)
+                self._frame_buffer_bytes -= len(frame_buffer.popleft())
+            else:
+                self._drop_frame_buffer(evicted_host_session_id)
+                metrics.increment("spectators.frame_buffer_evictions")
+
+    def get_buffered_frames(self, host_session_id: UUID) -> bytes:
+        """A host's most recent SPECTATE_FRAMES packets, oldest first."""
+        frame_buffer = self._frame_buffers.get(host_session_id)
+        if frame_buffer is None:
+            return b""
+
+        self._frame_buffers.move_to_end(host_session_id)
+        return b"".join(frame_buffer)
+
+    async def broadcast_frames(self, ctx: Context, host_session_id: UUID,
+                               host_account_id: int,
+                               frame_bundle: bytes) -> bool:
+        """Encode a host's frame bundle once, and deliver that one buffer to
+        all of their spectators; returns False if they couldn't be
+        fetched."""
+        users_client = UsersClient(ctx.http_client)
+
+        spectators = await self.get_spectators(users_client, host_session_id)
+        if spectators is None:
+            return False
+
+        stats = self._host_stats.get(host_session_id)
+        if stats is None:
+            stats = self._host_stats[host_session_id] = HostStats(
+                host_account_id)
+
+        stats.frame_bundles += 1
+        stats.bytes_received += len(frame_bundle)
+        metrics.increment("spectators.frame_bundles")
+
+        data = serial.write_spectate_frames_packet(frame_bundle)
+        self._buffer_frames(host_session_id, data)
+
+        if not spectators:
+            return True
+
+        await delivery.multicast(ctx, data, spectators)
+        delivered = len(spectators)
+
+        stats.deliveries += delivered
+        stats.bytes_delivered += delivered * len(data)
+        metrics.increment("spectators.deliveries", delivered)
+        metrics.increment("spectators.bytes_delivered", delivered * len(data))
+
+        return True
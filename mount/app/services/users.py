@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+from typing import Any
+from typing import NamedTuple
+from uuid import UUID
+
+from app.common import serial
+from app.common.cache import TTLCache
+from app.services.loaders import BatchLoader
+from shared_modules.api.rest.v1.users import UsersClient
+
+# the key of the cached get_all_presences() result
+ALL_PRESENCES = "all"
+
+
+class CachedAccount(NamedTuple):
+    account_id: int
+    username: str
+    privileges: int
+
+    # the username, as sent in SEND_MESSAGE packets
+    encoded_username: bytes
+
+
+class UsersCache:
+    """A read-through cache of presences, stats & accounts in front of
+    UsersClient.
+
+    Entries expire after their TTL, so changes made by other services (or
+    other instances of this one) are seen eventually; presence writes made
+    through the cache take effect on it immediately.
+
+    Stats & account misses go through batch loaders, so concurrent misses
+    for the same keys share their upstream calls.
+    """
+
+    def __init__(self, presence_ttl: float, stats_ttl: float,
+                 account_ttl: float, max_size: int,
+                 concurrency_limit: int) -> None:
+        self.presences: TTLCache[UUID, Any] = TTLCache(
+            "users_cache.presences", ttl=presence_ttl, max_size=max_size)
+        self.all_presences: TTLCache[str, list[Any]] = TTLCache(
+            "users_cache.all_presences", ttl=presence_ttl, max_size=1)
+        # (account id, game mode) -> stats
+        self.stats: TTLCache[tuple[int, int], Any] = TTLCache(
+            "users_cache.stats", ttl=stats_ttl, max_size=max_size)
+        self.accounts: TTLCache[int, CachedAccount] = TTLCache(
+            "users_cache.accounts", ttl=account_ttl, max_size=max_size)
+
+        self.stats_loader: BatchLoader[tuple[int, int], Any] = BatchLoader(
+            "users_cache.stats_loader",
+            lambda users_client, key: users_client.get_stats(*key),
+            concurrency_limit=concurrency_limit)
+        self.account_loader: BatchLoader[int, Any] = BatchLoader(
+            "users_cache.account_loader",
+            lambda users_client, key: users_client.get_account(key),
+            concurrency_limit=concurrency_limit)
+
+    def register_gauges(self) -> None:
+        self.presences.register_gauges()
+        self.all_presences.register_gauges()
+        self.stats.register_gauges()
+        self.accounts.register_gauges()
+
+    def unregister_gauges(self) -> None:
+        self.presences.unregister_gauges()
+        self.all_presences.unregister_gauges()
+        self.stats.unregister_gauges()
+        self.accounts.unregister_gauges()
+
+    # reads
+
+    async def get_all_presences(self, users_client: UsersClient
+                                ) -> list[Any] | None:
+        presences = self.all_presences.get(ALL_PRESENCES)
+        if presences is not None:
+            return presences
+
+        presences = await users_client.get_all_presences()
+        if presences is None:
+            return None
+
+        self.all_presences.set(ALL_PRESENCES, presences)
+        return presences
+
+    async def get_presence(self, users_client: UsersClient,
+                           session_id: UUID) -> Any | None:
+        presence = self.presences.get(session_id)
+        if presence is not None:
+            return presence
+
+        presence = await users_client.get_presence(session_id)
+        if presence is None:
+            return None
+
+        self.presences.set(session_id, presence)
+        return presence
+
+    async def get_stats(self, users_client: UsersClient, account_id: int,
+                        game_mode: int) -> Any | None:
+        stats = self.stats.get((account_id, game_mode))
+        if stats is not None:
+            return stats
+
+        stats = await self.stats_loader.load(users_client,
+                                             (account_id, game_mode))
+        if stats is None:
+            return None
+
+        self.stats.set((account_id, game_mode), stats)
+        return stats
+
+    async def get_account(self, users_client: UsersClient,
+                          account_id: int) -> CachedAccount | None:
+        account = self.accounts.get(account_id)
+        if account is not None:
+            return account
+
+        fetched_account = await self.account_loader.load(users_client,
+                                                         account_id)
+        if fetched_account is None:
+            return None
+
+        account = CachedAccount(
+            account_id=fetched_account.account_id,
+            username=fetched_account.username,
+            privileges=fetched_account.privileges,
+            encoded_username=bytes(serial.pack_string(
+                fetched_account.username)))
+        self.accounts.set(account_id, account)
+        return account
+
+    # writes
+
+    async def create_presence(self, users_client: UsersClient,
+                              session_id: UUID, **kwargs: Any) -> Any | None:
+        presence = await users_client.create_presence(session_id, **kwargs)
+        self.invalidate_presence(session_id)
+        if presence is None:
+            return None
+
+        self.presences.set(session_id, presence)
+        return presence
+
+    async def partial_update_presence(self, users_client: UsersClient,
+                                      session_id: UUID, **kwargs: Any
+                                      ) -> Any | None:
+        presence = await users_client.partial_update_presence(session_id,
+                                                              **kwargs)
+        self.invalidate_presence(session_id)
+        if presence is None:
+            return None
+
+        self.presences.set(session_id, presence)
+        return presence
+
+    async def delete_presence(self, users_client: UsersClient,
+                              session_id: UUID) -> Any | None:
+        presence = await users_client.delete_presence(session_id)
+        self.invalidate_presence(session_id)
+        return presence
+
+    # invalidation
+
+    def invalidate_presence(self, session_id: UUID) -> None:
+        self.presences.pop(session_id)
+        self.all_presences.clear()
+
+    def invalidate_stats(self, account_id: int, game_mode: int) -> None:
+        self.stats.pop((account_id, game_mode))
+
+    def invalidate_account(self, account_id: int) -> None:
+        self.accounts.pop(account_id)
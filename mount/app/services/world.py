@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import asyncio
+from itertools import chain
+from typing import Any
+from typing import Iterable
+from uuid import UUID
+
+from app.common import metrics
+from app.common import serial
+from app.common.concurrency import gather_bounded
+from shared_modules import logger
+from shared_modules.api.rest.v1.users import UsersClient
+
+
+# TODO: privileges & global player rankings
+
+def is_restricted(server_privileges: int) -> bool:
+    return False
+
+
+def to_client_privileges(server_privileges: int) -> int:
+    return server_privileges & 0xff
+
+
+def get_global_rank(account_id: int) -> int:
+    return 0
+
+
+def get_account_id(presence_data: bytes) -> int:
+    """The account id of a USER_PRESENCE (or USER_STATS) packet."""
+    return serial.INT32_STRUCT.unpack_from(presence_data,
+                                           serial.PACKET_HEADER.size)[0]
+
+
+class PresenceFilters:
+    # which players' presence & stats updates a client wants
+    NONE = 0
+    ALL = 1
+    FRIENDS = 2
+
+
+def write_user_presence_packet(presence: Any) -> bytes:
+    return serial.write_user_presence_packet(
+        account_id=presence.account_id,
+        username=presence.username,
+        utc_offset=presence.utc_offset,
+        country_code=presence.country_code,
+        bancho_privileges=to_client_privileges(presence.privileges),
+        mode=presence.game_mode,
+        latitude=presence.latitude,
+        longitude=presence.longitude,
+        global_rank=get_global_rank(presence.account_id))
+
+
+def write_user_stats_packet(presence: Any, stats: Any) -> bytes:
+    return serial.write_user_stats_packet(
+        account_id=presence.account_id,
+        action=presence.action,
+        info_text=presence.info_text,
+        map_md5=presence.map_md5,
+        mods=presence.mods,
+        mode=presence.game_mode,
+        map_id=presence.map_id,
+        ranked_score=stats.ranked_score,
+        accuracy=stats.accuracy,
+        play_count=stats.play_count,
+        total_score=stats.total_score,
+        global_rank=get_global_rank(presence.account_id),
+        pp=stats.performance)
+
+
+class WorldSnapshot:
+    """The USER_PRESENCE & USER_STATS packets of every online player,
+    pre-encoded and kept up to date as players log in, change action and
+    log out, so that a login can send them all in one copy, and presence
+    requests can be answered without asking the users service.
+
+    The snapshot is periodically rebuilt from the users service so that it
+    can't drift (e.g. from sessions which expired, or which were handled by
+    another instance of this service).
+
+    Each player's presence filter is also kept, indexed by filter, so that
+    presence & stats updates are only sent to the players who want them.
+    Players default to all updates until they tell us otherwise (e.g. those
+    which logged in through another instance of this service).
+    """
+
+    def __init__(self) -> None:
+        self.version = 0
+        self.synced = False
+
+        # session id -> (presence packet, stats packet)
+        self._players: dict[UUID, tuple[bytes, bytes]] = {}
+
+        # session id -> presence filter, and presence filter -> session ids
+        self._presence_filters: dict[UUID, int] = {}
+        self._filter_groups: dict[int, set[UUID]] = {
+            PresenceFilters.NONE: set(),
+            PresenceFilters.ALL: set(),
+            PresenceFilters.FRIENDS: set(),
+        }
+
+        # account id -> session id
+        self._account_sessions: dict[int, UUID] = {}
+
+        # session id -> the account ids of their friends
+        self._friends: dict[UUID, frozenset[int]] = {}
+
+        self._packets = b""
+        self._packets_version = 0
+
+        # sessions updated while a resync is in progress
+        self._resync_lock = asyncio.Lock()
+        self._updated_during_resync: set[UUID] | None = None
+
+    def __len__(self) -> int:
+        return len(self._players)
+
+    def _updated(self, session_id: UUID) -> None:
+        self.version += 1
+        if self._updated_during_resync is not None:
+            self._updated_during_resync.add(session_id)
+
+    def set_player(self, session_id: UUID, presence_data: bytes,
+                   stats_data: bytes) -> None:
+        self._players[session_id] = (presence_data, stats_data)
+        self._account_sessions[get_account_id(presence_data)] = session_id
+        if session_id not in self._presence_filters:
+            self._set_filter_group(session_id, PresenceFilters.ALL)
+        self._updated(session_id)
+
+    def _set_filter_group(self, session_id: UUID, presence_filter: int) -> None:
+        previous_filter = self._presence_filters.get(session_id)
+        if previous_filter is not None:
+            self._filter_groups[previous_filter].discard(session_id)
+
+        self._presence_filters[session_id] = presence_filter
+        self._filter_groups[presence_filter].add(session_id)
+
+    def _remove_from_filter_groups(self, session_id: UUID) -> None:
+        presence_filter = self._presence_filters.pop(session_id, None)
+        if presence_filter is not None:
+            self._filter_groups[presence_filter].discard(session_id)
+        self._friends.pop(session_id, None)
+
+    def set_presence_filter(self, session_id: UUID,
+                            presence_filter: int) -> None:
+        if session_id in self._players:
+            self._set_filter_group(session_id, presence_filter)
+
+    def set_friends(self, session_id: UUID, friends: Iterable[int]) -> None:
+        self._friends[session_id] = frozenset(friends)
+
+    def get_presence_recipients(self, account_id: int,
+                                exclude: UUID | None = None
+                                ) -> list[UUID] | None:
+        """The sessions which want presence & stats updates of an account,
+        or None (for every online session) if we haven't synced yet."""
+        if not self.synced:
+            return None
+
+        recipients = [session_id
+                      for session_id in self._filter_groups[PresenceFilters.ALL]
+                      if session_id != exclude]
+        recipients.extend(
+            session_id
+            for session_id in self._filter_groups[PresenceFilters.FRIENDS]
+            if (session_id != exclude
+                and account_id in self._friends.get(session_id, ())))
+
+        metrics.increment("world.presence_recipients", len(recipients))
+        metrics.increment("world.presence_recipients_filtered",
+                          len(self._players) - len(recipients)
+                          - (exclude in self._players))
+        return recipients
+
+    def set_player_stats(self, session_id: UUID, stats_data: bytes,
+                         presence_data: bytes | None = None) -> None:
+        """Update a player's stats, and their presence if it's given (e.g.
+        their game mode, which it includes, has changed)."""
+        player = self._players.get(session_id)
+        if player is None:
+            return
+
+        if presence_data is None:
+            presence_data = player[0]
+
+        self._players[session_id] = (presence_data, stats_data)
+        self._updated(session_id)
+
+    def remove_player(self, session_id: UUID) -> None:
+        player = self._players.pop(session_id, None)
+        if player is not None:
+            account_id = get_account_id(player[0])
+            if self._account_sessions.get(account_id) == session_id:
+                del self._account_sessions[account_id]
+            self._updated(session_id)
+        self._remove_from_filter_groups(session_id)
+
+    def account_ids(self, exclude_session_id: UUID | None = None
+                    ) -> list[int]:
+        return [account_id
+                for account_id, session_id in self._account_sessions.items()
+                if session_id != exclude_session_id]
+
+    def get_presence_packets(self, account_ids: Iterable[int]
+                             ) -> tuple[bytes, list[int]]:
+        """The presence packets of some accounts, along with the ids of
+        those which aren't in the snapshot."""
+        packets: list[bytes] = []
+        missing_account_ids: list[int] = []
+
+        for account_id in account_ids:
+            session_id = self._account_sessions.get(account_id)
+            if session_id is None:
+                missing_account_ids.append(account_id)
+                continue
+
+            packets.append(self._players[session_id][0])
+
+        return b"".join(packets), missing_account_ids
+
+    def get_packets(self, exclude_session_id: UUID | None = None) -> bytes:
+        """The presence & stats packets of every player in the snapshot."""
+        if exclude_session_id in self._players:
+            return b"".join(chain.from_iterable(
+                packets for session_id, packets in self._players.items()
+                if session_id != exclude_session_id))
+
+        if self._packets_version != self.version:
+            self._packets = b"".join(chain.from_iterable(
+                self._players.values()))
+            self._packets_version = self.version
+
+        return self._packets
+
+    async def resync(self, users_client: UsersClient,
+                     concurrency_limit: int) -> bool:
+        """Rebuild the snapshot from the users service."""
+        async with self._resync_lock:
+            self._updated_during_resync = set()
+            try:
+                presences = await users_client.get_all_presences()
+                if presences is None:
+                    return False
+
+                presences = [presence for presence in presences
+                             if not is_restricted(presence.privileges)]
+
+                all_stats = await gather_bounded(
+                    (users_client.get_stats(presence.account_id,
+                                            presence.game_mode)
+                     for presence in presences),
+                    limit=concurrency_limit)
+
+                players: dict[UUID, tuple[bytes, bytes]] = {}
+                for presence, stats in zip(presences, all_stats):
+                    if stats is None:
+                        return False
+
+                    players[presence.session_id] = (
+                        write_user_presence_packet(presence),
+                        write_user_stats_packet(presence, stats),
+                    )
+
+                # local updates made while we were fetching are newer
+                for session_id in self._updated_during_resync:
+                    packets = self._players.get(session_id)
+                    if packets is not None:
+                        players[session_id] = packets
+                    else:
+                        players.pop(session_id, None)
+
+                self._players = players
+                self._account_sessions = {
+                    get_account_id(presence_data): session_id
+                    for session_id, (presence_data, _) in players.items()
+                }
+
+                for session_id in list(self._presence_filters):
+                    if session_id not in players:
+                        self._remove_from_filter_groups(session_id)
+                for session_id in players:
+                    if session_id not in self._presence_filters:
+                        self._set_filter_group(session_id,
+                                               PresenceFilters.ALL)
+
+                self.version += 1
+                self.synced = True
+                return True
+            finally:
+                self._updated_during_resync = None
+
+    async def run_resync_loop(self, users_client: UsersClient,
+                              interval: float,
+                              concurrency_limit: int) -> None:
+        while True:
+            try:
+                synced = await self.resync(users_client, concurrency_limit)
+            except Exception as exc:
+                logger.error("Failed to resync world snapshot",
+                             error=str(exc))
+            else:
+                if synced:
+                    logger.debug("Resynced world snapshot",
+                                 players=len(self), version=self.version)
+                else:
+                    logger.warning("Failed to resync world snapshot")
+
+            await asyncio.sleep(interval)
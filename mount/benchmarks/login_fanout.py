@@ -0,0 +1,197 @@
+"""Measure /v1/login with 100, 1,000 and 5,000 players online, against
+local stand-ins for the users & chats services.
+
+The first login on an instance rebuilds the world snapshot (a get_stats
+per online player); it's timed with the upstream fan-out done one request
+at a time and with UPSTREAM_CONCURRENCY_LIMIT at once. Later logins are
+served from the snapshot; they're timed with each LOGIN_PRESENCES mode.
+
+The real login() is driven through a stub request & context. shared_modules
+isn't needed; it's replaced by stubs (see benchmarks.stubs) before the app
+is imported. The app does import app.common.settings, so the service's
+environment (see docker-compose.yml) must be set.
+
+usage: python -m benchmarks.login_fanout [population ...]
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import sys
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any
+from uuid import UUID
+
+from benchmarks.stubs import install_stub_shared_modules
+
+UPSTREAM_LATENCY = 0.002  # seconds, per request
+CONCURRENCY_LIMIT = 32
+WARM_LOGINS = 20
+
+LOGIN_BODY = (b"benchmark\n" + b"0" * 32 + b"\n"
+              b"b20220101|0|0|a:b:c:d:e:|0\n")
+
+
+def make_presence(session_id: UUID, account_id: int,
+                  **kwargs: Any) -> SimpleNamespace:
+    fields = dict(account_id=account_id, username=f"player{account_id}",
+                  utc_offset=0, country_code=38, privileges=1, game_mode=0,
+                  latitude=0.0, longitude=0.0, action=0, info_text="",
+                  map_md5="", map_id=0, mods=0)
+    fields.update(kwargs)
+    return SimpleNamespace(session_id=session_id, **fields)
+
+
+class StandInService:
+    """Answers after a fixed latency, and tracks how many requests it is
+    serving at once."""
+
+    def __init__(self, presences: list[SimpleNamespace]) -> None:
+        self.presences = presences
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def request(self) -> None:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(UPSTREAM_LATENCY)
+        finally:
+            self.in_flight -= 1
+
+
+class StandInUsersClient:
+    """Takes the place of shared_modules' UsersClient; the context's http
+    client is the stand-in service it talks to."""
+
+    def __init__(self, service: StandInService) -> None:
+        self.service = service
+
+    async def get_all_presences(self, username: str | None = None
+                                ) -> list[SimpleNamespace]:
+        await self.service.request()
+        # (whoever is logging in isn't online yet)
+        return [] if username is not None else self.service.presences
+
+    async def log_in(self, username: str, password_md5: str,
+                     user_agent: str) -> SimpleNamespace:
+        await self.service.request()
+        return SimpleNamespace(session_id=uuid.uuid4(),
+                               account_id=random.randrange(1_000_000))
+
+    async def create_presence(self, session_id: UUID,
+                              **kwargs: Any) -> SimpleNamespace:
+        await self.service.request()
+        return make_presence(session_id, **kwargs)
+
+    async def get_stats(self, account_id: int,
+                        game_mode: int) -> SimpleNamespace:
+        await self.service.request()
+        return SimpleNamespace(ranked_score=0, accuracy=0.0, play_count=0,
+                               total_score=0, performance=0)
+
+
+class StandInChatsClient:
+    def __init__(self, service: StandInService) -> None:
+        self.service = service
+
+    async def get_chats(self) -> list[Any]:
+        await self.service.request()
+        return []
+
+
+class StubRequest:
+    async def body(self) -> bytes:
+        return LOGIN_BODY
+
+
+async def main() -> int:
+    install_stub_shared_modules(StandInUsersClient, StandInChatsClient)
+
+    from app.api.rest.v1.bancho import login
+    from app.api.rest.v1.bancho import LOGIN_PRESENCES_BUNDLE
+    from app.api.rest.v1.bancho import LOGIN_PRESENCES_FULL
+    from app.common import settings
+    from app.services.channels import ChannelDirectory
+    from app.services.dispatcher import BroadcastDispatcher
+    from app.services.users import UsersCache
+    from app.services.world import WorldSnapshot
+
+    def make_context(service: StandInService,
+                     concurrency_limit: int) -> SimpleNamespace:
+        return SimpleNamespace(
+            http_client=service,
+            users_cache=UsersCache(presence_ttl=60, stats_ttl=60,
+                                   account_ttl=60, max_size=100_000,
+                                   concurrency_limit=concurrency_limit),
+            channel_directory=ChannelDirectory(),
+            world_snapshot=WorldSnapshot(),
+            # (no workers; the broadcasts are only queued)
+            broadcast_dispatcher=BroadcastDispatcher(
+                workers=1, max_queue_size=WARM_LOGINS + 1, max_attempts=1,
+                retry_delay=0))
+
+    async def timed_login(ctx: SimpleNamespace) -> tuple[float, int]:
+        start = time.perf_counter()
+        response = await login(StubRequest(), ctx)  # type: ignore[arg-type]
+        elapsed_ms = (time.perf_counter() - start) * 1e3
+        return elapsed_ms, len(response.body)
+
+    async def cold_login(presences: list[SimpleNamespace],
+                         concurrency_limit: int) -> tuple[float, int]:
+        settings.UPSTREAM_CONCURRENCY_LIMIT = concurrency_limit
+        service = StandInService(presences)
+        elapsed_ms, _ = await timed_login(
+            make_context(service, concurrency_limit))
+        return elapsed_ms, service.max_in_flight
+
+    async def warm_logins(presences: list[SimpleNamespace],
+                          login_presences: str) -> tuple[float, int]:
+        settings.LOGIN_PRESENCES = login_presences
+        ctx = make_context(StandInService(presences), CONCURRENCY_LIMIT)
+        await timed_login(ctx)
+
+        total_ms = 0.0
+        for _ in range(WARM_LOGINS):
+            elapsed_ms, size = await timed_login(ctx)
+            total_ms += elapsed_ms
+        return total_ms / WARM_LOGINS, size
+
+    populations = [int(arg) for arg in sys.argv[1:]] or [100, 1_000, 5_000]
+
+    print(f"upstream latency {UPSTREAM_LATENCY * 1e3:.1f}ms, "
+          f"concurrency limit {CONCURRENCY_LIMIT}")
+    print(f"{'presences':>10} {'cold, 1 (ms)':>13} "
+          f"{f'cold, {CONCURRENCY_LIMIT} (ms)':>14} {'max in flight':>14} "
+          f"{'full (ms)':>10} {'full (bytes)':>13} "
+          f"{'bundle (ms)':>12} {'bundle (bytes)':>15}")
+    for count in populations:
+        presences = [make_presence(uuid.uuid4(), account_id)
+                     for account_id in random.sample(range(1_000_000),
+                                                     count)]
+
+        sequential_ms, _ = await cold_login(presences, 1)
+        concurrent_ms, max_in_flight = await cold_login(presences,
+                                                        CONCURRENCY_LIMIT)
+        full_ms, full_size = await warm_logins(presences,
+                                               LOGIN_PRESENCES_FULL)
+        bundle_ms, bundle_size = await warm_logins(presences,
+                                                   LOGIN_PRESENCES_BUNDLE)
+
+        if max_in_flight > CONCURRENCY_LIMIT:
+            print(f"{count}: the concurrency limit was exceeded!")
+            return 1
+
+        print(f"{count:>10} {sequential_ms:>13.1f} {concurrent_ms:>14.1f} "
+              f"{max_in_flight:>14} {full_ms:>10.2f} {full_size:>13} "
+              f"{bundle_ms:>12.2f} {bundle_size:>15}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main()))
@@ -0,0 +1,120 @@
+"""Compare the json and binary packet queue transports: bytes on the wire
+and CPU time per enqueue & dequeue, for a few realistic packet mixes.
+
+The json transport sends each payload as `{"data": [int, ...]}` and
+dequeues a list of such objects; the binary transport sends the raw
+payload and dequeues length-prefixed entries.
+
+usage: python -m benchmarks.queue_transport
+"""
+from __future__ import annotations
+
+import json
+import os
+import random
+import timeit
+from typing import Any
+
+from app.common import serial
+
+# entries in a session's queue between two of its /v1/bancho polls
+QUEUE_DEPTH = 20
+
+
+def make_stats(rng: random.Random) -> bytes:
+    return serial.write_user_stats_packet(
+        account_id=rng.randint(1000, 100_000), action=rng.randint(0, 13),
+        info_text="Cool Artist - Cool Song [Insane]",
+        map_md5="1cf5b2c2edfafd055536d2cefcb89c0e", mods=72, mode=0,
+        map_id=rng.randint(0, 4_000_000), ranked_score=rng.randint(0, 10**11),
+        accuracy=rng.uniform(50, 100), play_count=rng.randint(0, 100_000),
+        total_score=rng.randint(0, 10**12), global_rank=rng.randint(1, 10**6),
+        pp=rng.randint(0, 20_000))
+
+
+def make_message(rng: random.Random) -> bytes:
+    return serial.write_send_message_packet(
+        sender=f"player{rng.randint(0, 10_000)}",
+        message="hello! " * rng.randint(1, 10), recipient="#osu",
+        sender_id=rng.randint(1000, 100_000))
+
+
+def make_spectate_frames(rng: random.Random) -> bytes:
+    # frame bundles are passed through as the host sent them
+    return serial.write_spectate_frames_packet(
+        os.urandom(rng.randint(1_000, 8_000)))
+
+
+MIXES = {
+    "stats": (make_stats,),
+    "chat": (make_message, make_stats),
+    "spectating": (make_spectate_frames,),
+}
+
+
+def json_enqueue(data: bytes) -> bytes:
+    return json.dumps({"data": list(data)}).encode()
+
+
+def binary_enqueue(data: bytes) -> bytes:
+    # (the payload is the request body, as it is)
+    return bytes(data)
+
+
+def json_dequeue(body: bytes) -> bytes:
+    return b"".join(bytes(entry["data"]) for entry in json.loads(body))
+
+
+def json_dequeue_body(entries: list[bytes]) -> bytes:
+    return json.dumps([{"data": list(entry)} for entry in entries]).encode()
+
+
+def time_us(func: Any, *args: Any, number: int) -> float:
+    return min(timeit.repeat(lambda: func(*args), repeat=3,
+                             number=number)) / number * 1e6
+
+
+def main() -> int:
+    print(f"queue depth {QUEUE_DEPTH} entries")
+    print(f"{'mix':>11} {'transport':>10} {'enqueue (B)':>12} "
+          f"{'dequeue (B)':>12} {'enqueue (us)':>13} {'dequeue (us)':>13}")
+    for name, makers in MIXES.items():
+        rng = random.Random(name)
+        entries = [rng.choice(makers)(rng) for _ in range(QUEUE_DEPTH)]
+        expected = b"".join(entries)
+
+        json_body = json_dequeue_body(entries)
+        binary_body = serial.pack_queued_packets(entries)
+        if (json_dequeue(json_body) != expected
+                or serial.unpack_queued_packets(binary_body) != expected):
+            print(f"{name}: transports disagree!")
+            return 1
+
+        number = 200
+        json_enqueue_bytes = sum(len(json_enqueue(entry)) for entry in entries)
+        json_enqueue_us = time_us(lambda: [json_enqueue(entry)
+                                           for entry in entries],
+                                  number=number) / QUEUE_DEPTH
+        json_dequeue_us = time_us(json_dequeue, json_body, number=number)
+
+        binary_enqueue_bytes = sum(len(binary_enqueue(entry))
+                                   for entry in entries)
+        binary_enqueue_us = time_us(lambda: [binary_enqueue(entry)
+                                             for entry in entries],
+                                    number=number) / QUEUE_DEPTH
+        binary_dequeue_us = time_us(serial.unpack_queued_packets,
+                                    binary_body, number=number)
+
+        print(f"{name:>11} {'json':>10} "
+              f"{json_enqueue_bytes // QUEUE_DEPTH:>12} {len(json_body):>12} "
+              f"{json_enqueue_us:>13.2f} {json_dequeue_us:>13.2f}")
+        print(f"{name:>11} {'binary':>10} "
+              f"{binary_enqueue_bytes // QUEUE_DEPTH:>12} "
+              f"{len(binary_body):>12} {binary_enqueue_us:>13.2f} "
+              f"{binary_dequeue_us:>13.2f}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,106 @@
+"""Compare bulk (numpy) USER_PRESENCE + USER_STATS encoding against the
+per-packet writers, at several server populations.
+
+usage: python -m benchmarks.serial_bulk [population ...]
+"""
+from __future__ import annotations
+
+import random
+import sys
+import timeit
+from typing import Any
+
+import numpy
+from app.common import serial
+
+
+def make_columns(count: int) -> tuple[dict[str, list[Any]],
+                                      dict[str, list[Any]]]:
+    rng = random.Random(count)
+    presences: dict[str, list[Any]] = {
+        "account_id": list(range(1000, 1000 + count)),
+        "username": [f"player{i}" for i in range(count)],
+        "utc_offset": [rng.randint(-12, 14) for _ in range(count)],
+        "country_code": [rng.randint(0, 250) for _ in range(count)],
+        "bancho_privileges": [rng.choice((1, 5, 31)) for _ in range(count)],
+        "mode": [rng.randint(0, 3) for _ in range(count)],
+        "latitude": [rng.uniform(-90, 90) for _ in range(count)],
+        "longitude": [rng.uniform(-180, 180) for _ in range(count)],
+        "global_rank": [rng.randint(1, 1_000_000) for _ in range(count)],
+    }
+    stats: dict[str, list[Any]] = {
+        "account_id": presences["account_id"],
+        "action": [rng.randint(0, 13) for _ in range(count)],
+        "info_text": [rng.choice(("", "Cool Artist - Cool Song [Insane]"))
+                      for _ in range(count)],
+        "map_md5": [rng.choice(("", "1cf5b2c2edfafd055536d2cefcb89c0e"))
+                    for _ in range(count)],
+        "mods": [rng.choice((0, 8, 64, 72)) for _ in range(count)],
+        "mode": presences["mode"],
+        "map_id": [rng.randint(0, 4_000_000) for _ in range(count)],
+        "ranked_score": [rng.randint(0, 10**11) for _ in range(count)],
+        "accuracy": [rng.uniform(50, 100) for _ in range(count)],
+        "play_count": [rng.randint(0, 100_000) for _ in range(count)],
+        "total_score": [rng.randint(0, 10**12) for _ in range(count)],
+        "global_rank": presences["global_rank"],
+        "pp": [rng.randint(0, 20_000) for _ in range(count)],
+    }
+    return presences, stats
+
+
+def encode_per_packet(presences: dict[str, list[Any]],
+                      stats: dict[str, list[Any]]) -> bytes:
+    writer = serial.PacketWriter()
+    for row in zip(*presences.values()):
+        writer.write_user_presence(*row)
+    for row in zip(*stats.values()):
+        writer.write_user_stats(*row)
+    return writer.getvalue()
+
+
+def encode_bulk(presences: dict[str, Any], stats: dict[str, Any]) -> bytes:
+    return (serial.write_user_presence_packets(**presences)
+            + serial.write_user_stats_packets(**stats))
+
+
+def to_arrays(columns: dict[str, list[Any]]) -> dict[str, Any]:
+    """Fixed-width columns as numpy arrays, the way a columnar caller (such
+    as a snapshot of all presences) would hold them."""
+    return {name: (values if isinstance(values[0], str)
+                   else numpy.asarray(values))
+            for name, values in columns.items()}
+
+
+def main() -> int:
+    populations = [int(arg) for arg in sys.argv[1:]] or [1_000, 10_000, 50_000]
+
+    print(f"{'presences':>10} {'per-packet (ms)':>16} "
+          f"{'bulk, lists (ms)':>17} {'bulk, arrays (ms)':>18} {'speedup':>8}")
+    for count in populations:
+        presences, stats = make_columns(count)
+        presence_arrays, stats_arrays = to_arrays(presences), to_arrays(stats)
+
+        expected = encode_per_packet(presences, stats)
+        if (encode_bulk(presences, stats) != expected
+                or encode_bulk(presence_arrays, stats_arrays) != expected):
+            print(f"{count}: encoders disagree!")
+            return 1
+
+        number = max(1, 10_000 // count)
+
+        def time_ms(func: Any, *args: Any) -> float:
+            return min(timeit.repeat(lambda: func(*args), repeat=3,
+                                     number=number)) / number * 1e3
+
+        per_packet_ms = time_ms(encode_per_packet, presences, stats)
+        bulk_lists_ms = time_ms(encode_bulk, presences, stats)
+        bulk_arrays_ms = time_ms(encode_bulk, presence_arrays, stats_arrays)
+        print(f"{count:>10} {per_packet_ms:>16.2f} {bulk_lists_ms:>17.2f} "
+              f"{bulk_arrays_ms:>18.2f} "
+              f"{per_packet_ms / bulk_arrays_ms:>7.2f}x")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,243 @@
+"""Compare the schema-compiled packet encoders in app.common.serial against
+the original field-by-field concatenating encoders.
+
+usage: python -m benchmarks.serial_encoders [iterations]
+"""
+from __future__ import annotations
+
+import sys
+import timeit
+from typing import Any
+from typing import Callable
+
+from app.common import serial
+from app.common.serial import pack_float32
+from app.common.serial import pack_int16
+from app.common.serial import pack_int32
+from app.common.serial import pack_int64
+from app.common.serial import pack_string
+from app.common.serial import pack_uint16
+from app.common.serial import pack_uint32
+from app.common.serial import pack_uint8
+from app.common.serial import ServerPackets
+
+
+# the original encoders, kept here as the baseline
+
+def legacy_write_packet(packet_id: int, data: bytes = b"") -> bytes:
+    return pack_uint16(packet_id) + b"\x00" + pack_uint32(len(data)) + data
+
+
+def legacy_write_int32_packet(packet_id: int) -> Callable[[int], bytes]:
+    def write(value: int) -> bytes:
+        return legacy_write_packet(packet_id, pack_int32(value))
+    return write
+
+
+def legacy_write_string_packet(packet_id: int) -> Callable[[str], bytes]:
+    def write(value: str) -> bytes:
+        return legacy_write_packet(packet_id, pack_string(value))
+    return write
+
+
+def legacy_write_send_message_packet(sender: str, message: str,
+                                     recipient: str, sender_id: int) -> bytes:
+    data = pack_string(sender) + pack_string(message) + \
+        pack_string(recipient) + pack_int32(sender_id)
+    return legacy_write_packet(ServerPackets.SEND_MESSAGE, data)
+
+
+def legacy_write_pong_packet() -> bytes:
+    return legacy_write_packet(ServerPackets.PONG)
+
+
+def legacy_write_channel_info_packet(channel: str, topic: str,
+                                     user_count: int) -> bytes:
+    data = pack_string(channel) + pack_string(topic) + pack_uint16(user_count)
+    return legacy_write_packet(ServerPackets.CHANNEL_INFO, data)
+
+
+def legacy_write_channel_auto_join_packet(channel: str, topic: str,
+                                          user_count: int) -> bytes:
+    data = pack_string(channel) + pack_string(topic) + pack_uint16(user_count)
+    return legacy_write_packet(ServerPackets.CHANNEL_AUTO_JOIN, data)
+
+
+def legacy_write_channel_info_end_packet() -> bytes:
+    return legacy_write_packet(ServerPackets.CHANNEL_INFO_END)
+
+
+def legacy_write_main_menu_icon_packet(icon_url: str, onclick_url: str) -> bytes:
+    data = pack_string(icon_url + "|" + onclick_url)
+    return legacy_write_packet(ServerPackets.MAIN_MENU_ICON, data)
+
+
+def legacy_write_friends_list_packet(friends: list[int]) -> bytes:
+    data = pack_uint16(len(friends))
+    for friend in friends:
+        data += pack_uint32(friend)
+    return legacy_write_packet(ServerPackets.FRIENDS_LIST, data)
+
+
+def legacy_write_spectate_frames_packet(raw_data: bytes) -> bytes:
+    return legacy_write_packet(ServerPackets.SPECTATE_FRAMES, raw_data)
+
+
+def legacy_write_user_logout_packet(user_id: int) -> bytes:
+    data = pack_int32(user_id) + pack_uint8(0)
+    return legacy_write_packet(ServerPackets.USER_LOGOUT, data)
+
+
+def legacy_write_user_stats_packet(account_id: int, action: int,
+                                   info_text: str, map_md5: str, mods: int,
+                                   mode: int, map_id: int, ranked_score: int,
+                                   accuracy: float, play_count: int,
+                                   total_score: int, global_rank: int,
+                                   pp: int) -> bytes:
+    data = (
+        pack_int32(account_id)
+        + pack_uint8(action)
+        + pack_string(info_text)
+        + pack_string(map_md5)
+        + pack_int32(mods)
+        + pack_uint8(mode)
+        + pack_int32(map_id)
+        + pack_int64(ranked_score)
+        + pack_float32(accuracy / 100.0)
+        + pack_int32(play_count)
+        + pack_int64(total_score)
+        + pack_int32(global_rank)
+        + pack_int16(pp))
+    return legacy_write_packet(ServerPackets.USER_STATS, data)
+
+
+def legacy_write_user_presence_packet(account_id: int, username: str,
+                                      utc_offset: int, country_code: int,
+                                      bancho_privileges: int, mode: int,
+                                      latitude: float, longitude: float,
+                                      global_rank: int) -> bytes:
+    data = (
+        pack_int32(account_id)
+        + pack_string(username)
+        + pack_uint8(utc_offset + 24)
+        + pack_uint8(country_code)
+        + pack_uint8(bancho_privileges | (mode << 5))
+        + pack_float32(latitude)
+        + pack_float32(longitude)
+        + pack_int32(global_rank))
+    return legacy_write_packet(ServerPackets.USER_PRESENCE, data)
+
+
+USER_STATS_ARGS = (1000, 2, "Cool Artist - Cool Song [Insane]",
+                   "1cf5b2c2edfafd055536d2cefcb89c0e", 72, 0, 1234567,
+                   123_456_789, 98.76, 4321, 987_654_321, 15, 6543)
+USER_PRESENCE_ARGS = (1000, "cmyui", 2, 38, 0x1f, 0, 48.23, 16.37, 15)
+
+# (packet name, legacy encoder, new encoder, args)
+CASES: list[tuple[str, Callable[..., bytes], Callable[..., bytes], tuple[Any, ...]]] = [
+    ("ACCOUNT_ID",
+     legacy_write_int32_packet(ServerPackets.ACCOUNT_ID),
+     serial.write_account_id_packet, (1000,)),
+    ("SEND_MESSAGE",
+     legacy_write_send_message_packet,
+     serial.write_send_message_packet,
+     ("cmyui", "hello world!", "#osu", 1000)),
+    ("PONG",
+     legacy_write_pong_packet,
+     serial.write_pong_packet, ()),
+    ("PROTOCOL_VERSION",
+     legacy_write_int32_packet(ServerPackets.PROTOCOL_VERSION),
+     serial.write_protocol_version_packet, (19,)),
+    ("PRIVILEGES",
+     legacy_write_int32_packet(ServerPackets.PRIVILEGES),
+     serial.write_privileges_packet, (2_147_483_647,)),
+    ("CHANNEL_JOIN_SUCCESS",
+     legacy_write_string_packet(ServerPackets.CHANNEL_JOIN_SUCCESS),
+     serial.write_channel_join_success_packet, ("#osu",)),
+    ("CHANNEL_KICK",
+     legacy_write_string_packet(ServerPackets.CHANNEL_KICK),
+     serial.write_channel_kick_packet, ("#osu",)),
+    ("CHANNEL_INFO",
+     legacy_write_channel_info_packet,
+     serial.write_channel_info_packet,
+     ("#osu", "General discussion.", 512)),
+    ("CHANNEL_AUTO_JOIN",
+     legacy_write_channel_auto_join_packet,
+     serial.write_channel_auto_join_packet,
+     ("#osu", "General discussion.", 512)),
+    ("CHANNEL_INFO_END",
+     legacy_write_channel_info_end_packet,
+     serial.write_channel_info_end_packet, ()),
+    ("MAIN_MENU_ICON",
+     legacy_write_main_menu_icon_packet,
+     serial.write_main_menu_icon_packet,
+     ("https://akatsuki.pw/static/images/logos/logo.png",
+      "https://akatsuki.pw")),
+    ("FRIENDS_LIST",
+     legacy_write_friends_list_packet,
+     serial.write_friends_list_packet, (list(range(1000, 1050)),)),
+    ("SILENCE_END",
+     legacy_write_int32_packet(ServerPackets.SILENCE_END),
+     serial.write_silence_end_packet, (0,)),
+    ("SPECTATOR_JOINED",
+     legacy_write_int32_packet(ServerPackets.SPECTATOR_JOINED),
+     serial.write_spectator_joined_packet, (1000,)),
+    ("SPECTATOR_LEFT",
+     legacy_write_int32_packet(ServerPackets.SPECTATOR_LEFT),
+     serial.write_spectator_left_packet, (1000,)),
+    ("SPECTATE_FRAMES",
+     legacy_write_spectate_frames_packet,
+     serial.write_spectate_frames_packet, (bytes(2048),)),
+    ("SPECTATOR_CANT_SPECTATE",
+     legacy_write_int32_packet(ServerPackets.SPECTATOR_CANT_SPECTATE),
+     serial.write_spectator_cant_spectate_packet, (1000,)),
+    ("FELLOW_SPECTATOR_JOINED",
+     legacy_write_int32_packet(ServerPackets.FELLOW_SPECTATOR_JOINED),
+     serial.write_fellow_spectator_joined_packet, (1000,)),
+    ("FELLOW_SPECTATOR_LEFT",
+     legacy_write_int32_packet(ServerPackets.FELLOW_SPECTATOR_LEFT),
+     serial.write_fellow_spectator_left_packet, (1000,)),
+    ("USER_LOGOUT",
+     legacy_write_user_logout_packet,
+     serial.write_user_logout_packet, (1000,)),
+    ("USER_STATS",
+     legacy_write_user_stats_packet,
+     serial.write_user_stats_packet, USER_STATS_ARGS),
+    ("USER_PRESENCE",
+     legacy_write_user_presence_packet,
+     serial.write_user_presence_packet, USER_PRESENCE_ARGS),
+    ("RESTART",
+     legacy_write_int32_packet(ServerPackets.RESTART),
+     serial.write_server_restart_packet, (0,)),
+    ("NOTIFICATION",
+     legacy_write_string_packet(ServerPackets.NOTIFICATION),
+     serial.write_notification_packet, ("Welcome to Akatsuki v2!",)),
+]
+
+
+def time_per_call(func: Callable[..., bytes], args: tuple[Any, ...],
+                  iterations: int) -> float:
+    """Best of 5 runs, in nanoseconds per call."""
+    timer = timeit.Timer(lambda: func(*args))
+    return min(timer.repeat(repeat=5, number=iterations)) / iterations * 1e9
+
+
+def main() -> int:
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    print(f"{'packet':<25} {'legacy (ns)':>12} {'schema (ns)':>12} {'speedup':>8}")
+    for name, legacy_encoder, new_encoder, args in CASES:
+        if bytes(legacy_encoder(*args)) != new_encoder(*args):
+            print(f"{name}: encoders disagree!")
+            return 1
+
+        legacy_ns = time_per_call(legacy_encoder, args, iterations)
+        new_ns = time_per_call(new_encoder, args, iterations)
+        print(f"{name:<25} {legacy_ns:>12.1f} {new_ns:>12.1f} "
+              f"{legacy_ns / new_ns:>7.2f}x")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
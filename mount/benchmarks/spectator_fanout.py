@@ -0,0 +1,147 @@
+"""Measure the fan-out of one host's frame bundles to 1, 10 and 100
+spectators: the previous handler (get_spectators + a sequential enqueue of
+a fresh list per spectator, every bundle) against the spectator engine's
+broadcast_frames (cached spectators, one encoding, held in the outbox and
+flushed as bounded concurrent enqueues), against a local stand-in for the
+users service.
+
+The engine is driven through a stub context. shared_modules isn't needed;
+it's replaced by stubs (see benchmarks.stubs) before the engine is
+imported. The engine does import app.common.settings, so the service's
+environment (see docker-compose.yml) must be set.
+
+usage: python -m benchmarks.spectator_fanout [spectators ...]
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import time
+import uuid
+from typing import Any
+from typing import NamedTuple
+from uuid import UUID
+
+from app.common import serial
+from benchmarks.stubs import install_stub_shared_modules
+
+UPSTREAM_LATENCY = 0.001  # seconds, per request
+FRAME_BUNDLES = 20
+FRAME_BUNDLE_SIZE = 2_000  # bytes
+
+
+class Spectator(NamedTuple):
+    session_id: UUID
+    account_id: int
+
+
+class StandInUsersService:
+    def __init__(self, spectators: list[Spectator]) -> None:
+        self.spectators = spectators
+        self.requests = 0
+        self.bytes_sent = 0
+
+
+class StandInUsersClient:
+    """Takes the place of shared_modules' UsersClient; the context's http
+    client is the stand-in service it talks to."""
+
+    def __init__(self, service: StandInUsersService) -> None:
+        self.service = service
+
+    async def get_spectators(self, host_session_id: UUID
+                             ) -> list[Spectator]:
+        self.service.requests += 1
+        await asyncio.sleep(UPSTREAM_LATENCY)
+        return self.service.spectators
+
+    async def enqueue_packet(self, session_id: UUID, data: list[int]) -> bool:
+        self.service.requests += 1
+        self.service.bytes_sent += len(data)
+        await asyncio.sleep(UPSTREAM_LATENCY)
+        return True
+
+
+class StubQueueNotifier:
+    def notify(self, session_id: UUID) -> None:
+        pass
+
+
+class StubContext:
+    def __init__(self, service: StandInUsersService, outbox: Any) -> None:
+        self.http_client = service
+        self.outbox = outbox
+        self.queue_notifier = StubQueueNotifier()
+
+
+async def fan_out_per_spectator(client: StandInUsersClient,
+                                host_session_id: UUID,
+                                frame_bundle: bytes) -> None:
+    spectators = await client.get_spectators(host_session_id)
+    for spectator in spectators:
+        data = serial.write_spectate_frames_packet(frame_bundle)
+        await client.enqueue_packet(spectator.session_id, data=list(data))
+
+
+async def main() -> int:
+    install_stub_shared_modules(StandInUsersClient)
+
+    from app.common import settings
+    from app.services import delivery
+    from app.services.outbox import Outbox
+    from app.services.spectators import SpectatorEngine
+
+    # (the stand-in service only speaks the users client's json transport)
+    settings.PACKET_QUEUE_TRANSPORT = delivery.QUEUE_TRANSPORT_JSON
+
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, 10, 100]
+    frame_bundles = [os.urandom(FRAME_BUNDLE_SIZE)
+                     for _ in range(FRAME_BUNDLES)]
+    host_session_id = uuid.uuid4()
+
+    print(f"upstream latency {UPSTREAM_LATENCY * 1e3:.1f}ms, "
+          f"{FRAME_BUNDLES} bundles of {FRAME_BUNDLE_SIZE} bytes, "
+          f"the outbox flushed after each bundle")
+    print(f"{'spectators':>10} {'before (ms/bundle)':>19} "
+          f"{'engine (ms/bundle)':>19} {'before (req)':>13} "
+          f"{'engine (req)':>13}")
+    for count in counts:
+        spectators = [Spectator(uuid.uuid4(), account_id)
+                      for account_id in range(count)]
+
+        before = StandInUsersService(spectators)
+        client = StandInUsersClient(before)
+        start = time.perf_counter()
+        for frame_bundle in frame_bundles:
+            await fan_out_per_spectator(client, host_session_id,
+                                        frame_bundle)
+        before_ms = (time.perf_counter() - start) * 1e3 / FRAME_BUNDLES
+
+        after = StandInUsersService(spectators)
+        engine = SpectatorEngine(
+            ttl=60, max_size=1, frame_buffer_size=1,
+            frame_buffer_budget=FRAME_BUNDLE_SIZE * 2)
+        # (no limits; nothing polls these sessions)
+        ctx = StubContext(after, Outbox(max_bytes=sys.maxsize,
+                                        max_packets=sys.maxsize,
+                                        backlog_ttl=60))
+        start = time.perf_counter()
+        for frame_bundle in frame_bundles:
+            await engine.broadcast_frames(ctx,  # type: ignore[arg-type]
+                                          host_session_id, 0, frame_bundle)
+            await delivery.flush_outbox(ctx)  # type: ignore[arg-type]
+        after_ms = (time.perf_counter() - start) * 1e3 / FRAME_BUNDLES
+
+        if before.bytes_sent != after.bytes_sent:
+            print(f"{count}: engine delivered different data!")
+            return 1
+
+        print(f"{count:>10} {before_ms:>19.2f} {after_ms:>19.2f} "
+              f"{before.requests:>13} {after.requests:>13}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main()))
@@ -0,0 +1,45 @@
+"""Stubs for shared_modules, so that benchmarks can import and drive the
+real services without it."""
+from __future__ import annotations
+
+import sys
+import types
+from typing import Any
+
+
+def _log(*args: Any, **kwargs: Any) -> None:
+    pass
+
+
+def install_stub_shared_modules(users_client: type,
+                                chats_client: type = object) -> None:
+    """Stub out the parts of shared_modules the app imports, with the given
+    stand-ins for its users & chats clients. Call before importing any of
+    the app's services."""
+    attributes: dict[str, dict[str, Any]] = {
+        "shared_modules": {},
+        "shared_modules.logger": {"debug": _log, "info": _log,
+                                  "warning": _log, "error": _log},
+        "shared_modules.http_client": {"ServiceHTTPClient": object},
+        "shared_modules.api": {},
+        "shared_modules.api.rest": {},
+        "shared_modules.api.rest.v1": {},
+        "shared_modules.api.rest.v1.beatmaps": {"BeatmapsClient": object},
+        "shared_modules.api.rest.v1.chats": {"ChatsClient": chats_client},
+        "shared_modules.api.rest.v1.scores": {"ScoresClient": object},
+        "shared_modules.api.rest.v1.users": {"UsersClient": users_client},
+        "shared_modules.models": {},
+        "shared_modules.models.beatmaps": {"Beatmap": object},
+        "shared_modules.models.beatmapsets": {"Beatmapset": object},
+        "shared_modules.models.scores": {"Score": object},
+        "shared_modules.models.sessions": {"Session": object,
+                                           "LoginData": object},
+    }
+    for name, module_attributes in attributes.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(module_attributes)
+        sys.modules[name] = module
+
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(sys.modules[parent], child, module)